@@ -2,6 +2,8 @@
 from __future__ import absolute_import
 from collections import OrderedDict
 
+import six
+
 from frontera import Backend
 from frontera.core.components import States
 
@@ -62,13 +64,16 @@ class CommonBackend(Backend):
 
     def get_next_requests(self, max_next_requests, **kwargs):
         partitions = kwargs.pop('partitions', [0])  # TODO: Collect from all known partitions
+        quotas = kwargs.pop('quotas', None) or {}
         batch = []
         overused = self.get_overused_for_batch(partitions)
         if getattr(self.queue, 'batch_mode', None) == BATCH_MODE_ALL_PARTITIONS:
-            batch.extend(self.queue.get_next_requests(max_next_requests, partitions, overused=overused, **kwargs))
+            batch.extend(self.queue.get_next_requests(max_next_requests, partitions, overused=overused,
+                                                      quotas=quotas, **kwargs))
         else:
             for partition_id in partitions:
-                batch.extend(self.queue.get_next_requests(max_next_requests, partition_id, overused=overused[partition_id], **kwargs))
+                batch.extend(self.queue.get_next_requests(quotas.get(partition_id, max_next_requests), partition_id,
+                                                          overused=overused[partition_id], **kwargs))
         self.queue_size -= len(batch)
         return batch
 
@@ -94,6 +99,38 @@ class CommonBackend(Backend):
         self.metadata.request_error(request, error)
         self.states.update_cache(request)
 
+    def page_crawled_many(self, responses):
+        for response in responses:
+            response.meta[b'state'] = States.CRAWLED
+        self.states.update_cache(responses)
+        self.metadata.page_crawled_many(responses)
+
+    def links_extracted_many(self, batch):
+        to_fetch = OrderedDict()
+        unique_batch = []
+        for request, links in batch:
+            unique_links = OrderedDict()
+            for link in links:
+                unique_links[link.meta[b'fingerprint']] = link
+                link.meta[b'depth'] = request.meta.get(b'depth', 0)+1
+            for fingerprint, link in six.iteritems(unique_links):
+                to_fetch.setdefault(fingerprint, link)
+            unique_batch.append((request, list(unique_links.values())))
+        self.states.fetch(to_fetch.keys())
+        self.states.set_states([link for _, links in unique_batch for link in links])
+        unique_links = list(to_fetch.values())
+        self.metadata.links_extracted_many(unique_batch)
+        self._schedule(unique_links)
+        self.states.update_cache(unique_links)
+
+    def request_error_many(self, batch):
+        requests = []
+        for request, error in batch:
+            request.meta[b'state'] = States.ERROR
+            requests.append(request)
+        self.metadata.request_error_many(batch)
+        self.states.update_cache(requests)
+
     def set_overused(self, partition_id, netlocs):
         new_overused = {
             netloc: self.overused_batch_delay
@@ -4,8 +4,10 @@ from frontera.utils.url import parse_domain_from_url_fast
 from frontera import DistributedBackend
 from frontera.core.components import Metadata, Queue, States
 from frontera.core.models import Request
-from frontera.contrib.backends.partitioners import Crc32NamePartitioner
+from frontera.contrib.backends.partitioners import Crc32NamePartitioner, FingerprintPartitioner
 from frontera.utils.misc import chunks, get_crc32, load_object
+from frontera.utils.statetable import StateTable, StateDict
+from frontera.utils.bloom import ScalableBloomFilter
 from frontera.contrib.backends.remote.codecs.msgpack import Decoder, Encoder
 
 from happybase import Connection
@@ -21,7 +23,9 @@ from time import time
 from binascii import hexlify, unhexlify
 from io import BytesIO
 from random import choice
+from threading import Lock
 from collections import Iterable
+from functools import partial
 import logging
 
 
@@ -143,7 +147,8 @@ class HBaseQueue(Queue):
             key = self.partitioner.get_key(request)
             partition_id = self.partitioner.partition(key)
             host_crc32 = domain if type(domain) == int else get_crc32(key)
-            item = (unhexlify(fingerprint), host_crc32, self.encoder.encode_request(request), score)
+            item = (unhexlify(fingerprint), host_crc32, self.encoder.encode_request(self._with_score(request, score)),
+                    score)
             score = 1 - score  # because of lexicographical sort in HBase
             rk = "%d_%s_%d" % (partition_id, "%0.2f_%0.2f" % get_interval(score, 0.01), random_str)
             data.setdefault(rk, []).append((score, item))
@@ -166,6 +171,15 @@ class HBaseQueue(Queue):
                 final[b'f:t'] = str(timestamp)
                 b.put(rk, final)
 
+    def _with_score(self, request, score):
+        """
+        :return: shallow copy of request with score in meta, so encoded requests can be sent to spiders as they are
+        """
+        meta = dict(request.meta)
+        meta[b'score'] = score
+        return Request(request.url, method=request.method, headers=request.headers, cookies=request.cookies,
+                       meta=meta, body=request.body)
+
     def get_next_requests(self, max_n_requests, partition_id, **kwargs):
         """
         Tries to get new batch from priority queue. It makes self.GET_RETRIES tries and stops, trying to fit all
@@ -178,6 +192,42 @@ class HBaseQueue(Queue):
         :param max_requests_per_host: maximum number of requests per host
         :return: list of :class:`Request <frontera.core.models.Request>` objects.
         """
+        results = []
+        for _, _, encoded, score in self._get_next_items(max_n_requests, partition_id, **kwargs):
+            request = self.decoder.decode_request(encoded)
+            request.meta[b'score'] = score
+            results.append(request)
+        return results
+
+    def get_next_encoded_requests(self, max_n_requests, partition_id, partitioner=None, **kwargs):
+        """
+        The same as :meth:`get_next_requests`, but requests are returned as they are stored in the queue, encoded
+        with msgpack codec, ready to be sent to spider feed.
+
+        :param partitioner: partitioner of spider feed producer, keys are made for it, queue partitioner if None
+        :return: list of tuples (partitioning key, encoded request).
+        """
+        partitioner = partitioner or self.partitioner
+        return [(self._get_partition_key(partitioner, fprint, encoded), encoded)
+                for fprint, _, encoded, _ in self._get_next_items(max_n_requests, partition_id, **kwargs)]
+
+    def _get_partition_key(self, partitioner, fprint, encoded):
+        """
+        :return: the same key as partitioner makes for decoded request. Keys must be bytes or None for Kafka, the
+            items are already removed from the queue, so keys which can't be made are replaced with None.
+        """
+        if isinstance(partitioner, FingerprintPartitioner):
+            return hexlify(fprint)
+        try:
+            key = partitioner.get_key(self.decoder.decode_request(encoded))
+        except Exception as exc:
+            self.logger.error("Can't get partition key, fingerprint %s: %s", hexlify(fprint), exc)
+            return None
+        if isinstance(key, six.integer_types):
+            return to_bytes(str(key))
+        return key
+
+    def _get_next_items(self, max_n_requests, partition_id, **kwargs):
         min_requests = kwargs.pop('min_requests')
         min_hosts = kwargs.pop('min_hosts')
         max_requests_per_host = kwargs.pop('max_requests_per_host')
@@ -186,7 +236,7 @@ class HBaseQueue(Queue):
 
         meta_map = {}
         queue = {}
-        limit = min_requests
+        limit = max(min_requests, 1)
         tries = 0
         count = 0
         prefix = '%d_' % partition_id
@@ -248,10 +298,7 @@ class HBaseQueue(Queue):
                         continue
                     for rk_fprint in fprint_map[rk]:
                         _, item = meta_map[rk_fprint][0]
-                        _, _, encoded, score = item
-                        request = self.decoder.decode_request(encoded)
-                        request.meta[b'score'] = score
-                        results.append(request)
+                        results.append(item)
                     trash_can.add(rk)
 
         with table.batch(transaction=True) as b:
@@ -266,53 +313,117 @@ class HBaseQueue(Queue):
 
 class HBaseState(States):
 
-    def __init__(self, connection, table_name, cache_size_limit):
+    def __init__(self, connection, table_name, cache_size_limit, compact=False, low_watermark=0.75,
+                 filter_capacity=0, filter_error_rate=0.001):
+        """
+        :param filter_capacity: if positive, Bloom filter of fingerprints having state in HBase is kept, with this
+            initial capacity. Fingerprints missing in the filter aren't fetched from HBase. The filter is filled on
+            start and by own flushes only, so it's valid only if this is the only process writing states.
+        """
         self.connection = connection
         self._table_name = table_name
         self.logger = logging.getLogger("hbase.states")
-        self._state_cache = {}
+        # full fingerprints are kept, they're needed as row keys on flush
+        self._state_cache = StateTable(key_size=None) if compact else StateDict()
         self._cache_size_limit = cache_size_limit
+        self._low_watermark = low_watermark
+        self._filter = ScalableBloomFilter(filter_capacity, filter_error_rate) if filter_capacity else None
+        self.cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'filtered': 0}
+        # connection isn't thread-safe and states may be read in background, see StrategyWorker
+        self._storage_lock = Lock()
+
+    def frontier_start(self):
+        if self._filter is None:
+            return
+        self.logger.info("Loading fingerprints of known states into the filter")
+        table = self.connection.table(self._table_name)
+        for key, _ in table.scan(columns=[b's:state'], filter=b'KeyOnlyFilter()', batch_size=10000):
+            self._filter.add(hexlify(key))
+        self.logger.info("Filter has %d fingerprints", len(self._filter))
 
     def update_cache(self, objs):
         objs = objs if isinstance(objs, Iterable) else [objs]
-
-        def put(obj):
-            self._state_cache[obj.meta[b'fingerprint']] = obj.meta[b'state']
-        [put(obj) for obj in objs]
+        self._state_cache.update((obj.meta[b'fingerprint'], obj.meta[b'state']) for obj in objs)
 
     def set_states(self, objs):
         objs = objs if isinstance(objs, Iterable) else [objs]
 
         def get(obj):
-            fprint = obj.meta[b'fingerprint']
-            obj.meta[b'state'] = self._state_cache[fprint] if fprint in self._state_cache else States.DEFAULT
+            obj.meta[b'state'] = self._state_cache.get(obj.meta[b'fingerprint'], States.DEFAULT)
         [get(obj) for obj in objs]
 
-    def flush(self, force_clear):
-        if len(self._state_cache) > self._cache_size_limit:
-            force_clear = True
+    def flush_dirty(self, count=None):
+        """
+        Writes at most count states changed since they were fetched, and marks them clean.
+
+        :return: count of written states
+        """
+        items = self._state_cache.dirty_items(count)
         table = self.connection.table(self._table_name)
-        for chunk in chunks(list(self._state_cache.items()), 32768):
-            with table.batch(transaction=True) as b:
+        for chunk in chunks(items, 32768):
+            with self._storage_lock, table.batch(transaction=True) as b:
                 for fprint, state in chunk:
                     hb_obj = prepare_hbase_object(state=state)
                     b.put(unhexlify(fprint), hb_obj)
+            self._state_cache.mark_clean(fprint for fprint, _ in chunk)
+            if self._filter is not None:
+                for fprint, _ in chunk:
+                    self._filter.add(fprint)
+        return len(items)
+
+    def flush(self, force_clear):
+        self.flush_dirty()
         if force_clear:
             self.logger.debug("Cache has %d requests, clearing" % len(self._state_cache))
+            self.cache_stats['evictions'] += len(self._state_cache)
             self._state_cache.clear()
+            return
+        if len(self._state_cache) > self._cache_size_limit:
+            evicted = self._state_cache.evict(int(self._cache_size_limit * self._low_watermark))
+            self.cache_stats['evictions'] += evicted
+            self.logger.debug("Cache has %d requests, %d evicted" % (len(self._state_cache), evicted))
 
     def fetch(self, fingerprints):
-        to_fetch = [f for f in fingerprints if f not in self._state_cache]
+        to_fetch = self.missing(fingerprints)
         self.logger.debug("cache size %s" % len(self._state_cache))
         self.logger.debug("to fetch %d from %d" % (len(to_fetch), len(fingerprints)))
-        for chunk in chunks(to_fetch, 65536):
-            keys = [unhexlify(fprint) for fprint in chunk]
+        self.load(self.read(to_fetch))
+
+    def missing(self, fingerprints):
+        """
+        Returns fingerprints which states aren't in cache and have to be read from HBase.
+        """
+        missing = [f for f in fingerprints if f not in self._state_cache]
+        self.cache_stats['hits'] += len(fingerprints) - len(missing)
+        self.cache_stats['misses'] += len(missing)
+        if self._filter is not None:
+            # definitely never stored states are left to default
+            known = [f for f in missing if f in self._filter]
+            self.cache_stats['filtered'] += len(missing) - len(known)
+            missing = known
+        return missing
+
+    def read(self, fingerprints):
+        """
+        Reads states from HBase, without touching the cache, so it can be called from another thread.
+
+        :return: list of (fingerprint, state) tuples for fingerprints found in HBase
+        """
+        result = []
+        with self._storage_lock:
             table = self.connection.table(self._table_name)
-            records = table.rows(keys, columns=[b's:state'])
-            for key, cells in records:
-                if b's:state' in cells:
-                    state = unpack('>B', cells[b's:state'])[0]
-                    self._state_cache[hexlify(key)] = state
+            for chunk in chunks(fingerprints, 65536):
+                records = table.rows([unhexlify(fprint) for fprint in chunk], columns=[b's:state'])
+                result.extend((hexlify(key), unpack('>B', cells[b's:state'])[0])
+                              for key, cells in records if b's:state' in cells)
+        return result
+
+    def load(self, items):
+        """
+        Puts states read from HBase to cache. Cached states are never older than stored ones, so states of
+        fingerprints already in cache are left as they are.
+        """
+        self._state_cache.update(((f, s) for f, s in items if f not in self._state_cache), dirty=False)
 
 
 class HBaseMetadata(Metadata):
@@ -360,9 +471,13 @@ class HBaseMetadata(Metadata):
         self.batch.put(unhexlify(response.meta[b'fingerprint']), obj)
 
     def links_extracted(self, request, links):
+        self.links_extracted_many([(request, links)])
+
+    def links_extracted_many(self, batch):
         links_dict = dict()
-        for link in links:
-            links_dict[unhexlify(link.meta[b'fingerprint'])] = (link, link.url, link.meta[b'domain'])
+        for _, links in batch:
+            for link in links:
+                links_dict[unhexlify(link.meta[b'fingerprint'])] = (link, link.url, link.meta[b'domain'])
         for link_fingerprint, (link, link_url, link_domain) in six.iteritems(links_dict):
             obj = prepare_hbase_object(url=link_url,
                                        created_at=utcnow_timestamp(),
@@ -388,6 +503,8 @@ class HBaseMetadata(Metadata):
 
 class HBaseBackend(DistributedBackend):
     component_name = 'HBase Backend'
+    # queue table always stores requests encoded with msgpack codec
+    encoded_requests_codec = 'frontera.contrib.backends.remote.codecs.msgpack'
 
     def __init__(self, manager):
         self.manager = manager
@@ -424,8 +541,15 @@ class HBaseBackend(DistributedBackend):
     def strategy_worker(cls, manager):
         o = cls(manager)
         settings = manager.settings
+        filter_capacity = settings.get('HBASE_STATE_FILTER_CAPACITY')
+        if filter_capacity and settings.get('SPIDER_LOG_PARTITIONS') > 1:
+            # states written by other strategy workers would be treated as missing forever
+            o.logger.warning("States filter is disabled, it can't be used with several strategy workers")
+            filter_capacity = 0
         o._states = HBaseState(o.connection, settings.get('HBASE_METADATA_TABLE'),
-                               settings.get('HBASE_STATE_CACHE_SIZE_LIMIT'))
+                               settings.get('HBASE_STATE_CACHE_SIZE_LIMIT'), settings.get('STATE_CACHE_COMPACT'),
+                               settings.get('STATE_CACHE_LOW_WATERMARK'), filter_capacity,
+                               settings.get('HBASE_STATE_FILTER_ERROR_RATE'))
         return o
 
     @classmethod
@@ -475,20 +599,51 @@ class HBaseBackend(DistributedBackend):
     def request_error(self, page, error):
         self.metadata.request_error(page, error)
 
+    def page_crawled_many(self, responses):
+        self.metadata.page_crawled_many(responses)
+
+    def links_extracted_many(self, batch):
+        self.metadata.links_extracted_many(batch)
+
+    def request_error_many(self, batch):
+        self.metadata.request_error_many(batch)
+
     def finished(self):
         raise NotImplementedError
 
     def get_next_requests(self, max_next_requests, **kwargs):
+        return self._get_next(self.queue.get_next_requests, max_next_requests, **kwargs)
+
+    def get_next_encoded_requests(self, max_next_requests, **kwargs):
+        """
+        Returns next requests as they are stored in the queue, encoded with :attr:`encoded_requests_codec`, along
+        with their partitioning keys. Used by DB worker to push batches to spider feed without decoding and encoding
+        every request, when message bus uses the same codec.
+
+        :param partitioner: partitioner of spider feed producer
+        :return: list of tuples (partitioning key, encoded request).
+        """
+        partitioner = kwargs.pop('partitioner', None)
+        return self._get_next(partial(self.queue.get_next_encoded_requests, partitioner=partitioner),
+                              max_next_requests, **kwargs)
+
+    def _get_next(self, get_func, max_next_requests, **kwargs):
         next_pages = []
         self.logger.debug("Querying queue table.")
         partitions = set(kwargs.pop('partitions', []))
+        quotas = kwargs.pop('quotas', None) or {}
         for partition_id in self.partitioner.partitions:
             if partition_id not in partitions:
                 continue
-            results = self.queue.get_next_requests(max_next_requests, partition_id,
-                                                   min_requests=self._min_requests,
-                                                   min_hosts=self._min_hosts,
-                                                   max_requests_per_host=self._max_requests_per_host)
+            max_n_requests = quotas.get(partition_id, max_next_requests)
+            if max_n_requests <= 0:
+                continue
+            # queue scan must be able to stop below the quota
+            min_requests = min(self._min_requests, max_n_requests - 1)
+            results = get_func(max_n_requests, partition_id,
+                               min_requests=min_requests,
+                               min_hosts=self._min_hosts,
+                               max_requests_per_host=self._max_requests_per_host)
             next_pages.extend(results)
             self.logger.debug("Got %d requests for partition id %d", len(results), partition_id)
         return next_pages
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 import logging
 import random
 from collections import deque, Iterable
+from heapq import heappush, heappop
+from itertools import count
 
 from frontera.contrib.backends import CommonBackend
 from frontera.core.components import Metadata, Queue, States
@@ -9,15 +11,12 @@ from frontera.core import OverusedBuffer
 from frontera.utils.heap import Heap
 from frontera.utils.url import parse_domain_from_url_fast
 from frontera.utils.misc import load_object
+from frontera.utils.statetable import StateTable, StateDict
 import six
 from six.moves import map
 from six.moves import range
 
 
-def cmp(a, b):
-    return (a > b) - (a < b)
-
-
 class MemoryMetadata(Metadata):
     def __init__(self):
         self.requests = {}
@@ -57,24 +56,28 @@ class MemoryQueue(Queue):
         self.logger = logging.getLogger("memory.queue")
         self.heap = {}
         for partition in self.partitioner.partitions:
-            self.heap[partition] = Heap(self._compare_pages)
+            self.heap[partition] = Heap(self._get_key)
 
     def count(self):
-        return sum([len(h.heap) for h in six.itervalues(self.heap)])
+        return sum([len(h) for h in six.itervalues(self.heap)])
 
     def get_next_requests(self, max_n_requests, partition_id, **kwargs):
         return self.heap[partition_id].pop(max_n_requests)
 
     def schedule(self, batch):
+        to_push = dict((partition, []) for partition in self.heap)
         for fprint, score, request, schedule in batch:
             if schedule:
                 request.meta[b'_scr'] = score
                 key = self.partitioner.get_key(request)
                 partition_id = self.partitioner.partition(key)
-                self.heap[partition_id].push(request)
+                to_push[partition_id].append(request)
+        for partition_id, requests in six.iteritems(to_push):
+            if requests:
+                self.heap[partition_id].push_many(requests)
 
-    def _compare_pages(self, first, second):
-        return cmp(first.meta[b'_scr'], second.meta[b'_scr'])
+    def _get_key(self, request):
+        return request.meta[b'_scr']
 
 
 class MemoryDequeQueue(Queue):
@@ -111,37 +114,163 @@ class MemoryDequeQueue(Queue):
                 self.queues[partition_id].append(request)
 
 
+class MemoryBroadCrawlingQueue(Queue):
+    def __init__(self, partitioner, min_hosts=None, max_requests_per_host=None):
+        """
+        Queue keeping a heap of requests for every host and a heap of hosts ordered by score of their best request.
+        Batches are taken round-robin: one request from each host in order of their best scores, then the next round,
+        so a single large host can't take the whole batch.
+
+        :param partitioner: Partitioner
+        :param min_hosts: int, minimum number of hosts in a batch, logged when partition has less hosts
+        :param max_requests_per_host: int, maximum number of requests per host in a batch, None for unlimited
+        """
+        self.partitioner = partitioner
+        self.logger = logging.getLogger("memory.broadcrawlingqueue")
+        self.min_hosts = min_hosts
+        self.max_requests_per_host = max_requests_per_host
+        self._counter = count()
+        self.queues = {}
+        self.hosts = {}
+        for partition in self.partitioner.partitions:
+            self.queues[partition] = {}
+            self.hosts[partition] = []
+
+    def count(self):
+        return sum(len(queue) for queues in six.itervalues(self.queues) for queue in six.itervalues(queues))
+
+    def _get_host(self, request):
+        domain = request.meta.get(b'domain')
+        if isinstance(domain, dict) and domain.get(b'name'):
+            return domain[b'name']
+        return parse_domain_from_url_fast(request.url)[1]
+
+    def _push_host(self, hosts, host, queue):
+        # entries of hosts are never removed, stale ones are recognized by the key of the best request
+        score, seq, _ = queue[0]
+        heappush(hosts, (score, seq, host))
+
+    def get_next_requests(self, max_n_requests, partition_id, **kwargs):
+        min_hosts = kwargs.get('min_hosts', self.min_hosts)
+        max_requests_per_host = kwargs.get('max_requests_per_host', self.max_requests_per_host)
+        queues = self.queues[partition_id]
+        hosts = self.hosts[partition_id]
+        batch = []
+        taken = {}
+        while hosts and len(batch) < max_n_requests:
+            next_round = []
+            while hosts and len(batch) < max_n_requests:
+                score, seq, host = heappop(hosts)
+                queue = queues.get(host)
+                if not queue or queue[0][1] != seq:
+                    continue
+                batch.append(heappop(queue)[2])
+                taken[host] = taken.get(host, 0) + 1
+                if not queue:
+                    del queues[host]
+                elif max_requests_per_host is None or taken[host] < max_requests_per_host:
+                    next_round.append(host)
+            for host in next_round:
+                self._push_host(hosts, host, queues[host])
+        # hosts limited by max_requests_per_host are returned to the heap for the next batch
+        for host, taken_count in six.iteritems(taken):
+            if taken_count == max_requests_per_host and host in queues:
+                self._push_host(hosts, host, queues[host])
+        if min_hosts is not None and len(taken) < min_hosts:
+            self.logger.debug("Partition %d has %d hosts, less than %d", partition_id, len(taken), min_hosts)
+        return batch
+
+    def schedule(self, batch):
+        for fprint, score, request, schedule in batch:
+            if schedule:
+                request.meta[b'_scr'] = score
+                key = self.partitioner.get_key(request)
+                partition_id = self.partitioner.partition(key)
+                host = self._get_host(request)
+                queues = self.queues[partition_id]
+                queue = queues.setdefault(host, [])
+                item = (-score, next(self._counter), request)
+                heappush(queue, item)
+                if queue[0] is item:
+                    self._push_host(self.hosts[partition_id], host, queue)
+
+
 class MemoryStates(States):
 
-    def __init__(self, cache_size_limit):
-        self._cache = dict()
+    def __init__(self, cache_size_limit, compact=False, low_watermark=0.75):
+        self._cache = StateTable(key_size=8) if compact else StateDict()
         self._cache_size_limit = cache_size_limit
+        self._low_watermark = low_watermark
+        self.cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
         self.logger = logging.getLogger("memory.states")
 
-    def _put(self, obj):
-        self._cache[obj.meta[b'fingerprint']] = obj.meta[b'state']
-
     def _get(self, obj):
-        fprint = obj.meta[b'fingerprint']
-        obj.meta[b'state'] = self._cache[fprint] if fprint in self._cache else States.DEFAULT
+        obj.meta[b'state'] = self._cache.get(obj.meta[b'fingerprint'], States.DEFAULT)
 
     def update_cache(self, objs):
         objs = objs if isinstance(objs, Iterable) else [objs]
-        [self._put(obj) for obj in objs]
+        self._cache.update((obj.meta[b'fingerprint'], obj.meta[b'state']) for obj in objs)
 
     def set_states(self, objs):
         objs = objs if isinstance(objs, Iterable) else [objs]
         [self._get(obj) for obj in objs]
 
     def fetch(self, fingerprints):
+        self.load(self.read(self.missing(fingerprints)))
+
+    def missing(self, fingerprints):
+        """
+        Returns fingerprints which states aren't in cache and have to be read from storage.
+        """
+        missing = [f for f in fingerprints if f not in self._cache]
+        self._count_hits(fingerprints, missing)
+        return missing
+
+    def read(self, fingerprints):
+        """
+        Reads states from storage, without touching the cache, so it can be called from another thread.
+
+        :return: list of (fingerprint, state) tuples for fingerprints found in storage
+        """
+        return []
+
+    def load(self, items):
+        """
+        Puts states read from storage to cache. Cached states are never older than stored ones, so states of
+        fingerprints already in cache are left as they are.
+        """
+        self._cache.update(((f, s) for f, s in items if f not in self._cache), dirty=False)
+
+    def _count_hits(self, fingerprints, missing):
+        self.cache_stats['hits'] += len(fingerprints) - len(missing)
+        self.cache_stats['misses'] += len(missing)
+
+    def flush_dirty(self, count=None):
+        """
+        Persists at most count states changed since they were fetched, and marks them clean.
+
+        :return: count of persisted states
+        """
+        items = self._cache.dirty_items(count)
+        if items:
+            self._persist(items)
+            self._cache.mark_clean(fingerprint for fingerprint, _ in items)
+        return len(items)
+
+    def _persist(self, items):
         pass
 
     def flush(self, force_clear=False):
-        if len(self._cache) > self._cache_size_limit:
-            force_clear = True
+        self.flush_dirty()
         if force_clear:
             self.logger.debug("Cache has %d items, clearing", len(self._cache))
+            self.cache_stats['evictions'] += len(self._cache)
             self._cache.clear()
+            return
+        if len(self._cache) > self._cache_size_limit:
+            evicted = self._cache.evict(int(self._cache_size_limit * self._low_watermark))
+            self.cache_stats['evictions'] += evicted
+            self.logger.debug("Cache has %d items, %d evicted", len(self._cache), evicted)
 
 
 class MemoryBaseBackend(CommonBackend):
@@ -154,7 +283,8 @@ class MemoryBaseBackend(CommonBackend):
         self.manager = manager
         settings = manager.settings
         self._metadata = MemoryMetadata()
-        self._states = MemoryStates(settings.get("STATE_CACHE_SIZE"))
+        self._states = MemoryStates(settings.get("STATE_CACHE_SIZE"), settings.get("STATE_CACHE_COMPACT"),
+                                    settings.get("STATE_CACHE_LOW_WATERMARK"))
         partitions = list(range(settings.get('SPIDER_FEED_PARTITIONS')))
         partitioner_cls = load_object(settings.get('SPIDER_FEED_PARTITIONER'))
         self._partitioner = partitioner_cls(partitions)
@@ -192,25 +322,65 @@ class MemoryBaseBackend(CommonBackend):
             self._id += 1
         super(MemoryBaseBackend, self).links_extracted(request, links)
 
+    def links_extracted_many(self, batch):
+        for _, links in batch:
+            for link in links:
+                link.meta[b'id'] = self._id
+                self._id += 1
+        super(MemoryBaseBackend, self).links_extracted_many(batch)
+
     def finished(self):
         return self.queue.count() == 0
 
 
 class MemoryDFSQueue(MemoryQueue):
-    def _compare_pages(self, first, second):
-        return cmp((second.meta[b'depth'], first.meta[b'id']),
-                   (first.meta[b'depth'], second.meta[b'id']))
+    def _get_key(self, request):
+        return -request.meta[b'depth'], request.meta[b'id']
 
 
 class MemoryBFSQueue(MemoryQueue):
-    def _compare_pages(self, first, second):
-        return cmp((first.meta[b'depth'], first.meta[b'id']),
-                   (second.meta[b'depth'], second.meta[b'id']))
+    def _get_key(self, request):
+        return request.meta[b'depth'], request.meta[b'id']
 
 
-class MemoryRandomQueue(MemoryQueue):
-    def _compare_pages(self, first, second):
-        return random.choice([-1, 0, 1])
+class MemoryRandomQueue(Queue):
+    def __init__(self, partitioner):
+        """
+        Queue returning requests in random order. Requests are kept in a list per partition, and every request is
+        taken by swapping a random one with the last and popping it.
+        :param partitioner: Partitioner
+        """
+        self.partitioner = partitioner
+        self.logger = logging.getLogger("memory.randomqueue")
+        self.queues = {}
+        for partition in self.partitioner.partitions:
+            self.queues[partition] = []
+
+    def count(self):
+        return sum([len(q) for q in six.itervalues(self.queues)])
+
+    def get_next_requests(self, max_n_requests, partition_id, **kwargs):
+        queue = self.queues[partition_id]
+        batch = []
+        while queue and len(batch) < max_n_requests:
+            index = random.randrange(len(queue))
+            queue[index], queue[-1] = queue[-1], queue[index]
+            batch.append(queue.pop())
+        return batch
+
+    def schedule(self, batch):
+        for fprint, score, request, schedule in batch:
+            if schedule:
+                request.meta[b'_scr'] = score
+                key = self.partitioner.get_key(request)
+                partition_id = self.partitioner.partition(key)
+                self.queues[partition_id].append(request)
+
+
+class MemoryBroadCrawlingBackend(MemoryBaseBackend):
+    def _create_queue(self, settings):
+        return MemoryBroadCrawlingQueue(self._partitioner, settings.get('BC_MIN_HOSTS'),
+                                        settings.get('BC_MAX_REQUESTS_PER_HOST'))
 
 
 class MemoryFIFOBackend(MemoryBaseBackend):
@@ -253,3 +423,4 @@ LIFO = MemoryLIFOBackend
 DFS = MemoryDFSBackend
 BFS = MemoryBFSBackend
 RANDOM = MemoryRandomBackend
+BC = MemoryBroadCrawlingBackend
@@ -124,6 +124,11 @@ class Encoder(BaseEncoder, CrawlFrontierJSONEncoder):
     def encode_request(self, request):
         return self.encode(_prepare_request_message(request))
 
+    def update_request_meta(self, buffer, meta):
+        obj = _convert_from_saved_type(json.loads(to_unicode(buffer)))
+        obj['meta'].update(meta)
+        return self.encode(obj)
+
     def encode_update_score(self, request, score, schedule):
         return self.encode({'type': 'update_score',
                             'r': _prepare_request_message(request),
@@ -59,6 +59,11 @@ class Encoder(BaseEncoder):
     def encode_request(self, request):
         return packb(_prepare_request_message(request), use_bin_type=True)
 
+    def update_request_meta(self, buffer, meta):
+        obj = unpackb(buffer, encoding='utf-8')
+        obj[5].update(meta)
+        return packb(obj, use_bin_type=True)
+
     def encode_update_score(self, request, score, schedule):
         return packb([b'us', _prepare_request_message(request), score, schedule], use_bin_type=True)
 
@@ -40,6 +40,7 @@ class MessageBusBackend(Backend):
 
     def frontier_stop(self):
         self.spider_log_producer.flush()
+        self.spider_log_producer.close()
 
     def add_seeds(self, seeds):
         per_host = aggregate_per_host(seeds)
@@ -79,10 +80,16 @@ class MessageBusBackend(Backend):
         self.spider_log_producer.send(b'0123456789abcdef0123456789abcdef012345678',
                                       self._encoder.encode_offset(self.partition_id,
                                                                   self.consumer.get_offset(self.partition_id)))
+        # producer may keep messages in an envelope until the next send, but DB worker needs offset to fill the
+        # partition without delay
+        self.spider_log_producer.flush()
 
         return requests
 
     def get_next_requests(self, max_n_requests, **kwargs):
+        # called by spider regularly, also when it's idle, so partially filled envelopes aren't stuck in producer
+        if hasattr(self.spider_log_producer, 'flush_expired'):
+            self.spider_log_producer.flush_expired()
         return self._buffer.get_next_requests(max_n_requests, **kwargs)
 
     def finished(self):
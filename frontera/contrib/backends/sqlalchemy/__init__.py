@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine.reflection import Inspector
 
@@ -11,6 +13,14 @@ from frontera.contrib.backends.sqlalchemy.models import DeclarativeBase
 from frontera.utils.misc import load_object
 
 
+def _create_engine(engine, echo):
+    url = make_url(engine)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # every connection to in-memory SQLite gets its own database, share one between threads instead
+        return create_engine(url, echo=echo, poolclass=StaticPool, connect_args={'check_same_thread': False})
+    return create_engine(url, echo=echo)
+
+
 class SQLAlchemyBackend(CommonBackend):
     def __init__(self, manager):
         self.manager = manager
@@ -21,7 +31,7 @@ class SQLAlchemyBackend(CommonBackend):
         clear_content = settings.get('SQLALCHEMYBACKEND_CLEAR_CONTENT')
         models = settings.get('SQLALCHEMYBACKEND_MODELS')
 
-        self.engine = create_engine(engine, echo=engine_echo)
+        self.engine = _create_engine(engine, engine_echo)
         self.models = dict([(name, load_object(klass)) for name, klass in models.items()])
 
         if drop_all_tables:
@@ -43,7 +53,9 @@ class SQLAlchemyBackend(CommonBackend):
         self.partitioner = partitioner_cls(partitions)
 
         self._metadata = Metadata(self.session_cls, self.models['MetadataModel'],
-                                  settings.get('SQLALCHEMYBACKEND_CACHE_SIZE'))
+                                  settings.get('SQLALCHEMYBACKEND_CACHE_SIZE'),
+                                  settings.get('SQLALCHEMYBACKEND_METADATA_FLUSH_SIZE'),
+                                  settings.get('SQLALCHEMYBACKEND_METADATA_FLUSH_INTERVAL'))
         self._states = States(self.session_cls, self.models['StateModel'],
                               settings.get('STATE_CACHE_SIZE_LIMIT'))
         self._queue = self._create_queue(settings)
@@ -118,7 +130,7 @@ class Distributed(DistributedBackend):
         engine = settings.get('SQLALCHEMYBACKEND_ENGINE')
         engine_echo = settings.get('SQLALCHEMYBACKEND_ENGINE_ECHO')
         models = settings.get('SQLALCHEMYBACKEND_MODELS')
-        self.engine = create_engine(engine, echo=engine_echo)
+        self.engine = _create_engine(engine, engine_echo)
         self.models = dict([(name, load_object(klass)) for name, klass in models.items()])
         self.session_cls = sessionmaker()
         self.session_cls.configure(bind=self.engine)
@@ -174,7 +186,9 @@ class Distributed(DistributedBackend):
             session.close()
 
         b._metadata = Metadata(b.session_cls, metadata_m,
-                               settings.get('SQLALCHEMYBACKEND_CACHE_SIZE'))
+                               settings.get('SQLALCHEMYBACKEND_CACHE_SIZE'),
+                               settings.get('SQLALCHEMYBACKEND_METADATA_FLUSH_SIZE'),
+                               settings.get('SQLALCHEMYBACKEND_METADATA_FLUSH_INTERVAL'))
         b._queue = Queue(b.session_cls, queue_m, b.partitioner)
         return b
 
@@ -205,9 +219,11 @@ class Distributed(DistributedBackend):
 
     def get_next_requests(self, max_next_requests, **kwargs):
         partitions = kwargs.pop('partitions', [0])  # TODO: Collect from all known partitions
+        quotas = kwargs.pop('quotas', None) or {}
         batch = []
         for partition_id in partitions:
-            batch.extend(self.queue.get_next_requests(max_next_requests, partition_id, **kwargs))
+            batch.extend(self.queue.get_next_requests(quotas.get(partition_id, max_next_requests), partition_id,
+                                                      **kwargs))
         return batch
 
     def page_crawled(self, response):
@@ -219,6 +235,15 @@ class Distributed(DistributedBackend):
     def request_error(self, request, error):
         self.metadata.request_error(request, error)
 
+    def page_crawled_many(self, responses):
+        self.metadata.page_crawled_many(responses)
+
+    def links_extracted_many(self, batch):
+        self.metadata.links_extracted_many(batch)
+
+    def request_error_many(self, batch):
+        self.metadata.request_error_many(batch)
+
     def finished(self):
         raise NotImplementedError
 
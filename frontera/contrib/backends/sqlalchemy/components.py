@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import logging
+from collections import defaultdict
 from datetime import datetime
+from threading import Lock
 from time import time, sleep
 
 from cachetools import LRUCache
+from sqlalchemy import bindparam, func
 from frontera.contrib.backends.memory import MemoryStates
-from frontera.contrib.backends.sqlalchemy.models import DeclarativeBase
+from frontera.contrib.backends.sqlalchemy.models import DeclarativeBase, encode_payload, decode_payload
 from frontera.core.components import Metadata as BaseMetadata, Queue as BaseQueue
 from frontera.core.models import Request, Response
 from frontera.utils.misc import get_crc32, chunks
@@ -16,6 +19,33 @@ from six.moves import range
 from w3lib.util import to_native_str, to_bytes
 
 
+def upsert_statement(session, table, key_columns, update_columns):
+    """
+    Creates bulk upsert statement for the dialect of session's database: INSERT ... ON CONFLICT for SQLite and
+    PostgreSQL, INSERT ... ON DUPLICATE KEY UPDATE for MySQL. SQLite upsert requires SQLAlchemy 1.4+, with older
+    versions callers fall back to ORM merge.
+
+    :return: statement to execute with a list of row dicts, or None if dialect or SQLAlchemy version doesn't support it
+    """
+    dialect = session.get_bind().dialect.name
+    try:
+        if dialect in ('postgresql', 'sqlite'):
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            stmt = insert(table)
+            return stmt.on_conflict_do_update(index_elements=key_columns,
+                                              set_=dict((column, stmt.excluded[column]) for column in update_columns))
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(table)
+            return stmt.on_duplicate_key_update(**dict((column, stmt.inserted[column]) for column in update_columns))
+    except ImportError:
+        pass
+    return None
+
+
 def retry_and_rollback(func):
     def func_wrapper(self, *args, **kwargs):
         tries = 5
@@ -36,76 +66,186 @@ def retry_and_rollback(func):
 
 
 class Metadata(BaseMetadata):
-    def __init__(self, session_cls, model_cls, cache_size):
+    def __init__(self, session_cls, model_cls, cache_size, flush_size=0, flush_interval=None):
+        """
+        Changed rows are kept in memory and written in bulk, when there are flush_size of them, flush_interval
+        seconds passed since the last write or the frontier is stopping. Default flush_size 0 writes rows on every
+        call. Cache holds the latest version of rows, written or not.
+        """
         self.session = session_cls(expire_on_commit=False)   # FIXME: Should be explicitly mentioned in docs
         self.model = model_cls
         self.table = DeclarativeBase.metadata.tables['metadata']
         self.cache = LRUCache(cache_size)
         self.logger = logging.getLogger("sqlalchemy.metadata")
+        # meta, headers and cookies are kept in one column, see payload module
+        self._payload = hasattr(model_cls, 'payload')
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._last_flush = time()
+        # fingerprint -> (row, keys of changed columns, True if the row isn't known to be written)
+        self._pending = {}
+        self._upserts = {}
+        self._updates = {}
 
     def frontier_stop(self):
+        self.flush()
         self.session.close()
 
     @retry_and_rollback
+    def flush(self):
+        groups = defaultdict(list)
+        for row, columns, created in six.itervalues(self._pending):
+            columns = frozenset(columns) | frozenset(['fingerprint'])
+            groups[(columns, created)].append(dict((column, getattr(row, column)) for column in columns))
+        for (columns, created), rows in six.iteritems(groups):
+            if created:
+                self._write(columns, rows)
+            else:
+                self._update(columns, rows)
+        self.session.commit()
+        self._pending = {}
+        self._last_flush = time()
+
+    def _write(self, columns, rows):
+        if columns not in self._upserts:
+            self._upserts[columns] = upsert_statement(self.session, self.model.__table__, ['fingerprint'],
+                                                      sorted(columns - set(['fingerprint'])))
+        upsert = self._upserts[columns]
+        if upsert is None:
+            for row in rows:
+                self.session.merge(self.model(**row))
+            return
+        for chunk in chunks(rows, 1000):
+            self.session.execute(upsert, chunk)
+
+    def _update(self, columns, rows):
+        # rows are partial, inserting them would break NOT NULL constraints, so they are updated by fingerprint
+        if columns not in self._updates:
+            table = self.model.__table__
+            self._updates[columns] = table.update().where(table.c.fingerprint == bindparam('_fingerprint')).values(
+                dict((column, bindparam('_' + column, type_=table.c[column].type))
+                     for column in columns if column != 'fingerprint'))
+        params = [dict(('_' + column, value) for column, value in six.iteritems(row)) for row in rows]
+        for chunk in chunks(params, 1000):
+            self.session.execute(self._updates[columns], chunk)
+
+    def flush_if_needed(self):
+        """
+        Writes pending rows, if there are enough of them or flush interval has passed. Called after every change
+        and periodically by DB worker, so rows are written in time also when there are no changes.
+        """
+        if not self._pending:
+            return
+        if len(self._pending) >= self._flush_size or \
+                (self._flush_interval is not None and time() - self._last_flush >= self._flush_interval):
+            self.flush()
+
+    def _save_page(self, obj, create=False, **values):
+        fingerprint = obj.meta[b'fingerprint']
+        pending = None if create else self._pending.get(fingerprint)
+        row = None if create else pending[0] if pending else self.cache.get(fingerprint)
+        created = pending[2] if pending else False
+        if row is not None:
+            columns = self._modify_page(row, obj)
+        else:
+            created = True
+            row = self._create_page(obj)
+            columns = [column.key for column in self.model.__table__.columns if column.key in row.__dict__]
+        for column, value in six.iteritems(values):
+            setattr(row, column, value)
+            columns.append(column)
+        self.cache[fingerprint] = row
+        if pending:
+            pending[1].update(columns)
+        else:
+            self._pending[fingerprint] = (row, set(columns), created)
+
     def add_seeds(self, seeds):
         for seed in seeds:
-            o = self._create_page(seed)
-            self.cache[to_bytes(o.fingerprint)] = self.session.merge(o)
-        self.session.commit()
+            self._save_page(seed, create=True)
+        self.flush_if_needed()
 
-    @retry_and_rollback
     def request_error(self, page, error):
-        m = self._modify_page(page) if page.meta[b'fingerprint'] in self.cache else self._create_page(page)
-        m.error = error
-        self.cache[to_bytes(m.fingerprint)] = self.session.merge(m)
-        self.session.commit()
+        self.request_error_many([(page, error)])
+
+    def request_error_many(self, batch):
+        for page, error in batch:
+            self._save_page(page, error=error)
+        self.flush_if_needed()
 
-    @retry_and_rollback
     def page_crawled(self, response):
-        r = self._modify_page(response) if response.meta[b'fingerprint'] in self.cache else self._create_page(response)
-        self.cache[r.fingerprint] = self.session.merge(r)
-        self.session.commit()
+        self.page_crawled_many([response])
+
+    def page_crawled_many(self, responses):
+        for response in responses:
+            self._save_page(response)
+        self.flush_if_needed()
 
     def links_extracted(self, request, links):
-        for link in links:
-            if link.meta[b'fingerprint'] not in self.cache:
-                self.cache[link.meta[b'fingerprint']] = self.session.merge(self._create_page(link))
-        self.session.commit()
+        self.links_extracted_many([(request, links)])
+
+    def links_extracted_many(self, batch):
+        for _, links in batch:
+            for link in links:
+                fingerprint = link.meta[b'fingerprint']
+                if fingerprint not in self._pending and fingerprint not in self.cache:
+                    self._save_page(link)
+        self.flush_if_needed()
 
-    def _modify_page(self, obj):
-        db_page = self.cache[obj.meta[b'fingerprint']]
+    def _modify_page(self, db_page, obj):
+        """
+        :return: list of keys of changed columns
+        """
         db_page.fetched_at = datetime.utcnow()
         if isinstance(obj, Response):
-            db_page.headers = obj.request.headers
             db_page.method = to_native_str(obj.request.method)
-            db_page.cookies = obj.request.cookies
             db_page.status_code = obj.status_code
-        return db_page
+            if self._payload:
+                db_page.payload = encode_payload(obj.request)
+                return ['fetched_at', 'payload', 'method', 'status_code']
+            db_page.headers = obj.request.headers
+            db_page.cookies = obj.request.cookies
+            return ['fetched_at', 'headers', 'method', 'cookies', 'status_code']
+        return ['fetched_at']
 
     def _create_page(self, obj):
         db_page = self.model()
         db_page.fingerprint = to_native_str(obj.meta[b'fingerprint'])
         db_page.url = obj.url
         db_page.created_at = datetime.utcnow()
-        db_page.meta = obj.meta
         db_page.depth = 0
-
-        if isinstance(obj, Request):
-            db_page.headers = obj.headers
-            db_page.method = to_native_str(obj.method)
-            db_page.cookies = obj.cookies
-        elif isinstance(obj, Response):
-            db_page.headers = obj.request.headers
-            db_page.method = to_native_str(obj.request.method)
-            db_page.cookies = obj.request.cookies
+        request = obj.request if isinstance(obj, Response) else obj
+        if isinstance(obj, Response):
             db_page.status_code = obj.status_code
+        db_page.method = to_native_str(request.method)
+        if self._payload:
+            db_page.payload = encode_payload(Request(obj.url, method=request.method, headers=request.headers,
+                                                     cookies=request.cookies, meta=obj.meta))
+            return db_page
+        db_page.meta = obj.meta
+        db_page.headers = request.headers
+        db_page.cookies = request.cookies
         return db_page
 
     @retry_and_rollback
     def update_score(self, batch):
+        updates = []
         for fprint, score, request, schedule in batch:
-            m = self.model(fingerprint=to_native_str(fprint), score=score)
-            self.session.merge(m)
+            pending = self._pending.get(fprint)
+            if pending:
+                pending[0].score = score
+                pending[1].add('score')
+                continue
+            if fprint in self.cache:
+                self.cache[fprint].score = score
+            updates.append({'_fingerprint': to_native_str(fprint), '_score': score})
+        if not updates:
+            return
+        # written rows were created on add_seeds and links_extracted, so updating in bulk without loading them
+        table = self.model.__table__
+        stmt = table.update().where(table.c.fingerprint == bindparam('_fingerprint')).values(score=bindparam('_score'))
+        for chunk in chunks(updates, 1000):
+            self.session.execute(stmt, chunk)
         self.session.commit()
 
 
@@ -116,6 +256,8 @@ class States(MemoryStates):
         self.session = session_cls()
         self.model = model_cls
         self.table = DeclarativeBase.metadata.tables['states']
+        self._upsert = upsert_statement(self.session, self.model.__table__, ['fingerprint'], ['state'])
+        self._storage_lock = Lock()
         self.logger = logging.getLogger("sqlalchemy.states")
 
     @retry_and_rollback
@@ -123,24 +265,44 @@ class States(MemoryStates):
         self.flush()
         self.session.close()
 
-    @retry_and_rollback
     def fetch(self, fingerprints):
-        to_fetch = [to_native_str(f) for f in fingerprints if f not in self._cache]
+        to_fetch = self.missing(fingerprints)
         self.logger.debug("cache size %s", len(self._cache))
         self.logger.debug("to fetch %d from %d", len(to_fetch), len(fingerprints))
+        self.load(self.read(to_fetch))
 
-        for chunk in chunks(to_fetch, 128):
-            for state in self.session.query(self.model).filter(self.model.fingerprint.in_(chunk)):
-                self._cache[to_bytes(state.fingerprint)] = state.state
+    def read(self, fingerprints):
+        # the session is shared with the prefetching thread, so rollbacks must happen under the lock too
+        with self._storage_lock:
+            return self._read(fingerprints)
 
     @retry_and_rollback
-    def flush(self, force_clear=False):
-        for fingerprint, state_val in six.iteritems(self._cache):
-            state = self.model(fingerprint=to_native_str(fingerprint), state=state_val)
-            self.session.merge(state)
+    def _read(self, fingerprints):
+        result = []
+        for chunk in chunks([to_native_str(f) for f in fingerprints], 128):
+            states = self.session.query(self.model).filter(self.model.fingerprint.in_(chunk))
+            result.extend((to_bytes(state.fingerprint), state.state) for state in states)
+        return result
+
+    def _persist(self, items):
+        with self._storage_lock:
+            self._write(items)
+
+    @retry_and_rollback
+    def _write(self, items):
+        if self._upsert is not None:
+            for chunk in chunks(items, 1000):
+                self.session.execute(self._upsert, [{'fingerprint': to_native_str(fingerprint), 'state': state}
+                                                    for fingerprint, state in chunk])
+        else:
+            for fingerprint, state_val in items:
+                state = self.model(fingerprint=to_native_str(fingerprint), state=state_val)
+                self.session.merge(state)
         self.session.commit()
-        self.logger.debug("State cache has been flushed.")
+
+    def flush(self, force_clear=False):
         super(States, self).flush(force_clear)
+        self.logger.debug("State cache has been flushed.")
 
 
 class Queue(BaseQueue):
@@ -150,18 +312,72 @@ class Queue(BaseQueue):
         self.logger = logging.getLogger("sqlalchemy.queue")
         self.partitioner = partitioner
         self.ordering = ordering
+        self._server_version = None
+        # meta, headers and cookies are kept in one column, see payload module
+        self._payload = hasattr(queue_cls, 'payload')
 
     def frontier_stop(self):
         self.session.close()
 
-    def _order_by(self, query):
+    def _ordering(self, columns=None):
+        columns = self.queue_model if columns is None else columns
         if self.ordering == 'created':
-            return query.order_by(self.queue_model.created_at)
+            return [columns.created_at]
         if self.ordering == 'created_desc':
-            return query.order_by(self.queue_model.created_at.desc())
-        return query.order_by(self.queue_model.score, self.queue_model.created_at)  # TODO: remove second parameter,
+            return [columns.created_at.desc()]
+        return [columns.score, columns.created_at]  # TODO: remove second parameter,
         # it's not necessary for proper crawling, but needed for tests
 
+    def _order_by(self, query):
+        return query.order_by(*self._ordering())
+
+    def _dialect(self):
+        """
+        :return: tuple of dialect name and server version, the version is known only after connecting. MariaDB is
+            reported as ``mariadb``, its versions aren't comparable with MySQL ones.
+        """
+        if self._server_version is None:
+            self._server_version = self.session.connection().dialect.server_version_info or ()
+        dialect = self.session.get_bind().dialect
+        name = 'mariadb' if getattr(dialect, '_is_mariadb', False) else dialect.name
+        return name, self._server_version
+
+    def _lock(self, query):
+        """
+        Locks selected rows till commit, skipping rows locked by other workers, where it's supported. This way
+        several DB workers can dequeue from the same table.
+        """
+        name, version = self._dialect()
+        if name == 'postgresql' and version >= (9, 5) or name == 'mysql' and version >= (8, ) or \
+                name == 'mariadb' and version >= (10, 6):
+            return query.with_for_update(skip_locked=True, of=self.queue_model)
+        return query
+
+    def _select(self):
+        model = self.queue_model
+        columns = [model.payload] if self._payload else [model.meta, model.headers, model.cookies]
+        return self.session.query(model.id, model.url, model.method, model.fingerprint, model.score,
+                                  model.host_crc32, *columns)
+
+    def _dequeue(self, rows):
+        """
+        Deletes selected rows at once and creates requests from them. Payloads are decoded only for these rows.
+        """
+        model = self.queue_model
+        for chunk in chunks([row.id for row in rows], 500):
+            self.session.query(model).filter(model.id.in_(chunk)).delete(synchronize_session=False)
+        results = []
+        for row in rows:
+            if self._payload:
+                r = decode_payload(row.payload)
+            else:
+                method = row.method or b'GET'
+                r = Request(row.url, method=method, meta=row.meta, headers=row.headers, cookies=row.cookies)
+            r.meta[b'fingerprint'] = to_bytes(row.fingerprint)
+            r.meta[b'score'] = row.score
+            results.append(r)
+        return results
+
     def get_next_requests(self, max_n_requests, partition_id, **kwargs):
         """
         Dequeues new batch of requests for crawling.
@@ -172,14 +388,8 @@ class Queue(BaseQueue):
         """
         results = []
         try:
-            for item in self._order_by(self.session.query(self.queue_model).filter_by(partition_id=partition_id)).\
-                    limit(max_n_requests):
-                method = item.method or b'GET'
-                r = Request(item.url, method=method, meta=item.meta, headers=item.headers, cookies=item.cookies)
-                r.meta[b'fingerprint'] = to_bytes(item.fingerprint)
-                r.meta[b'score'] = item.score
-                results.append(r)
-                self.session.delete(item)
+            query = self._order_by(self._select().filter(self.queue_model.partition_id == partition_id))
+            results = self._dequeue(self._lock(query.limit(max_n_requests)).all())
             self.session.commit()
         except Exception as exc:
             self.logger.exception(exc)
@@ -199,9 +409,11 @@ class Queue(BaseQueue):
                 else:
                     partition_id = self.partitioner.partition(key)
                     host_crc32 = get_crc32(key)
-                q = self.queue_model(fingerprint=to_native_str(fprint), score=score, url=request.url, meta=request.meta,
-                                     headers=request.headers, cookies=request.cookies, method=to_native_str(request.method),
-                                     partition_id=partition_id, host_crc32=host_crc32, created_at=time()*1E+6)
+                payload = {'payload': encode_payload(request)} if self._payload else \
+                    {'meta': request.meta, 'headers': request.headers, 'cookies': request.cookies}
+                q = self.queue_model(fingerprint=to_native_str(fprint), score=score, url=request.url,
+                                     method=to_native_str(request.method), partition_id=partition_id,
+                                     host_crc32=host_crc32, created_at=time()*1E+6, **payload)
                 to_save.append(q)
                 request.meta[b'state'] = States.QUEUED
         self.session.bulk_save_objects(to_save)
@@ -215,6 +427,7 @@ class Queue(BaseQueue):
 class BroadCrawlingQueue(Queue):
 
     GET_RETRIES = 3
+    RANKING_WINDOW = 10
 
     @retry_and_rollback
     def get_next_requests(self, max_n_requests, partition_id, **kwargs):
@@ -226,6 +439,12 @@ class BroadCrawlingQueue(Queue):
          - max_n_requests
          - min_hosts & min_requests
 
+        Where window functions are supported (SQLite 3.25+, PostgreSQL, MySQL 8, MariaDB 10.2+), requests are ranked
+        per host in one query. Only max_n_requests * RANKING_WINDOW requests from the head of the partition are
+        ranked, min_hosts & min_requests are met, if these have enough hosts and requests.
+        Otherwise queue is scanned with growing limit, till these are met or GET_RETRIES is reached. min_requests
+        above max_n_requests is lowered to it.
+
         :param max_n_requests:
         :param partition_id:
         :param kwargs: min_requests, min_hosts, max_requests_per_host
@@ -234,8 +453,39 @@ class BroadCrawlingQueue(Queue):
         min_requests = kwargs.pop("min_requests", None)
         min_hosts = kwargs.pop("min_hosts", None)
         max_requests_per_host = kwargs.pop("max_requests_per_host", None)
-        assert(max_n_requests > min_requests)
+        if min_requests is not None:
+            min_requests = min(min_requests, max_n_requests)
+
+        if max_requests_per_host is None:
+            query = self._order_by(self._select().filter(self.queue_model.partition_id == partition_id))
+            rows = self._lock(query.limit(max_n_requests)).all()
+        elif self._supports_window_functions():
+            rows = self._select_ranked(max_n_requests, partition_id, max_requests_per_host)
+        else:
+            rows = self._select_scanning(max_n_requests, partition_id, min_requests, min_hosts,
+                                         max_requests_per_host)
+        results = self._dequeue(rows)
+        self.session.commit()
+        return results
 
+    def _supports_window_functions(self):
+        name, version = self._dialect()
+        return name == 'postgresql' or name == 'sqlite' and version >= (3, 25) or \
+            name == 'mysql' and version >= (8, ) or name == 'mariadb' and version >= (10, 2)
+
+    def _select_ranked(self, max_n_requests, partition_id, max_requests_per_host):
+        model = self.queue_model
+        # only the head of the queue can be dequeued, so ranking is limited to it instead of the whole partition
+        candidates = self._order_by(self.session.query(model.id, model.host_crc32, model.score, model.created_at)
+                                    .filter(model.partition_id == partition_id)) \
+            .limit(max_n_requests * self.RANKING_WINDOW).subquery()
+        rank = func.row_number().over(partition_by=candidates.c.host_crc32,
+                                      order_by=self._ordering(candidates.c)).label('rank')
+        ranked = self.session.query(candidates.c.id.label('id'), rank).subquery()
+        query = self._select().join(ranked, ranked.c.id == model.id).filter(ranked.c.rank <= max_requests_per_host)
+        return self._lock(self._order_by(query).limit(max_n_requests)).all()
+
+    def _select_scanning(self, max_n_requests, partition_id, min_requests, min_hosts, max_requests_per_host):
         queue = {}
         limit = max_n_requests
         tries = 0
@@ -247,15 +497,15 @@ class BroadCrawlingQueue(Queue):
                               tries, limit, count, len(queue.keys()))
             queue.clear()
             count = 0
-            for item in self._order_by(self.session.query(self.queue_model).filter_by(partition_id=partition_id)).\
-                    limit(limit):
-                if item.host_crc32 not in queue:
-                    queue[item.host_crc32] = []
-                if max_requests_per_host is not None and len(queue[item.host_crc32]) > max_requests_per_host:
+            query = self._order_by(self._select().filter(self.queue_model.partition_id == partition_id))
+            for row in query.limit(int(limit)):
+                if row.host_crc32 not in queue:
+                    queue[row.host_crc32] = []
+                if len(queue[row.host_crc32]) >= max_requests_per_host:
                     continue
-                queue[item.host_crc32].append(item)
+                queue[row.host_crc32].append(row)
                 count += 1
-                if count > max_n_requests:
+                if count >= max_n_requests:
                     break
             if min_hosts is not None and len(queue.keys()) < min_hosts:
                 continue
@@ -263,13 +513,4 @@ class BroadCrawlingQueue(Queue):
                 continue
             break
         self.logger.debug("Finished: tries %d, hosts %d, requests %d", tries, len(queue.keys()), count)
-
-        results = []
-        for items in six.itervalues(queue):
-            for item in items:
-                method = item.method or b'GET'
-                results.append(Request(item.url, method=method,
-                                       meta=item.meta, headers=item.headers, cookies=item.cookies))
-                self.session.delete(item)
-        self.session.commit()
-        return results
+        return [row for rows in six.itervalues(queue) for row in rows]
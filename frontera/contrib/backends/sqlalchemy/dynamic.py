@@ -8,12 +8,7 @@ from frontera.contrib.backends.sqlalchemy.models import QueueModelMixin, Declara
 from frontera.core.components import Queue as BaseQueue, States, Partitioner
 from frontera.contrib.backends import BATCH_MODE_ALL_PARTITIONS
 
-from sqlalchemy import Column, Integer, BigInteger, func, and_
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql.expression import between, text
-from sqlalchemy.orm import with_expression, query_expression
-from sqlalchemy.sql.functions import Function
-from sqlalchemy.dialects.postgresql import array
+from sqlalchemy import Column, Integer, BigInteger, Index, func, and_, case
 
 
 def utcnow_timestamp():
@@ -43,74 +38,94 @@ class DynamicPartitioner(Partitioner):
 
 class DynamicQueueModel(QueueModelMixin, DeclarativeBase):
     __tablename__ = 'dynamic_queue'
+    __table_args__ = (
+        Index('ix_dynamic_queue_partition_score', 'partition_id', 'score', 'crawl_at'),
+        Index('ix_dynamic_queue_partition_host', 'partition_id', 'host_crc32'),
+    ) + QueueModelMixin.__table_args__
 
     crawl_at = Column(BigInteger, nullable=False)
-    netloc = query_expression()
-    partition_id = query_expression()
     partition_seed = Column(Integer, nullable=False)
 
 
 class DynamicQueue(RevisitingQueue):
+    """
+    Queue, which partition is computed as partition seed modulo partitions count. Partition and host CRC32 are
+    stored in indexed columns on scheduling, and rows are repartitioned in bulk, if partitions count is changed.
+    Works with any database supporting window functions, including SQLite 3.25+.
+    """
 
     batch_mode = BATCH_MODE_ALL_PARTITIONS
 
-    def __init__(self, score_window=1000, max_request_per_host=60, *args):
-        super(DynamicQueue, self).__init__(*args)
+    def __init__(self, session_cls, queue_cls, partitioner, dequeued_delay, score_window=1000,
+                 max_request_per_host=60):
+        super(DynamicQueue, self).__init__(session_cls, queue_cls, partitioner, dequeued_delay)
         self.score_window = score_window
         self.max_request_per_host = max_request_per_host
-
-    def query_next_requests(self, max_n_requests, partitions):
+        self._partitions_count = None
+
+    def _repartition(self, partitions_count):
+        if self._partitions_count == partitions_count:
+            return
+        model = self.queue_model
+        partition = model.partition_seed % partitions_count
+        self.session.query(model).filter(model.partition_id != partition).\
+            update({model.partition_id: partition}, synchronize_session=False)
+        self.session.commit()
+        self._partitions_count = partitions_count
+
+    def query_next_requests(self, max_n_requests, partitions, quotas=None, **kwargs):
         partitions_count = len(self.partitioner.partitions)
+        self._repartition(partitions_count)
         score_window = partitions_count * self.score_window
-        partition = DynamicQueueModel.partition_seed % partitions_count
-        netloc = text("(regexp_matches(url, '^(?:://)?([^/]+)'))[1]")
+        model = self.queue_model
 
-        score_query = self.session.query(
-            self.queue_model,
-            func.row_number().over(
-                order_by=[
-                    self.queue_model.score.desc(),
-                    self.queue_model.crawl_at
-                ]).label('score_rank')
-        ).\
-            filter(and_(self.queue_model.crawl_at <= utcnow_timestamp(),
-                        partition.in_(partitions))).\
+        # index-driven top of the queue, windows below are computed only for these rows
+        top_query = self.session.query(model.id, model.partition_id, model.host_crc32, model.score, model.crawl_at).\
+            filter(and_(model.crawl_at <= utcnow_timestamp(),
+                        model.partition_id.in_(partitions))).\
+            order_by(model.score.desc(), model.crawl_at).\
             limit(score_window).\
             subquery()
 
-        netloc_query = self.session.query(
-            self.queue_model,
-            score_query.c.score_rank,
+        order = [top_query.c.score.desc(), top_query.c.crawl_at]
+        host_query = self.session.query(
+            top_query.c.id,
+            top_query.c.partition_id,
+            func.row_number().over(order_by=order).label('score_rank'),
             func.row_number().over(
                 partition_by=[
-                    partition,
-                    netloc
+                    top_query.c.partition_id,
+                    top_query.c.host_crc32
                 ],
-                order_by=score_query.c.score_rank
-            ).label('netloc_rank')
+                order_by=order
+            ).label('host_rank')
         ).\
-            select_entity_from(score_query).\
             subquery()
 
         partition_query = self.session.query(
-            self.queue_model,
+            host_query.c.id,
+            host_query.c.partition_id,
             func.row_number().over(
-                partition_by=partition,
-                order_by=netloc_query.c.score_rank
+                partition_by=host_query.c.partition_id,
+                order_by=host_query.c.score_rank
             ).label('partition_rank')
         ).\
-            select_entity_from(netloc_query).\
-            filter(netloc_query.c.netloc_rank <= self.max_request_per_host).\
+            filter(host_query.c.host_rank <= self.max_request_per_host).\
             subquery()
 
-        return self.session.query(self.queue_model).\
-            select_entity_from(partition_query).\
-            options(with_expression(self.queue_model.partition_id, partition)).\
-            filter(partition_query.c.partition_rank <= max_n_requests)
+        limit = max_n_requests
+        if quotas:
+            limit = case([(partition_query.c.partition_id == partition_id, quota)
+                          for partition_id, quota in quotas.items()], else_=max_n_requests)
+
+        return self.session.query(model).\
+            join(partition_query, partition_query.c.id == model.id).\
+            filter(partition_query.c.partition_rank <= limit)
 
     def request_data(self, *args):
         data = super(DynamicQueue, self).request_data(*args)
-        data['partition_seed'] = data.pop('partition_id')
+        data['partition_seed'] = data['partition_id']
+        data['partition_id'] = data['partition_seed'] % len(self.partitioner.partitions)
         return data
 
 
@@ -5,6 +5,31 @@ from sqlalchemy.ext.declarative import declarative_base
 
 DeclarativeBase = declarative_base()
 
+_payload_codec = None
+
+
+def _codec():
+    global _payload_codec
+    if _payload_codec is None:
+        from frontera.contrib.backends.remote.codecs.msgpack import Encoder, Decoder
+        from frontera.core.models import Request, Response
+        _payload_codec = Encoder(Request), Decoder(Request, Response)
+    return _payload_codec
+
+
+def encode_payload(request):
+    """
+    Serializes request with msgpack codec of the message bus, for payload columns of models in payload module.
+    """
+    return _codec()[0].encode_request(request)
+
+
+def decode_payload(payload):
+    """
+    :return: :class:`Request <frontera.core.models.Request>` with url, method, headers, cookies and meta
+    """
+    return _codec()[1].decode_request(payload)
+
 
 class MetadataModel(DeclarativeBase):
     __tablename__ = 'metadata'
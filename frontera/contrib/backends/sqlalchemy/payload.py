@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Models keeping meta, headers and cookies of a request in one msgpack payload column, instead of three pickled ones.
+Payloads are serialized with the msgpack codec of the message bus, so msgpack is required. To use them, set in
+SQLALCHEMYBACKEND_MODELS::
+
+    'MetadataModel': 'frontera.contrib.backends.sqlalchemy.payload.PayloadMetadataModel',
+    'QueueModel': 'frontera.contrib.backends.sqlalchemy.payload.PayloadQueueModel',
+
+Rows of existing tables can be converted with :func:`migrate`.
+"""
+from __future__ import absolute_import
+from sqlalchemy import Column, String, Integer, SmallInteger, Float, DateTime, BigInteger, LargeBinary
+from sqlalchemy.orm import sessionmaker
+
+from frontera.contrib.backends.sqlalchemy.models import DeclarativeBase, encode_payload
+from frontera.core.models import Request
+
+
+class PayloadMetadataModel(DeclarativeBase):
+    __tablename__ = 'payload_metadata'
+    __table_args__ = (
+        {
+            'mysql_charset': 'utf8',
+            'mysql_engine': 'InnoDB',
+            'mysql_row_format': 'DYNAMIC',
+        },
+    )
+
+    fingerprint = Column(String(40), primary_key=True, nullable=False)
+    url = Column(String(1024), nullable=False)
+    depth = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    fetched_at = Column(DateTime, nullable=True)
+    status_code = Column(String(20))
+    score = Column(Float)
+    error = Column(String(128))
+    method = Column(String(6))
+    payload = Column(LargeBinary)
+
+    @classmethod
+    def query(cls, session):
+        return session.query(cls)
+
+    def __repr__(self):
+        return '<Metadata:%s (%s)>' % (self.url, self.fingerprint)
+
+
+class PayloadQueueModel(DeclarativeBase):
+    __tablename__ = 'payload_queue'
+    __table_args__ = (
+        {
+            'mysql_charset': 'utf8',
+            'mysql_engine': 'InnoDB',
+            'mysql_row_format': 'DYNAMIC',
+        },
+    )
+
+    id = Column(Integer, primary_key=True)
+    partition_id = Column(Integer, index=True)
+    score = Column(Float, index=True)
+    url = Column(String(1024), nullable=False)
+    fingerprint = Column(String(40), nullable=False)
+    host_crc32 = Column(Integer, nullable=False)
+    payload = Column(LargeBinary)
+    method = Column(String(6))
+    created_at = Column(BigInteger, index=True)
+    depth = Column(SmallInteger)
+
+    @classmethod
+    def query(cls, session):
+        return session.query(cls)
+
+    def __repr__(self):
+        return '<Queue:%s (%d)>' % (self.url, self.id)
+
+
+def migrate(engine, source_model, target_model, chunk_size=1000):
+    """
+    Copies rows of a table with pickled meta, headers and cookies columns to a table with payload column. The target
+    table is created, if it doesn't exist. Source table is left as is.
+
+    :param engine: SQLAlchemy engine
+    :param source_model: f.e. :class:`MetadataModel <frontera.contrib.backends.sqlalchemy.models.MetadataModel>`
+    :param target_model: f.e. :class:`PayloadMetadataModel`
+    :param chunk_size: count of rows inserted at once
+    :return: count of copied rows
+    """
+    target_model.__table__.create(bind=engine, checkfirst=True)
+    columns = [column.key for column in target_model.__table__.columns if column.key != 'payload']
+    session = sessionmaker(bind=engine)()
+    insert = target_model.__table__.insert()
+    count = 0
+    rows = []
+    try:
+        for item in session.query(source_model).yield_per(chunk_size):
+            row = dict((column, getattr(item, column)) for column in columns)
+            row['payload'] = encode_payload(Request(item.url, method=getattr(item, 'method', None) or b'GET',
+                                                    headers=item.headers, cookies=item.cookies, meta=item.meta))
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                session.execute(insert, rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            session.execute(insert, rows)
+            count += len(rows)
+        session.commit()
+    finally:
+        session.close()
+    return count
@@ -6,16 +6,17 @@ from datetime import datetime, timedelta
 from time import time, sleep
 from calendar import timegm
 
-from sqlalchemy import Column, BigInteger
+from sqlalchemy import Column, BigInteger, bindparam
 
 from frontera import Request
 from frontera.contrib.backends.partitioners import Crc32NamePartitioner
 from frontera.contrib.backends.sqlalchemy import SQLAlchemyBackend
 from frontera.contrib.backends.sqlalchemy.models import QueueModelMixin, DeclarativeBase
 from frontera.core.components import Queue as BaseQueue, States
-from frontera.utils.misc import get_crc32
+from frontera.utils.misc import get_crc32, chunks
 from frontera.utils.url import parse_domain_from_url_fast
 from six.moves import range
+import six
 
 
 def utcnow_timestamp():
@@ -62,20 +63,20 @@ class RevisitingQueue(BaseQueue):
 
     def get_next_requests(self, max_n_requests, partition_id, **kwargs):
         results = []
-        to_save = []
+        to_update = []
         try:
-            for item in self.query_next_requests(max_n_requests, partition_id):
+            crawl_at = utcnow_timestamp() + self.dequeued_delay
+            for item in self.query_next_requests(max_n_requests, partition_id, **kwargs):
                 results.append(self.request_from_record(item))
-                item.crawl_at = utcnow_timestamp() + self.dequeued_delay
-                to_save.append(item)
-            self.session.bulk_save_objects(to_save)
+                to_update.append({'id': item.id, 'crawl_at': crawl_at})
+            self._update(to_update)
             self.session.commit()
         except Exception as exc:
             self.logger.exception(exc)
             self.session.rollback()
         return results
 
-    def query_next_requests(self, max_n_requests, partition_id):
+    def query_next_requests(self, max_n_requests, partition_id, **kwargs):
         return self.session.query(self.queue_model).\
             filter(RevisitingQueueModel.crawl_at <= utcnow_timestamp(),
                    RevisitingQueueModel.partition_id == partition_id).\
@@ -89,20 +90,40 @@ class RevisitingQueue(BaseQueue):
         return Request(item.url, method=method, meta=meta, headers=item.headers,
                        cookies=item.cookies)
 
+    def _update(self, rows):
+        """
+        Updates rows by id, executing one statement for every chunk of rows.
+
+        :param rows: list of dicts with id and the same set of columns to update
+        """
+        if not rows:
+            return
+        table = self.queue_model.__table__
+        columns = [column for column in rows[0] if column != 'id']
+        # bind parameters can't be named as updated columns
+        stmt = table.update().where(table.c.id == bindparam('_id')).\
+            values(dict((column, bindparam('_' + column, type_=table.c[column].type)) for column in columns))
+        for chunk in chunks(rows, 1000):
+            self.session.execute(stmt, [dict(('_' + column, value) for column, value in six.iteritems(row))
+                                        for row in chunk])
+
     @retry_and_rollback
     def schedule(self, batch):
         to_save = []
+        to_update = []
         for fprint, score, request, schedule in batch:
             if schedule:
                 data = self.request_data(fprint, score, request)
                 queue_id = request.meta.get(b'queue_id')
                 if queue_id:
-                    self.session.query(self.queue_model).filter_by(id=queue_id).update(data)
+                    data['id'] = queue_id
+                    to_update.append(data)
                 else:
                     q = self.queue_model(**data)
                     to_save.append(q)
                 request.meta[b'state'] = States.QUEUED
         self.session.bulk_save_objects(to_save)
+        self._update(to_update)
         self.session.commit()
 
     def request_data(self, fprint, score, request):
@@ -160,3 +181,10 @@ class Backend(SQLAlchemyBackend):
         self.states.set_states(response.request)
         self._schedule([response.request])
         self.states.update_cache(response.request)
+
+    def page_crawled_many(self, responses):
+        super(Backend, self).page_crawled_many(responses)
+        requests = [response.request for response in responses]
+        self.states.set_states(requests)
+        self._schedule(requests)
+        self.states.update_cache(requests)
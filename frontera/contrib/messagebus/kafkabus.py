@@ -2,7 +2,8 @@
 from __future__ import absolute_import
 
 from logging import getLogger
-from time import sleep
+from threading import Thread, Event, Lock
+from time import sleep, time
 
 import six
 from kafka import KafkaConsumer, KafkaProducer, TopicPartition
@@ -31,7 +32,6 @@ class Consumer(BaseStreamConsumer):
             bootstrap_servers=self._location,
             group_id=self._group,
             max_partition_fetch_bytes=10485760,
-            consumer_timeout_ms=100,
             client_id="%s-%s" % (self._topic, str(partition_id) if partition_id is not None else "all"),
             request_timeout_ms=120 * 1000,
         )
@@ -47,6 +47,10 @@ class Consumer(BaseStreamConsumer):
                 self._consumer._coordinator.ensure_active_group()
 
         self._consumer._update_fetch_positions(self._partition_ids)
+        self.fetch_stats = {}
+        # KafkaConsumer isn't thread-safe, and messages can be consumed in worker's thread pool, while client is
+        # polled from the reactor thread
+        self._lock = Lock()
         self._start_looping_call()
 
     def _start_looping_call(self, interval=60):
@@ -60,28 +64,51 @@ class Consumer(BaseStreamConsumer):
         self._poll_task.start(interval).addErrback(errback)
 
     def _poll_client(self):
-        self._consumer._client.poll()
+        # client is polled anyway if messages are being consumed at the moment, reactor isn't blocked waiting for it
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._consumer._client.poll()
+        finally:
+            self._lock.release()
 
     def get_messages(self, timeout=0.1, count=1):
+        """
+        Polls all assigned partitions, until count messages are fetched or timeout (in seconds) expires. Per-partition
+        statistics are kept in fetch_stats: total count of fetched messages and count fetched by the last call.
+        """
         result = []
-        while count > 0:
-            try:
-                m = next(self._consumer)
-                result.append(m.value)
-                count -= 1
-            except StopIteration:
-                break
+        fetched = {}
+        deadline = time() + timeout
+        with self._lock:
+            while count > 0:
+                timeout_ms = max(int((deadline - time()) * 1000), 0)
+                records = self._consumer.poll(timeout_ms=timeout_ms, max_records=count)
+                for tp, messages in six.iteritems(records):
+                    result.extend(m.value for m in messages)
+                    fetched[tp.partition] = fetched.get(tp.partition, 0) + len(messages)
+                    count -= len(messages)
+                if not timeout_ms:
+                    break
+        for partition_id, stats in six.iteritems(self.fetch_stats):
+            stats['last_fetched'] = 0
+        for partition_id, size in six.iteritems(fetched):
+            stats = self.fetch_stats.setdefault(partition_id, {'fetched': 0})
+            stats['fetched'] += size
+            stats['last_fetched'] = size
         return result
 
     def get_offset(self, partition_id):
         for tp in self._partition_ids:
             if tp.partition == partition_id:
-                return self._consumer.position(tp)
+                with self._lock:
+                    return self._consumer.position(tp)
         raise KeyError("Can't find partition %d", partition_id)
 
     def close(self):
         self._poll_task.stop()
-        self._consumer.commit()
+        with self._lock:
+            self._consumer.commit()
         # getting kafka client event loop running some more and execute commit
         tries = 3
         while tries:
@@ -136,6 +163,48 @@ class KeyedProducer(BaseStreamProducer):
         return self._partitioner(key)
 
 
+class LagTracker(object):
+    """
+    Refreshes spider feed lags in a background thread every interval (in seconds), so group coordinator and offset
+    requests aren't blocking the caller. The last snapshot is available in lags, updated is the time it was taken.
+    The first snapshot is taken synchronously by :meth:`start`, so lags aren't empty after starting.
+    """
+    def __init__(self, offset_fetcher, interval):
+        self._offset_fetcher = offset_fetcher
+        self._interval = interval
+        self._stopped = Event()
+        self.lags = {}
+        self.updated = None
+        self._thread = None
+
+    def start(self):
+        self._refresh()
+        self._thread = Thread(target=self._run, name="kafka-lag-tracker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _refresh(self):
+        try:
+            lags = self._offset_fetcher.get()
+        except Exception as exc:
+            logger.exception(exc)
+        else:
+            self.lags, self.updated = lags, time()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._refresh()
+
+    @property
+    def age(self):
+        return time() - self.updated if self.updated is not None else None
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
 class SpiderLogStream(BaseSpiderLogStream):
     def __init__(self, messagebus):
         self._location = messagebus.kafka_location
@@ -170,6 +239,9 @@ class SpiderFeedStream(BaseSpiderFeedStream):
         self._max_next_requests = messagebus.max_next_requests
         self._offset_fetcher = OffsetsFetcherAsync(bootstrap_servers=self._location, topic=self._topic,
                                                    group_id=self._general_group)
+        self._lag_refresh_interval = messagebus.lag_refresh_interval
+        # started on the first use, spiders are creating the stream only for consuming
+        self._lag_tracker = None
         self._codec = messagebus.codec
         self._partitioner = messagebus.spider_feed_partitioner
 
@@ -179,16 +251,38 @@ class SpiderFeedStream(BaseSpiderFeedStream):
         return c
 
     def available_partitions(self):
-        partitions = []
-        lags = self._offset_fetcher.get()
-        for partition, lag in six.iteritems(lags):
+        return list(self.partition_deficits())
+
+    def _get_lag_tracker(self):
+        if self._lag_tracker is None:
+            self._lag_tracker = LagTracker(self._offset_fetcher, self._lag_refresh_interval)
+            self._lag_tracker.start()
+        return self._lag_tracker
+
+    def partition_deficits(self):
+        deficits = {}
+        for partition, lag in six.iteritems(self._get_lag_tracker().lags):
             if lag < self._max_next_requests:
-                partitions.append(partition)
-        return partitions
+                deficits[partition] = min(self._max_next_requests - lag, self._max_next_requests)
+        return deficits
+
+    @property
+    def lag_stats(self):
+        if self._lag_tracker is None:
+            return {}
+        return {
+            'spider_feed_lag': dict(self._lag_tracker.lags),
+            'spider_feed_lag_age': self._lag_tracker.age
+        }
 
     def producer(self):
         return KeyedProducer(self._location, self._topic, self._partitioner, self._codec)
 
+    def close(self):
+        if self._lag_tracker is not None:
+            self._lag_tracker.stop()
+            self._lag_tracker = None
+
 
 class ScoringLogStream(BaseScoringLogStream):
     def __init__(self, messagebus):
@@ -216,6 +310,7 @@ class MessageBus(BaseMessageBus):
         self.spider_feed_group = settings.get('SPIDER_FEED_GROUP')
         self.spider_partition_id = settings.get('SPIDER_PARTITION_ID')
         self.max_next_requests = settings.MAX_NEXT_REQUESTS
+        self.lag_refresh_interval = settings.get('KAFKA_LAG_REFRESH_INTERVAL')
         self.codec = settings.get('KAFKA_CODEC')
         self.kafka_location = settings.get('KAFKA_LOCATION')
 
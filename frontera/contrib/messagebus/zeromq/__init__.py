@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from time import time, sleep
-from struct import pack, unpack
+from time import time
+from math import ceil
+from struct import pack, unpack, unpack_from
+from collections import deque
 from logging import getLogger
 
 import zmq
@@ -15,6 +17,21 @@ from frontera.utils.misc import load_object
 from six.moves import range
 
 
+def pack_envelope(messages):
+    return b''.join(pack(">I", len(msg)) + msg for msg in messages)
+
+
+def unpack_envelope(envelope, size):
+    messages = []
+    offset = 0
+    for _ in range(size):
+        length, = unpack_from(">I", envelope, offset)
+        offset += 4
+        messages.append(envelope[offset:offset + length])
+        offset += length
+    return messages
+
+
 class Consumer(BaseStreamConsumer):
     def __init__(self, context, location, partition_id, identity, seq_warnings=False, hwm=1000):
         self.subscriber = context.zeromq.socket(zmq.SUB)
@@ -23,40 +40,59 @@ class Consumer(BaseStreamConsumer):
 
         filter = identity + pack('>B', partition_id) if partition_id is not None else identity
         self.subscriber.setsockopt(zmq.SUBSCRIBE, filter)
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
         self.counters = {}
         self.count_global = partition_id is None
         self.logger = getLogger("distributed_frontera.messagebus.zeromq.Consumer(%s-%s)" % (identity, partition_id))
         self.seq_warnings = seq_warnings
+        self.pending = deque()
 
         self.stats = context.stats
         self.stat_key = "consumer-%s" % identity
         self.stats[self.stat_key] = 0
 
     def get_messages(self, timeout=0.1, count=1):
-        started = time()
-        sleep_time = timeout / 10.0
+        """
+        Drains up to count messages already received by the socket, blocking on the poller only when there are none,
+        until a new message arrives or timeout (in seconds) expires. Envelopes are unpacked transparently, messages
+        left over from an envelope are returned by the next call.
+        """
+        deadline = time() + timeout
         while count:
-            try:
-                msg = self.subscriber.recv_multipart(copy=True, flags=zmq.NOBLOCK)
-            except zmq.Again:
-                if time() - started > timeout:
-                    break
-                sleep(sleep_time)
-            else:
-                partition_seqno, global_seqno = unpack(">II", msg[2])
-                from_partition, = unpack(">B", msg[-1])
-                seqno = global_seqno if self.count_global else partition_seqno
-                if from_partition not in self.counters:
-                    self.counters[from_partition] = seqno
-                elif self.counters[from_partition] != seqno:
-                    if self.seq_warnings:
-                        self.logger.warning("Sequence counter mismatch from %d: expected %d, got %d. Check if system "
-                                            "isn't missing messages." % (from_partition, self.counters[from_partition], seqno))
-                    self.counters[from_partition] = seqno
-                yield msg[1]
-                count -= 1
-                self.counters[from_partition] += 1
-                self.stats[self.stat_key] += 1
+            if not self.pending:
+                try:
+                    msg = self.subscriber.recv_multipart(copy=True, flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    remaining = deadline - time()
+                    if remaining <= 0 or not self.poller.poll(ceil(remaining * 1000.0)):
+                        break
+                    continue
+                self._receive(msg)
+            from_partition, message = self.pending.popleft()
+            yield message
+            count -= 1
+            self.counters[from_partition] += 1
+            self.stats[self.stat_key] += 1
+
+    def _receive(self, msg):
+        if len(msg[2]) == 12:
+            partition_seqno, global_seqno, size = unpack(">III", msg[2])
+            messages = unpack_envelope(msg[1], size)
+        else:
+            partition_seqno, global_seqno = unpack(">II", msg[2])
+            messages = [msg[1]]
+        # scoring log messages have no partition frame
+        from_partition = unpack(">B", msg[3])[0] if len(msg) > 3 else 0
+        seqno = global_seqno if self.count_global else partition_seqno
+        if from_partition not in self.counters:
+            self.counters[from_partition] = seqno
+        elif self.counters[from_partition] != seqno:
+            if self.seq_warnings:
+                self.logger.warning("Sequence counter mismatch from %d: expected %d, got %d. Check if system "
+                                    "isn't missing messages." % (from_partition, self.counters[from_partition], seqno))
+            self.counters[from_partition] = seqno
+        self.pending.extend((from_partition, message) for message in messages)
 
     def get_offset(self, partition_id):
         if self.counters:
@@ -65,13 +101,23 @@ class Consumer(BaseStreamConsumer):
 
 
 class Producer(BaseStreamProducer):
-    def __init__(self, context, location, identity, partition=None):
+    """
+    Sends every message as a separate ZeroMQ message, or, if envelope_size is set, packs messages into envelopes
+    per partition. An envelope is sent when it has envelope_size messages, when its first message is older than
+    envelope_linger seconds (checked on every send and by :meth:`flush_expired`), on flush or close. Owners of
+    producers, which may go idle, have to call :meth:`flush_expired` periodically, sockets can't be used from a timer
+    thread.
+    """
+    def __init__(self, context, location, identity, partition=None, envelope_size=0, envelope_linger=0.1):
         self.spider_partition = partition
         self.identity = identity
         self.sender = context.zeromq.socket(zmq.PUB)
         self.sender.connect(location)
         self.counters = {}
         self.global_counter = 0
+        self.envelope_size = envelope_size
+        self.envelope_linger = envelope_linger
+        self.envelopes = {}
         self.stats = context.stats
         self.stat_key = "producer-%s" % identity
         self.stats[self.stat_key] = 0
@@ -85,22 +131,54 @@ class Producer(BaseStreamProducer):
         if any(not isinstance(m, six.binary_type) for m in messages):
             raise TypeError("all produce message payloads must be type bytes")
         partition = self.partition(key)
-        counter = self.counters.get(partition, 0)
+        if not self.envelope_size:
+            for msg in messages:
+                self._send(partition, [msg])
+            return
+
         for msg in messages:
-            self.sender.send_multipart([self.identity + pack(">B", partition), msg,
-                                        pack(">II", counter, self.global_counter),
-                                        pack(">B", self.spider_partition or 0)])
-            counter += 1
-            self.global_counter += 1
-            if counter == 4294967296:
-                counter = 0
-            if self.global_counter == 4294967296:
-                self.global_counter = 0
-            self.stats[self.stat_key] += 1
-        self.counters[partition] = counter
+            if partition not in self.envelopes:
+                self.envelopes[partition] = (time(), [])
+            envelope = self.envelopes[partition][1]
+            envelope.append(msg)
+            if len(envelope) >= self.envelope_size:
+                del self.envelopes[partition]
+                self._send(partition, envelope)
+        self.flush_expired()
+
+    def flush_expired(self):
+        """
+        Sends envelopes which first message is older than envelope_linger.
+        """
+        expired = time() - self.envelope_linger
+        for partition, (started, envelope) in list(self.envelopes.items()):
+            if started <= expired:
+                del self.envelopes[partition]
+                self._send(partition, envelope)
+
+    def _send(self, partition, messages):
+        counter = self.counters.get(partition, 0)
+        if len(messages) == 1:
+            self.sender.send_multipart(self._frames(partition, messages[0],
+                                                    pack(">II", counter, self.global_counter)))
+        else:
+            self.sender.send_multipart(self._frames(partition, pack_envelope(messages),
+                                                    pack(">III", counter, self.global_counter, len(messages))))
+        self.counters[partition] = (counter + len(messages)) % 4294967296
+        self.global_counter = (self.global_counter + len(messages)) % 4294967296
+        self.stats[self.stat_key] += len(messages)
+
+    def _frames(self, partition, msg, header):
+        return [self.identity + pack(">B", partition), msg, header, pack(">B", self.spider_partition or 0)]
 
     def flush(self):
-        pass
+        envelopes, self.envelopes = self.envelopes, {}
+        for partition, (started, envelope) in six.iteritems(envelopes):
+            self._send(partition, envelope)
+
+    def close(self):
+        self.flush()
+        self.sender.close()
 
     def get_offset(self, partition_id):
         return self.counters.get(partition_id, None)
@@ -110,8 +188,8 @@ class Producer(BaseStreamProducer):
 
 
 class SpiderLogProducer(Producer):
-    def __init__(self, context, location, partitioner, partition):
-        super(SpiderLogProducer, self).__init__(context, location, b'sl', partition)
+    def __init__(self, context, location, partitioner, partition, envelope_size, envelope_linger):
+        super(SpiderLogProducer, self).__init__(context, location, b'sl', partition, envelope_size, envelope_linger)
         self.partitioner = partitioner
 
 
@@ -123,9 +201,12 @@ class SpiderLogStream(BaseSpiderLogStream):
         self.out_location = messagebus.socket_config.spiders_out()
         self.partitioner = messagebus.spider_log_partitioner
         self.partition = messagebus.spider_partition
+        self.envelope_size = messagebus.envelope_size
+        self.envelope_linger = messagebus.envelope_linger
 
     def producer(self):
-        return SpiderLogProducer(self.context, self.out_location, self.partitioner, self.partition)
+        return SpiderLogProducer(self.context, self.out_location, self.partitioner, self.partition,
+                                 self.envelope_size, self.envelope_linger)
 
     def consumer(self, partition_id, type):
         location = self.sw_in_location if type == b'sw' else self.db_in_location
@@ -133,25 +214,15 @@ class SpiderLogStream(BaseSpiderLogStream):
 
 
 class UpdateScoreProducer(Producer):
-    def __init__(self, context, location):
-        super(UpdateScoreProducer, self).__init__(context, location, b'us')
+    def __init__(self, context, location, envelope_size, envelope_linger):
+        super(UpdateScoreProducer, self).__init__(context, location, b'us', envelope_size=envelope_size,
+                                                  envelope_linger=envelope_linger)
 
-    def send(self, key, *messages):
-        # Guarantee that msg is actually a list or tuple (should always be true)
-        if not isinstance(messages, (list, tuple)):
-            raise TypeError("msg is not a list or tuple!")
+    def _frames(self, partition, msg, header):
+        return [self.identity, msg, header]
 
-        # Raise TypeError if any message is not encoded as bytes
-        if any(not isinstance(m, six.binary_type) for m in messages):
-            raise TypeError("all produce message payloads must be type bytes")
-        counter = self.counters.get(0, 0)
-        for msg in messages:
-            self.sender.send_multipart([self.identity, msg, pack(">II", counter, counter)])
-            counter += 1
-            if counter == 4294967296:
-                counter = 0
-            self.stats[self.stat_key] += 1
-        self.counters[0] = counter
+    def partition(self, key):
+        return 0
 
 
 class ScoringLogStream(BaseScoringLogStream):
@@ -159,17 +230,20 @@ class ScoringLogStream(BaseScoringLogStream):
         self.context = messagebus.context
         self.in_location = messagebus.socket_config.sw_out()
         self.out_location = messagebus.socket_config.db_in()
+        self.envelope_size = messagebus.envelope_size
+        self.envelope_linger = messagebus.envelope_linger
 
     def consumer(self):
         return Consumer(self.context, self.out_location, None, b'us')
 
     def producer(self):
-        return UpdateScoreProducer(self.context, self.in_location)
+        return UpdateScoreProducer(self.context, self.in_location, self.envelope_size, self.envelope_linger)
 
 
 class SpiderFeedProducer(Producer):
-    def __init__(self, context, location, hwm, partitioner):
-        super(SpiderFeedProducer, self).__init__(context, location, b'sf')
+    def __init__(self, context, location, hwm, partitioner, envelope_size, envelope_linger):
+        super(SpiderFeedProducer, self).__init__(context, location, b'sf', envelope_size=envelope_size,
+                                                 envelope_linger=envelope_linger)
         self.partitioner = partitioner
         self.sender.set(zmq.SNDHWM, hwm)
 
@@ -186,6 +260,8 @@ class SpiderFeedStream(BaseSpiderFeedStream):
         self.consumer_hwm = messagebus.spider_feed_rcvhwm
         self.producer_hwm = messagebus.spider_feed_sndhwm
         self.max_next_requests = messagebus.max_next_requests
+        self.envelope_size = messagebus.envelope_size
+        self.envelope_linger = messagebus.envelope_linger
         self._producer = None
 
     def consumer(self, partition_id):
@@ -193,23 +269,26 @@ class SpiderFeedStream(BaseSpiderFeedStream):
 
     def producer(self):
         if not self._producer:
-            self._producer = SpiderFeedProducer(self.context, self.in_location,
-                                                self.producer_hwm, self.partitioner)
+            self._producer = SpiderFeedProducer(self.context, self.in_location, self.producer_hwm,
+                                                self.partitioner, self.envelope_size, self.envelope_linger)
         return self._producer
 
     def available_partitions(self):
+        return list(self.partition_deficits())
+
+    def partition_deficits(self):
         if not self._producer:
-            return []
+            return {}
 
-        partitions = []
+        deficits = {}
         for partition_id, last_offset in self.partitions_offset.items():
             producer_offset = self._producer.get_offset(partition_id)
             if producer_offset is None:
                 producer_offset = 0
-            lag = producer_offset - last_offset
-            if lag < self.max_next_requests or not last_offset:
-                partitions.append(partition_id)
-        return partitions
+            lag = producer_offset - last_offset if last_offset else 0
+            if lag < self.max_next_requests:
+                deficits[partition_id] = min(self.max_next_requests - lag, self.max_next_requests)
+        return deficits
 
     def set_spider_offset(self, partition_id, offset):
         self.partitions_offset[partition_id] = offset
@@ -244,6 +323,8 @@ class MessageBus(BaseMessageBus):
         self.spider_feed_sndhwm = int(settings.get('MAX_NEXT_REQUESTS') * len(self.spider_feed_partitions) * 1.2)
         self.spider_feed_rcvhwm = int(settings.get('MAX_NEXT_REQUESTS') * 2.0)
         self.max_next_requests = int(settings.get('MAX_NEXT_REQUESTS'))
+        self.envelope_size = int(settings.get('ZMQ_ENVELOPE_SIZE'))
+        self.envelope_linger = float(settings.get('ZMQ_ENVELOPE_LINGER'))
         if self.socket_config.is_ipv6:
             self.context.zeromq.setsockopt(zmq.IPV6, True)
 
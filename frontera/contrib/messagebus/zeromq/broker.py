@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
-from time import time
+from time import time, sleep
 from datetime import timedelta
 import logging
 from argparse import ArgumentParser
 from struct import unpack
+from threading import Thread
 
 import zmq
 from zmq.eventloop.ioloop import IOLoop
@@ -151,6 +152,125 @@ class Server(object):
         raise ValueError("Can't decode subscription correctly.")
 
 
+class ProxyServer(object):
+    """
+    Broker built on native ZeroMQ proxies, running one thread per channel. Messages and subscriptions are forwarded
+    by libzmq without Python code touching any frame: spider log and scoring log are published to in-process hubs,
+    which strategy and DB workers sides are subscribed to. Statistics are read from proxy counters through control
+    sockets (requires libzmq 4.3+). Proxies count frames, not messages, so unlike :class:`Server` frames and bytes
+    are reported.
+    """
+
+    # channel name, frontend socket attribute, backend socket attribute
+    channels = [
+        ('spiders_out', 'spiders_out', 'spider_log_hub'),
+        ('sw_out', 'sw_out', 'scoring_log_hub'),
+        ('sw_in', 'sw_in_sub', 'sw_in'),
+        ('db_in', 'db_in_sub', 'db_in'),
+        ('db_out', 'db_out', 'spiders_in'),
+    ]
+
+    def __init__(self, address, base_port):
+        if zmq.zmq_version_info() < (4, 3) or not hasattr(zmq, 'proxy_steerable'):
+            raise RuntimeError("Proxy broker requires libzmq 4.3 or newer for proxy statistics, found libzmq %s" %
+                               zmq.zmq_version())
+        self.ctx = zmq.Context()
+        self.stats = {'started': time()}
+        self.threads = []
+        self.controls = {}
+
+        socket_config = SocketConfig(address, base_port)
+
+        if socket_config.is_ipv6:
+            self.ctx.setsockopt(zmq.IPV6, True)
+
+        self.spiders_in = self.ctx.socket(zmq.XPUB)
+        self.spiders_out = self.ctx.socket(zmq.XSUB)
+        self.sw_in = self.ctx.socket(zmq.XPUB)
+        self.sw_out = self.ctx.socket(zmq.XSUB)
+        self.db_in = self.ctx.socket(zmq.XPUB)
+        self.db_out = self.ctx.socket(zmq.XSUB)
+
+        self.spiders_in.set(zmq.SNDHWM, 1000)
+        self.db_in.set(zmq.SNDHWM, 1000)
+
+        self.spiders_out.set(zmq.RCVHWM, 1000)
+        self.db_out.set(zmq.RCVHWM, 1000)
+
+        self.spiders_in.bind(socket_config.spiders_in())
+        self.spiders_out.bind(socket_config.spiders_out())
+        self.sw_in.bind(socket_config.sw_in())
+        self.sw_out.bind(socket_config.sw_out())
+        self.db_in.bind(socket_config.db_in())
+        self.db_out.bind(socket_config.db_out())
+
+        # spider log goes to both strategy and DB workers, DB workers also receive the scoring log
+        prefix = 'inproc://broker-%d' % id(self)
+        self.spider_log_hub = self.ctx.socket(zmq.XPUB)
+        self.spider_log_hub.bind(prefix + '-spider-log')
+        self.scoring_log_hub = self.ctx.socket(zmq.XPUB)
+        self.scoring_log_hub.bind(prefix + '-scoring-log')
+        self.sw_in_sub = self.ctx.socket(zmq.XSUB)
+        self.sw_in_sub.connect(prefix + '-spider-log')
+        self.db_in_sub = self.ctx.socket(zmq.XSUB)
+        self.db_in_sub.connect(prefix + '-spider-log')
+        self.db_in_sub.connect(prefix + '-scoring-log')
+
+        for name, frontend, backend in self.channels:
+            control = self.ctx.socket(zmq.PAIR)
+            control.bind('%s-control-%s' % (prefix, name))
+            controller = self.ctx.socket(zmq.PAIR)
+            controller.connect('%s-control-%s' % (prefix, name))
+            self.controls[name] = controller
+            thread = Thread(target=zmq.proxy_steerable, name='broker-%s' % name,
+                            args=(getattr(self, frontend), getattr(self, backend), None, control))
+            thread.daemon = True
+            self.threads.append(thread)
+
+        logging.basicConfig(format="%(asctime)s %(message)s",
+                            datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+        self.logger = logging.getLogger("distributed_frontera.messagebus"
+                                        ".zeromq.broker.ProxyServer")
+        self.logger.info("Using socket: {}:{}".format(socket_config.ip_addr,
+                                                      socket_config.base_port))
+
+    def start(self):
+        self.start_proxies()
+        self.logger.info("Distributed Frontera ZeroMQ broker is started.")
+        try:
+            while True:
+                self.log_stats()
+                sleep(10)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def start_proxies(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for controller in self.controls.values():
+            controller.send(b'TERMINATE')
+        for thread in self.threads:
+            thread.join()
+
+    def update_stats(self):
+        """
+        Frames and bytes received by frontend of every channel, it's where messages are entering the channel. Every
+        message has several frames, their number depends on the envelope.
+        """
+        for name, controller in self.controls.items():
+            controller.send(b'STATISTICS')
+            counters = [unpack("=Q", frame)[0] for frame in controller.recv_multipart()]
+            self.stats['%s_frames' % name] = counters[0]
+            self.stats['%s_bytes' % name] = counters[1]
+
+    def log_stats(self):
+        self.update_stats()
+        self.logger.info(self.stats)
+
+
 def main():
     """
     Parse arguments, set configuration values, then start the broker
@@ -171,12 +291,16 @@ def main():
         '--port', type=int,
         help='Base port number, server will bind to 6 ports starting from base'
         '. Default is 5550')
+    parser.add_argument(
+        '--proxy', action='store_true',
+        help='Forward messages using native ZeroMQ proxies, one thread per '
+        'channel. Requires libzmq 4.3 or newer.')
     args = parser.parse_args()
 
     settings = Settings(module=args.config)
     address = args.address if args.address else settings.get("ZMQ_ADDRESS")
     port = args.port if args.port else settings.get("ZMQ_BASE_PORT")
-    server = Server(address, port)
+    server = ProxyServer(address, port) if args.proxy else Server(address, port)
     server.logger.setLevel(args.log_level)
     server.start()
 
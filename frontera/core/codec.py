@@ -86,6 +86,26 @@ class BaseEncoder(object):
         """
         pass
 
+    def update_request_meta(self, buffer, meta):
+        """
+        Updates meta of already encoded request. Default implementation decodes the request with the Decoder class
+        of the same codec module, updates meta and encodes it again. Codecs should override it with a faster one,
+        not constructing Request object.
+
+        :param bytes buffer: request encoded by :meth:`encode_request`
+        :param dict meta: meta keys and values to set
+        :return: bytes encoded message
+        """
+        decoder = getattr(self, '_meta_decoder', None)
+        if decoder is None:
+            from frontera.core.models import Request, Response
+            from frontera.utils.misc import load_object
+            decoder_cls = load_object(type(self).__module__ + '.Decoder')
+            decoder = self._meta_decoder = decoder_cls(Request, Response)
+        request = decoder.decode_request(buffer)
+        request.meta.update(meta)
+        return self.encode_request(request)
+
     @abstractmethod
     def encode_update_score(self, request, score, schedule):
         """
@@ -60,6 +60,35 @@ class Metadata(StartStopMixin):
         """
         pass
 
+    def page_crawled_many(self, responses):
+        """
+        Batch version of :meth:`page_crawled`, used by DB worker to process all crawled pages from the spider log
+        batch at once. Default implementation calls :meth:`page_crawled` for every response.
+
+        :param list responses: A list of :class:`Response <frontera.core.models.Response>` objects.
+        """
+        for response in responses:
+            self.page_crawled(response)
+
+    def links_extracted_many(self, batch):
+        """
+        Batch version of :meth:`links_extracted`. Default implementation calls :meth:`links_extracted` for every
+        item.
+
+        :param list batch: A list of tuples (request, links).
+        """
+        for request, links in batch:
+            self.links_extracted(request, links)
+
+    def request_error_many(self, batch):
+        """
+        Batch version of :meth:`request_error`. Default implementation calls :meth:`request_error` for every item.
+
+        :param list batch: A list of tuples (request, error).
+        """
+        for request, error in batch:
+            self.request_error(request, error)
+
 
 @six.add_metaclass(ABCMeta)
 class Queue(StartStopMixin):
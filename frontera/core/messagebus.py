@@ -165,6 +165,14 @@ class BaseSpiderFeedStream(object):
         """
         raise NotImplementedError
 
+    def partition_deficits(self):
+        """
+        Returns the count of requests each available partition can take, that is maximum allowed lag minus the
+        current one. Used to size new batches proportionally to how much of the partition is already consumed.
+        :return: dict of partition id to int, or None if deficit is unknown
+        """
+        return dict((partition_id, None) for partition_id in self.available_partitions())
+
     def set_spider_offset(self, partition_id, offset):
         """
         Set the message processed offset for a given partition. Used to
@@ -176,6 +184,13 @@ class BaseSpiderFeedStream(object):
         """
         pass
 
+    def close(self):
+        """
+        Releases resources held by the stream, f.e. background threads. Called when DB worker is stopping.
+        :return: nothing
+        """
+        pass
+
 
 @six.add_metaclass(ABCMeta)
 class BaseMessageBus(object):
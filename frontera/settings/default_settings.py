@@ -20,6 +20,8 @@ HBASE_USE_SNAPPY = False
 HBASE_USE_FRAMED_COMPACT = False
 HBASE_BATCH_SIZE = 9216
 HBASE_STATE_CACHE_SIZE_LIMIT = 3000000
+HBASE_STATE_FILTER_CAPACITY = 0
+HBASE_STATE_FILTER_ERROR_RATE = 0.001
 HBASE_QUEUE_TABLE = 'queue'
 KAFKA_GET_TIMEOUT = 5.0
 MAX_NEXT_REQUESTS = 64
@@ -38,6 +40,7 @@ REQUEST_MODEL = 'frontera.core.models.Request'
 RESPONSE_MODEL = 'frontera.core.models.Response'
 
 
+SCORE_MERGE_POLICY = 'last'
 SCORING_PARTITION_ID = 0
 SCORING_LOG_CONSUMER_BATCH_SIZE = 512
 SPIDER_LOG_CONSUMER_BATCH_SIZE = 512
@@ -51,6 +54,8 @@ SQLALCHEMYBACKEND_CLEAR_CONTENT = True
 SQLALCHEMYBACKEND_DROP_ALL_TABLES = True
 SQLALCHEMYBACKEND_ENGINE = 'sqlite:///:memory:'
 SQLALCHEMYBACKEND_ENGINE_ECHO = False
+SQLALCHEMYBACKEND_METADATA_FLUSH_INTERVAL = 30.0
+SQLALCHEMYBACKEND_METADATA_FLUSH_SIZE = 0
 SQLALCHEMYBACKEND_MODELS = {
     'MetadataModel': 'frontera.contrib.backends.sqlalchemy.models.MetadataModel',
     'StateModel': 'frontera.contrib.backends.sqlalchemy.models.StateModel',
@@ -60,15 +65,24 @@ SQLALCHEMYBACKEND_REVISIT_INTERVAL = timedelta(days=1)
 SQLALCHEMYBACKEND_DEQUEUED_DELAY = timedelta(minutes=10)
 SQLALCHEMYBACKEND_SCORE_WINDOW = 1000
 SQLALCHEMYBACKEND_MAX_REQUEST_PER_HOST = 60
+STATE_CACHE_COMPACT = False
+STATE_CACHE_LOW_WATERMARK = 0.75
 STATE_CACHE_SIZE = 1000000
 STATE_CACHE_SIZE_LIMIT = 0
+STATE_FLUSH_SLICE_SIZE = 0
+STATE_PREFETCH = False
 STORE_CONTENT = False
+STRATEGY_BATCH_SCORING = False
+STRATEGY_LINKS_DEDUP = False
 TEST_MODE = False
 TLDEXTRACT_DOMAIN_INFO = False
 URL_FINGERPRINT_FUNCTION = 'frontera.utils.fingerprint.sha1'
+WORKER_THREAD_POOL_SIZE = 0
 
 ZMQ_ADDRESS = '127.0.0.1'
 ZMQ_BASE_PORT = 5550
+ZMQ_ENVELOPE_SIZE = 0
+ZMQ_ENVELOPE_LINGER = 0.1
 
 LOGGING_CONFIG = 'logging.conf'
 
@@ -86,3 +100,4 @@ SCORING_LOG_DBW_GROUP = "dbw-scoring-log"
 SPIDER_FEED_GROUP = "fetchers-spider-feed"
 
 KAFKA_CODEC = None
+KAFKA_LAG_REFRESH_INTERVAL = 5.0
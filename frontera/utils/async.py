@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from twisted.internet import reactor, error
+from twisted.internet import reactor, error, threads
 from twisted.internet.defer import Deferred
 from six.moves import range
 
@@ -47,6 +47,38 @@ class CallLaterOnce(object):
         return f
 
 
+class CallInThreadOnce(CallLaterOnce):
+    """Like CallLaterOnce, but the function is run in the thread pool. The function never runs concurrently with
+    itself, the call scheduled while previous run hasn't finished is postponed until it finishes.
+    """
+    def __init__(self, func, threadpool, reactor=reactor, *a, **kw):
+        super(CallInThreadOnce, self).__init__(func, reactor, *a, **kw)
+        self._threadpool = threadpool
+        self._running = False
+        self._pending_delay = None
+
+    def schedule(self, delay=0.0):
+        if self._running:
+            if self._pending_delay is None or delay < self._pending_delay:
+                self._pending_delay = delay
+            return
+        super(CallInThreadOnce, self).schedule(delay)
+
+    def __call__(self, *args, **kwargs):
+        self._call = None
+        self._running = True
+        d = threads.deferToThreadPool(self._reactor, self._threadpool, self._func, *self._a, **self._kw)
+        d.addBoth(self._finished)
+        return d
+
+    def _finished(self, result):
+        self._running = False
+        if self._pending_delay is not None:
+            delay, self._pending_delay = self._pending_delay, None
+            self.schedule(delay)
+        return result
+
+
 def listen_tcp(portrange, host, factory, reactor=reactor):
     """Like reactor.listenTCP but tries different ports in a range."""
     if isinstance(portrange, int):
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from binascii import unhexlify
+from hashlib import md5
+from math import ceil, log
+from struct import unpack
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of hex fingerprints. Fingerprints are hashes already, so bit positions are derived from the binary
+    fingerprint with double hashing, without hashing it again.
+
+    :param capacity: expected count of fingerprints
+    :param error_rate: false positive probability, when filter holds capacity fingerprints
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._size = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self._hashes = max(int(round(self._size / float(capacity) * log(2))), 1)
+        self._bits = bytearray((self._size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, fingerprint):
+        digest = unhexlify(fingerprint)
+        if len(digest) < 16:
+            digest = md5(digest).digest()
+        h1, h2 = unpack('<QQ', digest[:16])
+        h2 |= 1
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def add(self, fingerprint):
+        """
+        Adds fingerprint to the filter.
+
+        :return: True if fingerprint wasn't in the filter
+        """
+        added = False
+        bits = self._bits
+        for position in self._positions(fingerprint):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, fingerprint):
+        bits = self._bits
+        for position in self._positions(fingerprint):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ScalableBloomFilter(object):
+    """
+    Bloom filter growing with the count of fingerprints. When the last filter is full, a new one is added, twice
+    larger and with tighter error rate, so the overall false positive probability stays below error_rate.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, growth=2, tightening=0.5):
+        self._growth = growth
+        self._tightening = tightening
+        self._filters = [BloomFilter(capacity, error_rate * (1 - tightening))]
+
+    def add(self, fingerprint):
+        if fingerprint in self:
+            return False
+        last = self._filters[-1]
+        if last.count >= last.capacity:
+            last = BloomFilter(last.capacity * self._growth, last.error_rate * self._tightening)
+            self._filters.append(last)
+        return last.add(fingerprint)
+
+    def __contains__(self, fingerprint):
+        for bloom in self._filters:
+            if fingerprint in bloom:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self._filters)
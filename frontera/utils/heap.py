@@ -3,6 +3,9 @@ from __future__ import print_function
 import heapq
 import math
 from io import StringIO
+from itertools import count
+
+from six.moves import range
 
 
 def show_tree(tree, total_width=80, fill=' '):
@@ -27,55 +30,50 @@ def show_tree(tree, total_width=80, fill=' '):
     return
 
 
-class HeapObjectWrapper(object):
-    def __init__(self, obj, compare_function):
-        self.obj = obj
-        self.compare_function = compare_function
-
-    def __cmp__(self, other):
-        return self.compare_function(self.obj, other.obj)
-
-    def __lt__(self, other):
-        if self.compare_function(self.obj, other.obj) == -1:
-            return True
-        else:
-            return False
-
-    def __eq__(self, other):
-        if self.compare_function(self.obj, other.obj) == 0:
-            return True
-        else:
-            return False
-
-    def __repr__(self):
-        return repr(self.obj)
-
-    def __str__(self):
-        return str(self.obj)
+class Heap(object):
+    """
+    Binary heap of objects ordered by key function. Key is computed once per pushed object and stored in a tuple with
+    a sequence number, so objects with equal keys are popped in order of pushing and objects are never compared.
 
+    :param key: function returning sort key of an object, objects themselves are compared if None
+    """
 
-class Heap(object):
-    def __init__(self, compare_function):
+    def __init__(self, key=None):
         self.heap = []
-        self._compare_function = compare_function
+        self._key = key
+        self._counter = count()
+
+    def __len__(self):
+        return len(self.heap)
 
     def push(self, obj):
-        heapq.heappush(self.heap, HeapObjectWrapper(obj, self._compare_function))
+        key = self._key(obj) if self._key else obj
+        heapq.heappush(self.heap, (key, next(self._counter), obj))
+
+    def push_many(self, objs):
+        """
+        Pushes many objects at once. When there are more new objects than already in heap, they are appended and
+        the heap is rebuilt in linear time.
+        """
+        key_func, counter = self._key, self._counter
+        items = [(key_func(obj) if key_func else obj, next(counter), obj) for obj in objs]
+        if len(items) > len(self.heap):
+            self.heap.extend(items)
+            heapq.heapify(self.heap)
+        else:
+            for item in items:
+                heapq.heappush(self.heap, item)
 
     def pop(self, n):
-        pages = []
-        page = self._extract_object()
-        while page:
-            pages.append(page)
-            if n and len(pages) >= n:
-                break
-            else:
-                page = self._extract_object()
-        return pages
+        """
+        Pops at most n objects with the lowest keys, all objects if n is 0 or None.
 
-    def _extract_object(self):
-        try:
-            wrapper = heapq.heappop(self.heap)
-            return wrapper.obj
-        except IndexError:
-            return None
+        :return: list of objects, ordered by key
+        """
+        heap = self.heap
+        if not n or n >= len(heap):
+            items = sorted(heap)
+            del heap[:]
+        else:
+            items = [heapq.heappop(heap) for _ in range(n)]
+        return [item[2] for item in items]
@@ -48,6 +48,25 @@ def to_signed32(x):
     return x - 0x100000000 if x > 0x7fffffff else x
 
 
+_score_merge_policies = {
+    'max': max,
+    'last': lambda old, new: new,
+    'sum': lambda old, new: old + new,
+}
+
+
+def get_score_merge_policy(name):
+    """
+    Returns function merging the score already buffered for a fingerprint with a new one.
+
+    :param name: 'max', 'last' or 'sum'
+    """
+    try:
+        return _score_merge_policies[name]
+    except KeyError:
+        raise ValueError("Unknown score merge policy %r, use one of %s" % (name, ", ".join(_score_merge_policies)))
+
+
 def chunks(l, n):
     for i in range(0, len(l), n):
         yield l[i:i+n]
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from itertools import islice
+
+import six
+
+
+class StateTable(object):
+    """
+    Compact hash table mapping hex fingerprints to document states. Binary fingerprint prefixes of key_size bytes are
+    stored in one bytearray and one byte states in another, using open addressing with linear probing. A slot takes
+    key_size + 1 bytes, instead of 150+ bytes taken by a dict item with bytes key.
+
+    Keys shorter than full fingerprint save more memory, but fingerprints sharing a prefix are sharing a state and
+    items() can't restore full fingerprints. Use key_size=None, if fingerprints have to be restored (f.e. for flushing
+    to storage), the size will be taken from the first fingerprint.
+
+    States are ints from 0 to 253 or None. Entries can be evicted incrementally with CLOCK algorithm, every slot has
+    a reference bit, which is set on access and cleared by the clock hand, see :meth:`evict`. Another bit marks
+    entries changed since they were loaded from storage or marked clean, these are never evicted.
+    """
+
+    EMPTY = 0xFF
+    NONE = 0xFE
+    REFERENCED = 1
+    DIRTY = 2
+    # translation table of flags to 1 for dirty entries and 0 for the rest
+    _DIRTY_MARKS = bytes(bytearray((flags >> 1) & 1 for flags in range(256)))
+
+    def __init__(self, key_size=8, capacity=1024, max_load=0.7):
+        self._key_size = key_size
+        self._initial_capacity = capacity
+        self._max_load = max_load
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self._mask = size - 1
+        # probing stops at empty slot, so there has to be one
+        self._limit = min(int(size * self._max_load), size - 1)
+        self._count = 0
+        self._states = bytearray([self.EMPTY]) * size
+        self._flags = bytearray(size)
+        self._keys = bytearray(size * self._key_size) if self._key_size else None
+        self._hand = 0
+
+    def _key(self, fingerprint):
+        key = unhexlify(fingerprint)
+        if self._key_size is None:
+            self._key_size = len(key)
+            self._keys = bytearray(len(self._states) * self._key_size)
+        if len(key) < self._key_size:
+            return key.ljust(self._key_size, b'\0')
+        return key[:self._key_size]
+
+    def _find(self, key):
+        key_size = self._key_size
+        keys = self._keys
+        states = self._states
+        index = hash(key) & self._mask
+        while states[index] != self.EMPTY:
+            offset = index * key_size
+            if keys[offset:offset + key_size] == key:
+                return index, True
+            index = (index + 1) & self._mask
+        return index, False
+
+    def _add(self, index, key, value, flags):
+        offset = index * self._key_size
+        self._keys[offset:offset + self._key_size] = key
+        self._states[index] = value
+        self._flags[index] = flags
+        self._count += 1
+
+    def _set(self, key, value, dirty):
+        index, found = self._find(key)
+        if found:
+            flags = self._flags[index] | self.REFERENCED
+            if not dirty:
+                flags &= ~self.DIRTY
+            elif self._states[index] != value:
+                flags |= self.DIRTY
+            self._states[index] = value
+            self._flags[index] = flags
+            return
+        if self._count >= self._limit:
+            self._grow()
+            index, _ = self._find(key)
+        self._add(index, key, value, self.REFERENCED | self.DIRTY if dirty else self.REFERENCED)
+
+    def _grow(self):
+        key_size = self._key_size
+        keys, states, flags = self._keys, self._states, self._flags
+        self._allocate(len(states) * 2)
+        for index, value in enumerate(states):
+            if value != self.EMPTY:
+                offset = index * key_size
+                key = bytes(keys[offset:offset + key_size])
+                self._add(self._find(key)[0], key, value, flags[index])
+
+    def _fingerprint(self, index):
+        offset = index * self._key_size
+        return hexlify(bytes(self._keys[offset:offset + self._key_size]))
+
+    def _remove(self, index):
+        """
+        Removes the entry and shifts back entries of the same probe sequence, so lookups don't need tombstones.
+        """
+        key_size, mask = self._key_size, self._mask
+        keys, states, flags = self._keys, self._states, self._flags
+        hole = index
+        current = (index + 1) & mask
+        while states[current] != self.EMPTY:
+            offset = current * key_size
+            key = bytes(keys[offset:offset + key_size])
+            home = hash(key) & mask
+            if (current - home) & mask >= (current - hole) & mask:
+                hole_offset = hole * key_size
+                keys[hole_offset:hole_offset + key_size] = key
+                states[hole] = states[current]
+                flags[hole] = flags[current]
+                hole = current
+            current = (current + 1) & mask
+        states[hole] = self.EMPTY
+        flags[hole] = 0
+        self._count -= 1
+
+    def _encode(self, state):
+        if state is None:
+            return self.NONE
+        if not 0 <= state < self.NONE:
+            raise ValueError("State %r can't be stored in the state table" % state)
+        return state
+
+    def _decode(self, value):
+        return None if value == self.NONE else value
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, fingerprint):
+        return self._find(self._key(fingerprint))[1]
+
+    def __getitem__(self, fingerprint):
+        index, found = self._find(self._key(fingerprint))
+        if not found:
+            raise KeyError(fingerprint)
+        self._flags[index] |= self.REFERENCED
+        return self._decode(self._states[index])
+
+    def __setitem__(self, fingerprint, state):
+        self._set(self._key(fingerprint), self._encode(state), True)
+
+    def __delitem__(self, fingerprint):
+        index, found = self._find(self._key(fingerprint))
+        if not found:
+            raise KeyError(fingerprint)
+        self._remove(index)
+
+    def get(self, fingerprint, default=None):
+        index, found = self._find(self._key(fingerprint))
+        if not found:
+            return default
+        self._flags[index] |= self.REFERENCED
+        return self._decode(self._states[index])
+
+    def update(self, items, dirty=True):
+        """
+        Sets states for many fingerprints at once.
+
+        :param items: dict or iterable of (fingerprint, state) tuples
+        :param dirty: False for states loaded from storage, True marks new and changed states dirty
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        for fingerprint, state in items:
+            self._set(self._key(fingerprint), self._encode(state), dirty)
+
+    def items(self):
+        for index, value in enumerate(self._states):
+            if value != self.EMPTY:
+                yield self._fingerprint(index), self._decode(value)
+
+    def dirty_items(self, count=None):
+        """
+        Returns list of at most count (fingerprint, state) tuples for dirty entries.
+        """
+        marks = self._flags.translate(self._DIRTY_MARKS)
+        result = []
+        index = marks.find(b'\x01')
+        while index != -1 and (count is None or len(result) < count):
+            result.append((self._fingerprint(index), self._decode(self._states[index])))
+            index = marks.find(b'\x01', index + 1)
+        return result
+
+    def dirty_count(self):
+        return self._flags.translate(self._DIRTY_MARKS).count(b'\x01')
+
+    def mark_clean(self, fingerprints):
+        for fingerprint in fingerprints:
+            index, found = self._find(self._key(fingerprint))
+            if found:
+                self._flags[index] &= ~self.DIRTY
+
+    def evict(self, size):
+        """
+        Evicts clean entries not accessed since the last pass of the clock hand, until table has at most size entries
+        or every entry was passed twice.
+
+        :param size: int, count of entries to keep
+        :return: count of evicted entries
+        """
+        evicted = 0
+        steps = 0
+        capacity = len(self._states)
+        while self._count > size and steps < 2 * capacity:
+            index = self._hand
+            if self._states[index] != self.EMPTY and not self._flags[index] & self.DIRTY:
+                if not self._flags[index] & self.REFERENCED:
+                    # the next entry may be shifted to this slot, so hand stays
+                    self._remove(index)
+                    evicted += 1
+                    continue
+                self._flags[index] &= ~self.REFERENCED
+            self._hand = (index + 1) & self._mask
+            steps += 1
+        return evicted
+
+    def clear(self):
+        self._allocate(self._initial_capacity)
+
+
+class StateDict(object):
+    """
+    Mapping of fingerprints to states, supporting the same CLOCK eviction as :class:`StateTable`. Used when compact
+    table isn't enabled. Entries are kept in clock order, the first one is under the clock hand and entries getting
+    the second chance are moved to the end. A state is stored together with reference and dirty bits in one small
+    int, so an entry takes nothing besides its dict item.
+    """
+
+    REFERENCED = 1
+    DIRTY = 2
+
+    def __init__(self):
+        self._items = OrderedDict()
+        self._dirty_count = 0
+
+    def _encode(self, state, flags):
+        return ((0 if state is None else state + 1) << 2) | flags
+
+    def _decode(self, value):
+        return None if value < 4 else (value >> 2) - 1
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._items
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getitem__(self, fingerprint):
+        value = self._items[fingerprint]
+        if not value & self.REFERENCED:
+            self._items[fingerprint] = value | self.REFERENCED
+        return self._decode(value)
+
+    def __setitem__(self, fingerprint, state):
+        self._set(fingerprint, state, True)
+
+    def __delitem__(self, fingerprint):
+        if self._items.pop(fingerprint) & self.DIRTY:
+            self._dirty_count -= 1
+
+    def _set(self, fingerprint, state, dirty):
+        previous = self._items.get(fingerprint)
+        was_dirty = previous is not None and previous & self.DIRTY
+        if dirty and (previous is None or self._decode(previous) != state):
+            is_dirty = True
+        else:
+            is_dirty = dirty and was_dirty
+        self._items[fingerprint] = self._encode(state, self.REFERENCED | (self.DIRTY if is_dirty else 0))
+        self._dirty_count += bool(is_dirty) - bool(was_dirty)
+
+    def get(self, fingerprint, default=None):
+        if fingerprint not in self._items:
+            return default
+        return self[fingerprint]
+
+    def update(self, items, dirty=True):
+        if isinstance(items, dict):
+            items = items.items()
+        for fingerprint, state in items:
+            self._set(fingerprint, state, dirty)
+
+    def items(self):
+        for fingerprint, value in six.iteritems(self._items):
+            yield fingerprint, self._decode(value)
+
+    def dirty_items(self, count=None):
+        dirty = ((fingerprint, self._decode(value)) for fingerprint, value in six.iteritems(self._items)
+                 if value & self.DIRTY)
+        return list(islice(dirty, count))
+
+    def dirty_count(self):
+        return self._dirty_count
+
+    def mark_clean(self, fingerprints):
+        for fingerprint in fingerprints:
+            value = self._items.get(fingerprint)
+            if value is not None and value & self.DIRTY:
+                self._items[fingerprint] = value & ~self.DIRTY
+                self._dirty_count -= 1
+
+    def evict(self, size):
+        """
+        The same as :meth:`StateTable.evict`, the clock hand is always at the first entry.
+        """
+        evicted = 0
+        steps = 0
+        limit = 2 * len(self._items)
+        while len(self._items) > size and steps < limit:
+            fingerprint, value = self._items.popitem(last=False)
+            steps += 1
+            if value & self.DIRTY:
+                self._items[fingerprint] = value
+            elif value & self.REFERENCED:
+                self._items[fingerprint] = value & ~self.REFERENCED
+            else:
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        self._items.clear()
+        self._dirty_count = 0
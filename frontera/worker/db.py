@@ -8,16 +8,19 @@ from argparse import ArgumentParser
 from time import asctime
 from os.path import exists
 from collections import defaultdict
+from threading import RLock
 
 from twisted.internet import reactor, task
 from twisted.python.failure import Failure
+from twisted.python.threadable import isInIOThread
+from twisted.python.threadpool import ThreadPool
 from frontera.core.components import DistributedBackend
 from frontera.core.manager import FrontierManager
 from frontera.logger.handlers import CONSOLE
 
 from frontera.settings import Settings
-from frontera.utils.misc import load_object
-from frontera.utils.async import CallLaterOnce
+from frontera.utils.misc import load_object, get_score_merge_policy
+from frontera.utils.async import CallLaterOnce, CallInThreadOnce
 from .server import WorkerJsonRpcService
 import six
 from six.moves import map
@@ -27,17 +30,20 @@ logger = logging.getLogger("db-worker")
 
 class Slot(object):
     def __init__(self, new_batch, consume_incoming, consume_scoring, no_batches, no_scoring_log,
-                 new_batch_delay, no_spider_log):
-        self.new_batch = CallLaterOnce(new_batch)
+                 new_batch_delay, no_spider_log, threadpool=None, clock=None):
+        self.threadpool = threadpool
+        self.reactor = clock if clock is not None else reactor
+
+        self.new_batch = self._task(new_batch)
         self.new_batch.setErrback(self.error)
 
-        self.consumption = CallLaterOnce(consume_incoming)
+        self.consumption = self._task(consume_incoming)
         self.consumption.setErrback(self.error)
 
-        self.scheduling = CallLaterOnce(self.schedule)
+        self.scheduling = CallLaterOnce(self.schedule, reactor=self.reactor)
         self.scheduling.setErrback(self.error)
 
-        self.scoring_consumption = CallLaterOnce(consume_scoring)
+        self.scoring_consumption = self._task(consume_scoring)
         self.scoring_consumption.setErrback(self.error)
 
         self.no_batches = no_batches
@@ -52,7 +58,16 @@ class Slot(object):
             self.exception(f.value)
         return f
 
+    def _task(self, func):
+        if self.threadpool is None:
+            return CallLaterOnce(func, reactor=self.reactor)
+        return CallInThreadOnce(func, self.threadpool, reactor=self.reactor)
+
     def schedule(self, on_start=False):
+        if not isInIOThread():
+            self.reactor.callFromThread(self.schedule, on_start)
+            return
+
         if on_start and not self.no_batches:
             self.new_batch.schedule(0)
 
@@ -66,6 +81,10 @@ class Slot(object):
 
 
 class DBWorker(object):
+
+    INCOMING_TYPES = frozenset(['add_seeds', 'page_crawled', 'links_extracted', 'request_error', 'offset',
+                                'overused'])
+
     def __init__(self, settings, no_batches, no_incoming, no_scoring):
         messagebus = load_object(settings.get('MESSAGE_BUS'))
         self.mb = messagebus(settings)
@@ -82,6 +101,14 @@ class DBWorker(object):
         decoder_cls = load_object(codec_path+".Decoder")
         self._encoder = encoder_cls(self._manager.request_model)
         self._decoder = decoder_cls(self._manager.request_model, self._manager.response_model)
+        # requests encoded by backend are sent as they are, if they are encoded with the message bus codec
+        self._pass_encoded = hasattr(self._backend, 'get_next_encoded_requests') and \
+            getattr(self._backend, 'encoded_requests_codec', None) == codec_path
+        try:
+            metadata = self._backend.metadata
+        except NotImplementedError:
+            metadata = None
+        self._flush_metadata = getattr(metadata, 'flush_if_needed', None)
 
         if isinstance(self._backend, DistributedBackend) and not no_scoring:
             scoring_log = self.mb.scoring_log()
@@ -92,14 +119,22 @@ class DBWorker(object):
             self.strategy_disabled = True
         self.spider_log_consumer_batch_size = settings.get('SPIDER_LOG_CONSUMER_BATCH_SIZE')
         self.scoring_log_consumer_batch_size = settings.get('SCORING_LOG_CONSUMER_BATCH_SIZE')
+        self.merge_score = get_score_merge_policy(settings.get('SCORE_MERGE_POLICY'))
 
         if settings.get('QUEUE_HOSTNAME_PARTITIONING'):
             self.logger.warning('QUEUE_HOSTNAME_PARTITIONING is deprecated, use SPIDER_FEED_PARTITIONER instead.')
             settings.set('SPIDER_FEED_PARTITIONER', 'frontera.contrib.backends.partitioners.Crc32NamePartitioner')
         self.partitioner_cls = load_object(settings.get('SPIDER_FEED_PARTITIONER'))
         self.max_next_requests = settings.MAX_NEXT_REQUESTS
+
+        # Backends aren't thread-safe, in thread pool mode only message bus I/O and (de)serialization are overlapping.
+        self._backend_lock = RLock()
+        pool_size = settings.get('WORKER_THREAD_POOL_SIZE')
+        self.threadpool = ThreadPool(minthreads=pool_size, maxthreads=pool_size, name='db-worker') \
+            if pool_size else None
         self.slot = Slot(self.new_batch, self.consume_incoming, self.consume_scoring, no_batches,
-                         self.strategy_disabled, settings.get('NEW_BATCH_DELAY'), no_incoming)
+                         self.strategy_disabled, settings.get('NEW_BATCH_DELAY'), no_incoming,
+                         threadpool=self.threadpool)
         self.job_id = 0
         self.stats = {
             'consumed_since_start': 0,
@@ -116,6 +151,8 @@ class DBWorker(object):
         self.process_info = process_info
 
     def run(self):
+        if self.threadpool:
+            self.threadpool.start()
         self.slot.schedule(on_start=True)
         self._logging_task.start(30)
         signal.signal(signal.SIGUSR1, self.remote_debug_signal)
@@ -123,10 +160,16 @@ class DBWorker(object):
         reactor.run()
 
     def stop(self):
+        if self.threadpool:
+            logger.info("Waiting for running tasks to finish.")
+            self.threadpool.stop()
+        self.spider_feed.close()
         logger.info("Stopping frontier manager.")
         self._manager.stop()
 
     def log_status(self):
+        if hasattr(self.spider_feed, 'lag_stats'):
+            self.stats.update(self.spider_feed.lag_stats)
         for k, v in six.iteritems(self.stats):
             logger.info("%s=%s", k, v)
 
@@ -136,6 +179,12 @@ class DBWorker(object):
         logger.info('spider_offsets={!r}'.format(spider_offsets))
         logger.info('worker_offsets={!r}'.format(worker_offsets))
         logger.info('overused={!r}'.format(overused))
+        consumers = [('spider_log', self.spider_log_consumer)]
+        if not self.strategy_disabled:
+            consumers.append(('scoring_log', self.scoring_log_consumer))
+        for name, consumer in consumers:
+            if hasattr(consumer, 'fetch_stats'):
+                logger.info('{}_fetch_stats={!r}'.format(name, consumer.fetch_stats))
 
     def disable_new_batches(self):
         self.slot.no_batches = True
@@ -145,70 +194,35 @@ class DBWorker(object):
 
     def consume_incoming(self, *args, **kwargs):
         consumed = 0
+        batch = defaultdict(list)
         for m in self.spider_log_consumer.get_messages(timeout=1.0, count=self.spider_log_consumer_batch_size):
+            consumed += 1
             try:
                 msg = self._decoder.decode(m)
             except (KeyError, TypeError) as e:
                 logger.error("Decoding error: %s", e)
                 continue
-            else:
-                try:
-                    type = msg[0]
-                    if type == 'add_seeds':
-                        _, seeds = msg
-                        logger.info('Adding %i seeds', len(seeds))
-                        for seed in seeds:
-                            logger.debug('URL: %s', seed.url)
-                        self._backend.add_seeds(seeds)
-                        continue
-                    if type == 'page_crawled':
-                        _, response = msg
-                        request = response.request
-                        request_fingerprint = request.meta.get(b'fingerprint').decode() if request else None
-
-                        logger.debug("Page crawled %s [%s from %s]", response.url, response.meta.get(b'fingerprint').decode(), request_fingerprint)
-                        if b'jid' not in response.meta or response.meta[b'jid'] != self.job_id:
-                            logger.warning('Response {} has no jid'.format(response))
-                            continue
-                        self._backend.page_crawled(response)
-                        continue
-                    if type == 'links_extracted':
-                        _, request, links = msg
-                        logger.debug("Links extracted %s (%d) [%s]", request.url, len(links), request.meta.get(b'fingerprint').decode())
-                        if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
-                            logger.warning('Response {} has no jid'.format(request))
-                            continue
-                        self._backend.links_extracted(request, links)
-                        continue
-                    if type == 'request_error':
-                        _, request, error = msg
-                        logger.debug("Request error %s [%s]", request.url, request.meta.get(b'fingerprint'))
-                        if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
-                            logger.warning('Response {} has no jid'.format(request))
-                            continue
-                        self._backend.request_error(request, error)
-                        continue
-                    if type == 'offset':
-                        _, partition_id, offset = msg
-                        logger.debug('Offset %s=%s', partition_id, offset)
-                        self.spider_feed.set_spider_offset(partition_id, offset)
-                        continue
-                    if type == 'overused':
-                        if not hasattr(self._backend, 'set_overused'):
-                            continue
-                        _, partition_id, netlocs = msg
-                        for netloc in netlocs:
-                            logger.debug('Domain: %s', netloc)
-                        self._backend.set_overused(partition_id, netlocs)
-                        continue
-                    logger.debug('Unknown message type %s', type)
-                except Exception as exc:
-                    logger.exception(exc)
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Message caused the error %s", str(msg))
-                    continue
-            finally:
-                consumed += 1
+            batch[msg[0]].append(msg[1:])
+
+        for type in batch:
+            if type not in self.INCOMING_TYPES:
+                logger.debug('Unknown message type %s', type)
+        with self._backend_lock:
+            self._process_seeds(batch['add_seeds'])
+            self._process_crawled(batch['page_crawled'])
+            self._process_links(batch['links_extracted'])
+            self._process_errors(batch['request_error'])
+            for partition_id, offset in batch['offset']:
+                logger.debug('Offset %s=%s', partition_id, offset)
+                self.spider_feed.set_spider_offset(partition_id, offset)
+            if hasattr(self._backend, 'set_overused'):
+                for partition_id, netlocs in batch['overused']:
+                    for netloc in netlocs:
+                        logger.debug('Domain: %s', netloc)
+                    self._backend.set_overused(partition_id, netlocs)
+            # consumption runs also when spider log is idle, so buffered metadata is written in time
+            if self._flush_metadata is not None:
+                self._flush_metadata()
         """
         # TODO: Think how it should be implemented in DB-worker only mode.
         if not self.strategy_disabled and self._backend.finished():
@@ -221,10 +235,78 @@ class DBWorker(object):
         self.slot.schedule()
         return consumed
 
+    def _process_seeds(self, messages):
+        seeds = []
+        for msg_seeds, in messages:
+            logger.info('Adding %i seeds', len(msg_seeds))
+            for seed in msg_seeds:
+                logger.debug('URL: %s', seed.url)
+            seeds.extend(msg_seeds)
+        if seeds:
+            self._process_many('add_seeds', lambda seed: self._backend.add_seeds([seed]), seeds)
+
+    def _process_crawled(self, messages):
+        responses = []
+        for response, in messages:
+            request = response.request
+            request_fingerprint = request.meta.get(b'fingerprint').decode() if request else None
+            logger.debug("Page crawled %s [%s from %s]", response.url, response.meta.get(b'fingerprint').decode(),
+                         request_fingerprint)
+            if b'jid' not in response.meta or response.meta[b'jid'] != self.job_id:
+                logger.warning('Response {} has no jid'.format(response))
+                continue
+            responses.append(response)
+        self._process_many('page_crawled_many', self._backend.page_crawled, responses)
+
+    def _process_links(self, messages):
+        batch = []
+        for request, links in messages:
+            logger.debug("Links extracted %s (%d) [%s]", request.url, len(links), request.meta.get(b'fingerprint').decode())
+            if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
+                logger.warning('Response {} has no jid'.format(request))
+                continue
+            batch.append((request, links))
+        self._process_many('links_extracted_many', lambda item: self._backend.links_extracted(*item),
+                           batch)
+
+    def _process_errors(self, messages):
+        batch = []
+        for request, error in messages:
+            logger.debug("Request error %s [%s]", request.url, request.meta.get(b'fingerprint'))
+            if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
+                logger.warning('Response {} has no jid'.format(request))
+                continue
+            batch.append((request, error))
+        self._process_many('request_error_many', lambda item: self._backend.request_error(*item),
+                           batch)
+
+    def _process_many(self, batch_method, process_item, items):
+        """
+        Passes the whole batch to backend method batch_method at once. If it fails or backend doesn't have such
+        method, falls back to processing items one by one, so a single broken message doesn't cause losing the rest
+        of the batch.
+        """
+        if not items:
+            return
+        process_batch = getattr(self._backend, batch_method, None)
+        if process_batch is not None:
+            try:
+                process_batch(items)
+                return
+            except Exception as exc:
+                logger.exception(exc)
+                logger.warning("Batch processing has failed, processing %d messages one by one", len(items))
+        for item in items:
+            try:
+                process_item(item)
+            except Exception as exc:
+                logger.exception(exc)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Message caused the error %s", str(item))
+
     def consume_scoring(self, *args, **kwargs):
         consumed = 0
-        seen = set()
-        batch = []
+        batch = {}
         for m in self.scoring_log_consumer.get_messages(count=self.scoring_log_consumer_batch_size):
             try:
                 msg = self._decoder.decode(m)
@@ -234,14 +316,18 @@ class DBWorker(object):
             else:
                 if msg[0] == 'update_score':
                     _, request, score, schedule = msg
-                    if request.meta[b'fingerprint'] not in seen:
-                        batch.append((request.meta[b'fingerprint'], score, request, schedule))
-                        seen.add(request.meta[b'fingerprint'])
+                    fingerprint = request.meta[b'fingerprint']
+                    if fingerprint in batch:
+                        _, merged_score, _, merged_schedule = batch[fingerprint]
+                        score = self.merge_score(merged_score, score)
+                        schedule = schedule or merged_schedule
+                    batch[fingerprint] = (fingerprint, score, request, schedule)
                 if msg[0] == 'new_job_id':
                     self.job_id = msg[1]
             finally:
                 consumed += 1
-        self.queue.schedule(batch)
+        with self._backend_lock:
+            self.queue.schedule(list(six.itervalues(batch)))
 
         self.stats['consumed_scoring_since_start'] += consumed
         self.stats['last_consumed_scoring'] = consumed
@@ -249,30 +335,28 @@ class DBWorker(object):
         self.slot.schedule()
 
     def new_batch(self, *args, **kwargs):
-        partitions = self.spider_feed.available_partitions()
-        self._backend.on_new_batch(partitions)
-        logger.info("Getting new batches for partitions %s" % str(",").join(map(str, partitions)))
-        if not partitions:
-            return 0
+        deficits = self.spider_feed.partition_deficits()
+        partitions = list(deficits)
+        quotas = dict((partition_id, deficit) for partition_id, deficit in six.iteritems(deficits)
+                      if deficit is not None)
+        with self._backend_lock:
+            self._backend.on_new_batch(partitions)
+            logger.info("Getting new batches for partitions %s" % str(",").join(map(str, partitions)))
+            if not partitions:
+                return 0
+            requests = list(self._get_next_encoded_requests(partitions, quotas))
 
         count = 0
         partitions_count = defaultdict(lambda: 0)
 
-        for request in self._backend.get_next_requests(self.max_next_requests, partitions=partitions):
-            try:
-                request.meta[b'jid'] = self.job_id
-                eo = self._encoder.encode_request(request)
-            except Exception as e:
-                logger.error("Encoding error, %s, fingerprint: %s, url: %s" % (e,
-                                                                               request.meta[b'fingerprint'],
-                                                                               request.url))
+        for key, eo in requests:
+            count += 1
+            if eo is None:
                 continue
-            finally:
-                count += 1
-            key = self.spider_feed_producer.partitioner.get_key(request)
             self.spider_feed_producer.send(key, eo)
             partition_id = self.spider_feed_producer.partition(key)
             partitions_count[partition_id] += 1
+        self.spider_feed_producer.flush()
 
         logger.info('Sent batches: {!r}'.format(dict(partitions_count)))
         self.stats['pushed_since_start'] += count
@@ -282,6 +366,38 @@ class DBWorker(object):
         self.stats['last_batch_generated'] = asctime()
         return count
 
+    def _get_next_encoded_requests(self, partitions, quotas):
+        """
+        Generates tuples (partitioning key, encoded request) for the new batch, encoded request is None if encoding
+        has failed. Backends capable of returning requests in already encoded form are avoiding decoding and encoding
+        of every request, only job id is stamped into encoded message. Partitions missing in quotas are getting
+        up to max_next_requests.
+        """
+        if self._pass_encoded:
+            for key, encoded in self._backend.get_next_encoded_requests(
+                    self.max_next_requests, partitions=partitions, quotas=quotas,
+                    partitioner=self.spider_feed_producer.partitioner):
+                try:
+                    eo = self._encoder.update_request_meta(encoded, {b'jid': self.job_id})
+                except Exception as e:
+                    logger.error("Encoding error, %s, key: %s" % (e, key))
+                    eo = None
+                yield key, eo
+            return
+
+        for request in self._backend.get_next_requests(self.max_next_requests, partitions=partitions,
+                                                       quotas=quotas):
+            try:
+                request.meta[b'jid'] = self.job_id
+                eo = self._encoder.encode_request(request)
+            except Exception as e:
+                logger.error("Encoding error, %s, fingerprint: %s, url: %s" % (e,
+                                                                               request.meta[b'fingerprint'],
+                                                                               request.url))
+                yield None, None
+                continue
+            yield self.spider_feed_producer.partitioner.get_key(request), eo
+
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Frontera DB worker.")
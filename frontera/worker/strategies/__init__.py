@@ -61,6 +61,22 @@ class BaseCrawlingStrategy(object):
         the links extracted for the crawled page.
         """
 
+    def score_links(self, urls, states, depths, domain_fingerprints):
+        """
+        Optional batch counterpart of :meth:`links_extracted`. If implemented and :setting:`STRATEGY_BATCH_SCORING`
+        is enabled, strategy worker collects links
+        extracted from all pages of the consumed batch and calls this method once, after the rest of the batch is
+        processed, instead of calling :meth:`links_extracted` for every page. Arguments are columns of equal length,
+        one row per unique link, so they can be turned into NumPy arrays for vectorized scoring.
+
+        :param list urls: URLs of the links.
+        :param list states: states of the links, changes made in place are stored.
+        :param list depths: depths of the links, the depth of the page plus one.
+        :param list domain_fingerprints: fingerprints of the link domains, or None if unknown.
+        :return: sequence of scores, None or NaN for links which shouldn't be scheduled.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def page_error(self, request, error):
         """
@@ -22,6 +22,14 @@ class CrawlingStrategy(BaseCrawlingStrategy):
                 link.meta[b'state'] = States.QUEUED
                 self.schedule(link, self.get_score(link.url))
 
+    def score_links(self, urls, states, depths, domain_fingerprints):
+        scores = [None] * len(urls)
+        for i, state in enumerate(states):
+            if state is States.NOT_CRAWLED:
+                states[i] = States.QUEUED
+                scores[i] = self.get_score(urls[i])
+        return scores
+
     def page_error(self, request, error):
         request.meta[b'state'] = States.ERROR
         self.schedule(request, score=0.0, dont_queue=True)
@@ -7,43 +7,125 @@ from signal import signal, SIGUSR1
 from logging.config import fileConfig
 from argparse import ArgumentParser
 from os.path import exists
-from frontera.utils.misc import load_object
+from threading import Lock, Thread, Event
+from frontera.utils.misc import load_object, get_score_merge_policy
+from frontera.worker.strategies import BaseCrawlingStrategy
 
 from frontera.core.manager import FrontierManager
 from frontera.logger.handlers import CONSOLE
 from twisted.internet.task import LoopingCall
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
 
 from frontera.settings import Settings
 from collections import Iterable
 from binascii import hexlify
 import six
+from six.moves.queue import Queue
 
 
 logger = logging.getLogger("strategy-worker")
 
 
 class UpdateScoreStream(object):
-    def __init__(self, encoder, scoring_log_producer, size):
+    """
+    Buffers score updates and sends them to scoring log. Updates of the same fingerprint are coalesced with the merge
+    policy, and encoded only on flush.
+    """
+
+    def __init__(self, encoder, scoring_log_producer, size, merge_policy='last'):
         self._encoder = encoder
-        self._buffer = []
+        self._buffer = {}
         self._producer = scoring_log_producer
         self._size = size
+        self._merge = get_score_merge_policy(merge_policy)
+
+    def _add(self, request, score, schedule):
+        fingerprint = request.meta[b'fingerprint']
+        buffered = self._buffer.get(fingerprint)
+        if buffered is not None:
+            score = self._merge(buffered[1], score)
+            schedule = schedule or buffered[2]
+        self._buffer[fingerprint] = (request, score, schedule)
 
     def send(self, request, score=1.0, dont_queue=False):
-        encoded = self._encoder.encode_update_score(
-            request,
-            score,
-            not dont_queue
-        )
-        self._buffer.append(encoded)
+        self._add(request, score, not dont_queue)
+        if len(self._buffer) > self._size:
+            self.flush()
+
+    def send_many(self, requests, scores, dont_queue=False):
+        for request, score in zip(requests, scores):
+            self._add(request, float(score), not dont_queue)
         if len(self._buffer) > self._size:
             self.flush()
 
     def flush(self):
         if self._buffer:
-            self._producer.send(None, *self._buffer)
-            self._buffer = []
+            encode = self._encoder.encode_update_score
+            self._producer.send(None, *[encode(request, score, schedule)
+                                        for request, score, schedule in six.itervalues(self._buffer)])
+            self._producer.flush()
+            self._buffer = {}
+
+
+class PrefetchedStates(object):
+    """
+    States of fingerprints read from storage by :class:`StatesReader`.
+    """
+
+    def __init__(self, states, fingerprints):
+        self.fingerprints = fingerprints
+        self.evictions = states.cache_stats['evictions']
+        self._states = states
+        self._result = []
+        self._error = None
+        self._done = Event()
+
+    def read(self):
+        try:
+            self._result = self._states.read(self.fingerprints)
+        except Exception as exc:
+            self._error = exc
+        finally:
+            self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class StatesReader(object):
+    """
+    Reads states from storage in one long-living background thread, in order of requests.
+    """
+
+    def __init__(self, states):
+        self._states = states
+        self._requests = Queue()
+        self._thread = Thread(target=self._run, name='states-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            prefetched = self._requests.get()
+            if prefetched is None:
+                return
+            prefetched.read()
+
+    def read(self, fingerprints):
+        """
+        :return: :class:`PrefetchedStates` object, which result is available when the states are read
+        """
+        prefetched = PrefetchedStates(self._states, fingerprints)
+        self._requests.put(prefetched)
+        return prefetched
+
+    def stop(self):
+        self._requests.put(None)
+        self._thread.join()
 
 
 class StatesContext(object):
@@ -52,6 +134,7 @@ class StatesContext(object):
         self._requests = []
         self._states = states
         self._fingerprints = set()
+        self._prefetched = None
 
     def to_fetch(self, requests):
         if isinstance(requests, Iterable):
@@ -59,7 +142,25 @@ class StatesContext(object):
             return
         self._fingerprints.add(requests.meta[b'fingerprint'])
 
+    def prefetch(self, reader):
+        """
+        Starts reading states of collected fingerprints from storage in background. Cache isn't touched until
+        :meth:`fetch` is called.
+
+        :param reader: :class:`StatesReader` object
+        """
+        self._prefetched = (reader.read(self._states.missing(self._fingerprints)), self._fingerprints)
+        self._fingerprints = set()
+
     def fetch(self):
+        if self._prefetched is not None:
+            (prefetched, fingerprints), self._prefetched = self._prefetched, None
+            states = prefetched.result()
+            if prefetched.evictions == self._states.cache_stats['evictions']:
+                self._states.load(states)
+            else:
+                # evicted states could be changed and flushed after they were read, so fetching all again
+                self._fingerprints.update(fingerprints)
         self._states.fetch(self._fingerprints)
         self._fingerprints.clear()
 
@@ -73,6 +174,10 @@ class StatesContext(object):
         self._states.update_cache(self._requests)
         self._requests = []
 
+    def flush_slice(self, count):
+        if hasattr(self._states, 'flush_dirty'):
+            self._states.flush_dirty(count)
+
     def flush(self):
         logger.info("Flushing states")
         self._states.flush(force_clear=False)
@@ -99,19 +204,36 @@ class StrategyWorker(object):
         self._decoder = decoder_cls(self._manager.request_model, self._manager.response_model)
         self._encoder = encoder_cls(self._manager.request_model)
 
-        self.update_score = UpdateScoreStream(self._encoder, self.scoring_log_producer, 1024)
+        self.update_score = UpdateScoreStream(self._encoder, self.scoring_log_producer, 1024,
+                                              settings.get('SCORE_MERGE_POLICY'))
         self.states_context = StatesContext(self._manager.backend.states)
 
         self.consumer_batch_size = settings.get('SPIDER_LOG_CONSUMER_BATCH_SIZE')
+        self.states_flush_slice_size = settings.get('STATE_FLUSH_SLICE_SIZE')
         self.strategy = strategy_class.from_worker(self._manager, self.update_score, self.states_context)
+        self.batch_scoring = settings.get('STRATEGY_BATCH_SCORING') and \
+            six.get_unbound_function(strategy_class.score_links) is not \
+            six.get_unbound_function(BaseCrawlingStrategy.score_links)
+        self.links_dedup = self.batch_scoring or settings.get('STRATEGY_LINKS_DEDUP')
         self.states = self._manager.backend.states
+        self.states_prefetch = settings.get('STATE_PREFETCH') and \
+            all(hasattr(self.states, attr) for attr in ('missing', 'read', 'load', 'cache_stats'))
+        self._pending = None
+        self._states_reader = None
         self.stats = {
-            'consumed_since_start': 0
+            'consumed_since_start': 0,
+            'duplicate_links_since_start': 0
         }
         self.job_id = 0
-        self.task = LoopingCall(self.work)
+
+        # States and strategy aren't thread-safe, so the work and states flushing are serialized by the lock.
+        self._lock = Lock()
+        pool_size = settings.get('WORKER_THREAD_POOL_SIZE')
+        self.threadpool = ThreadPool(minthreads=pool_size, maxthreads=pool_size, name='strategy-worker') \
+            if pool_size else None
+        self.task = LoopingCall(self._call, self.work)
         self._logging_task = LoopingCall(self.log_status)
-        self._flush_states_task = LoopingCall(self.flush_states)
+        self._flush_states_task = LoopingCall(self._call, self.flush_states)
         logger.info("Strategy worker is initialized and consuming partition %d", partition_id)
 
     def collect_unknown_message(self, msg):
@@ -120,9 +242,12 @@ class StrategyWorker(object):
     def on_unknown_message(self, msg):
         pass
 
-    def collect_batch(self):
+    def collect_batch(self, states_context=None):
+        states_context = states_context or self.states_context
         consumed = 0
         batch = []
+        # fingerprints of links extracted in the batch, if later duplicates are dropped
+        seen = set() if self.links_dedup else None
         for m in self.consumer.get_messages(count=self.consumer_batch_size, timeout=1.0):
             try:
                 msg = self._decoder.decode(m)
@@ -137,20 +262,24 @@ class StrategyWorker(object):
                 try:
                     if type == 'add_seeds':
                         _, seeds = msg
-                        self.states_context.to_fetch(seeds)
+                        states_context.to_fetch(seeds)
                         continue
                     if type == 'page_crawled':
                         _, response = msg
-                        self.states_context.to_fetch(response)
+                        states_context.to_fetch(response)
                         continue
                     if type == 'links_extracted':
                         _, request, links = msg
-                        self.states_context.to_fetch(request)
-                        self.states_context.to_fetch(links)
+                        # links of messages from other jobs are skipped later, they mustn't hide the valid ones
+                        if seen is not None and request.meta.get(b'jid') == self.job_id:
+                            links = self._drop_seen_links(links, seen)
+                            batch[-1] = (type, request, links)
+                        states_context.to_fetch(request)
+                        states_context.to_fetch(links)
                         continue
                     if type == 'request_error':
                         _, request, error = msg
-                        self.states_context.to_fetch(request)
+                        states_context.to_fetch(request)
                         continue
                     if type == 'offset':
                         continue
@@ -162,7 +291,18 @@ class StrategyWorker(object):
                 consumed += 1
         return (batch, consumed)
 
+    def _drop_seen_links(self, links, seen):
+        unique = []
+        for link in links:
+            fingerprint = link.meta[b'fingerprint']
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                unique.append(link)
+        self.stats['duplicate_links_since_start'] += len(links) - len(unique)
+        return unique
+
     def process_batch(self, batch):
+        extracted = [] if self.batch_scoring else None
         for msg in batch:
             type = msg[0]
             try:
@@ -182,6 +322,9 @@ class StrategyWorker(object):
                     _, request, links = msg
                     if b'jid' not in request.meta or request.meta[b'jid'] != self.job_id:
                         continue
+                    if extracted is not None:
+                        extracted.append((request, links))
+                        continue
                     self.on_links_extracted(request, links)
                     continue
                 if type == 'request_error':
@@ -194,13 +337,29 @@ class StrategyWorker(object):
             except Exception as exc:
                 logger.exception(exc)
                 pass
+        if extracted:
+            try:
+                self.on_links_extracted_batch(extracted)
+            except Exception as exc:
+                logger.exception(exc)
+
+    def _call(self, func):
+        """
+        Runs the function in the thread pool, if it's enabled, leaving the reactor thread free for the JSON-RPC
+        service. LoopingCall waits for the returned deferred before the next run.
+        """
+        if self.threadpool is None:
+            return func()
+        return threads.deferToThreadPool(reactor, self.threadpool, func)
 
     def work(self):
-        batch, consumed = self.collect_batch()
-        self.states_context.fetch()
-        self.process_batch(batch)
-        self.update_score.flush()
-        self.states_context.release()
+        if self.states_prefetch:
+            consumed = self._work_pipelined()
+        else:
+            batch, consumed = self.collect_batch()
+            with self._lock:
+                self.states_context.fetch()
+                self._process(batch)
 
         # Exiting, if crawl is finished
         if self.strategy.finished():
@@ -214,6 +373,34 @@ class StrategyWorker(object):
         self.stats['last_consumption_run'] = asctime()
         self.stats['consumed_since_start'] += consumed
 
+    def _work_pipelined(self):
+        """
+        Every collected batch gets own states context, its states are read from storage in background while the
+        batch collected on the previous run is processed. Read states are put to cache right before their batch is
+        processed, after the cache was updated by the previous batch.
+
+        :return: count of consumed messages
+        """
+        if self._states_reader is None:
+            self._states_reader = StatesReader(self.states)
+        states_context = StatesContext(self.states)
+        batch, consumed = self.collect_batch(states_context)
+        with self._lock:
+            previous, self._pending = self._pending, (batch, states_context)
+            if previous is not None:
+                previous[1].fetch()
+            states_context.prefetch(self._states_reader)
+            if previous is not None:
+                self._process(previous[0])
+        return consumed
+
+    def _process(self, batch):
+        self.process_batch(batch)
+        self.update_score.flush()
+        self.states_context.release()
+        if self.states_flush_slice_size:
+            self.states_context.flush_slice(self.states_flush_slice_size)
+
     def run(self):
         def log_failure(failure):
             logger.exception(failure.value)
@@ -232,6 +419,8 @@ class StrategyWorker(object):
             logger.critical("Signal received: printing stack trace")
             logger.critical(str("").join(format_stack(frame)))
 
+        if self.threadpool:
+            self.threadpool.start()
         self.task.start(interval=0).addErrback(errback_main)
         self._logging_task.start(interval=30)
         self._flush_states_task.start(interval=300).addErrback(errback_flush_states)
@@ -240,13 +429,30 @@ class StrategyWorker(object):
         reactor.run()
 
     def log_status(self):
+        if hasattr(self.states, 'cache_stats'):
+            self.stats.update(('state_cache_%s' % k, v) for k, v in six.iteritems(self.states.cache_stats))
         for k, v in six.iteritems(self.stats):
             logger.info("%s=%s", k, v)
+        if hasattr(self.consumer, 'fetch_stats'):
+            logger.info("fetch_stats=%s", self.consumer.fetch_stats)
 
     def flush_states(self):
-        self.states_context.flush()
+        with self._lock:
+            self.states_context.flush()
 
     def stop(self):
+        if self.threadpool:
+            logger.info("Waiting for running tasks to finish.")
+            self.threadpool.stop()
+        if self._pending is not None:
+            logger.info("Processing the last prefetched batch.")
+            batch, states_context = self._pending
+            self._pending = None
+            with self._lock:
+                states_context.fetch()
+                self._process(batch)
+        if self._states_reader is not None:
+            self._states_reader.stop()
         logger.info("Closing crawling strategy.")
         self.strategy.close()
         logger.info("Stopping frontier manager.")
@@ -274,6 +480,35 @@ class StrategyWorker(object):
         self.strategy.links_extracted(request, links)
         self.states.update_cache(links)
 
+    def _get_domain_fingerprint(self, request):
+        domain = request.meta.get(b'domain')
+        return domain.get(b'fingerprint') if isinstance(domain, dict) else None
+
+    def on_links_extracted_batch(self, extracted):
+        # links are unique in the batch, see collect_batch
+        links = []
+        depths = []
+        for request, request_links in extracted:
+            logger.debug("Links extracted %s (%d)", request.url, len(request_links))
+            depth = request.meta.get(b'depth', 0) + 1
+            for link in request_links:
+                links.append(link)
+                depths.append(link.meta.get(b'depth', depth))
+        self.states.set_states(links)
+        states = [link.meta[b'state'] for link in links]
+        scores = self.strategy.score_links([link.url for link in links], states, depths,
+                                           [self._get_domain_fingerprint(link) for link in links])
+        scheduled = []
+        scheduled_scores = []
+        for link, state, score in zip(links, states, scores):
+            link.meta[b'state'] = state
+            # NaN isn't equal to itself
+            if score is not None and score == score:
+                scheduled.append(link)
+                scheduled_scores.append(score)
+        self.update_score.send_many(scheduled, scheduled_scores)
+        self.states.update_cache(links)
+
     def on_request_error(self, request, error):
         logger.debug("Page error %s (%s)", request.url, error)
         self.states.set_states(request)
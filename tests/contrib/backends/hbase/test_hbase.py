@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 from happybase import Connection
 from Hbase_thrift import AlreadyExists  # module loaded at runtime in happybase
-from frontera.contrib.backends.hbase import HBaseState, HBaseMetadata, HBaseQueue
+from frontera.contrib.backends.hbase import HBaseState, HBaseMetadata, HBaseQueue, HBaseBackend
 from frontera.contrib.backends.partitioners import Crc32NamePartitioner
+from frontera.contrib.backends.remote.codecs.msgpack import Decoder, Encoder
 from frontera.core.models import Request, Response
 from frontera.core.components import States
+from frontera.settings import Settings
+from frontera.utils.misc import get_crc32
 from binascii import unhexlify
 from time import time
 from w3lib.util import to_native_str
@@ -53,6 +56,61 @@ class TestHBaseBackend(object):
         assert set([r.url for r in queue.get_next_requests(10, 1, min_requests=3, min_hosts=1,
                    max_requests_per_host=10)]) == set([r1.url, r2.url])
 
+    def test_get_next_requests_quotas(self):
+        backend = HBaseBackend.__new__(HBaseBackend)
+        backend.logger = mock.Mock()
+        backend.partitioner = Crc32NamePartitioner([0, 1, 2])
+        backend._min_requests = 64
+        backend._min_hosts = 24
+        backend._max_requests_per_host = 128
+        backend._queue = mock.Mock()
+        backend._queue.get_next_requests.return_value = []
+        backend.get_next_requests(256, partitions=[0, 1, 2], quotas={0: 1, 1: 0})
+        calls = [(args[0], args[1], kwargs['min_requests'])
+                 for args, kwargs in backend._queue.get_next_requests.call_args_list]
+        assert calls == [(1, 0, 0), (256, 2, 64)]
+
+    def test_get_next_encoded_requests_keys(self):
+        class KeyCheckingProducer(object):
+            # the same check as KafkaProducer.send does
+            def __init__(self, partitioner):
+                self.partitioner = partitioner
+                self.partitions = []
+
+            def send(self, key, *messages):
+                assert key is None or isinstance(key, (bytes, bytearray, memoryview))
+                self.partitions.append(self.partitioner.partition(key))
+
+        queue = HBaseQueue.__new__(HBaseQueue)
+        queue.logger = mock.Mock()
+        queue.partitioner = Crc32NamePartitioner([0, 1, 2])
+        queue.connection = mock.MagicMock()
+        queue.table_name = b'queue'
+        queue.decoder = Decoder(Request, Response)
+        queue.encoder = Encoder(Request)
+        requests = [r1, r2, r3]
+        queue._schedule([(r, 0.5) for r in requests], 0)
+        # scheduled requests aren't changed, score is added to the encoded ones only
+        assert all(b'score' not in r.meta for r in requests)
+        items = [(unhexlify(r.meta[b'fingerprint']), get_crc32(r.meta[b'domain'][b'name']),
+                  queue.encoder.encode_request(queue._with_score(r, 0.5)), 0.5) for r in requests]
+        queue._get_next_items = mock.Mock(return_value=items)
+        producer = KeyCheckingProducer(Crc32NamePartitioner([0, 1, 2]))
+        for key, encoded in queue.get_next_encoded_requests(10, 0, partitioner=producer.partitioner):
+            assert queue.decoder.decode_request(encoded).meta[b'score'] == 0.5
+            producer.send(key, encoded)
+        assert producer.partitions == [producer.partitioner.partition(producer.partitioner.get_key(r))
+                                       for r in requests]
+
+    def test_state_filter_several_strategy_workers(self):
+        settings = Settings()
+        settings.HBASE_STATE_FILTER_CAPACITY = 1000
+        for partitions, enabled in [(1, True), (2, False)]:
+            settings.SPIDER_LOG_PARTITIONS = partitions
+            with mock.patch('frontera.contrib.backends.hbase.Connection'):
+                backend = HBaseBackend.strategy_worker(mock.Mock(settings=settings))
+            assert (backend.states._filter is not None) == enabled
+
     @pytest.mark.xfail
     def test_queue_with_delay(self):
         connection = Connection(host='hbase-docker', port=9090)
@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 from tests.test_overused_buffer import DFSOverusedBackendTest
 from tests import backends
+from frontera.contrib.backends.memory import MemoryBroadCrawlingQueue
+from frontera.contrib.backends.partitioners import FingerprintPartitioner
+from frontera.core.models import Request
+from frontera.utils.fingerprint import sha1
 
 
 class TestFIFO(backends.FIFOBackendTest):
@@ -29,3 +33,21 @@ class TestBFS(backends.BFSBackendTest):
 
 class TestRANDOM(backends.RANDOMBackendTest):
     backend_class = 'frontera.contrib.backends.memory.RANDOM'
+
+
+def test_broad_crawling_queue():
+    queue = MemoryBroadCrawlingQueue(FingerprintPartitioner([0]), max_requests_per_host=2)
+    batch = []
+    for host, scores in [('big', [0.9, 0.8, 0.7, 0.6]), ('small', [0.5]), ('other', [0.95, 0.1])]:
+        for score in scores:
+            url = 'http://%s.com/%s' % (host, score)
+            batch.append((sha1(url), score, Request(url, meta={b'fingerprint': sha1(url)}), True))
+    queue.schedule(batch)
+    assert queue.count() == 7
+
+    urls = [r.url for r in queue.get_next_requests(4, 0)]
+    assert urls == ['http://other.com/0.95', 'http://big.com/0.9', 'http://small.com/0.5', 'http://big.com/0.8']
+    urls = [r.url for r in queue.get_next_requests(10, 0)]
+    assert urls == ['http://big.com/0.7', 'http://other.com/0.1', 'http://big.com/0.6']
+    assert queue.count() == 0
+    assert queue.get_next_requests(10, 0) == []
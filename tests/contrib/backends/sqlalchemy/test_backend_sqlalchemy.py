@@ -1,10 +1,21 @@
 from __future__ import absolute_import
 import os
 
+import pytest
+
 import pymysql
+from mock import MagicMock
 from psycopg2 import connect
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from frontera.contrib.backends.partitioners import Crc32NamePartitioner, FingerprintPartitioner
+from frontera.contrib.backends.sqlalchemy.components import BroadCrawlingQueue, Metadata, Queue, States
+from frontera.contrib.backends.sqlalchemy.models import DeclarativeBase, MetadataModel, QueueModel, StateModel, \
+    decode_payload
+from frontera.contrib.backends.sqlalchemy.payload import PayloadMetadataModel, PayloadQueueModel, migrate
+from frontera.core.models import Request, Response
 from tests import backends
 from tests.test_revisiting_backend import RevisitingBackendTest
 
@@ -64,6 +75,10 @@ class TestSQLiteMemoryBFS(SQLAlchemyBFS, SQLiteMemory):
 class TestSQLiteMemoryRevisiting(SQLAlchemyRevisiting):
     pass
 
+
+class TestSQLiteMemoryDynamic(SQLAlchemyDynamic):
+    pass
+
 #----------------------------------------------------
 # SQLite File
 #----------------------------------------------------
@@ -211,3 +226,152 @@ class TestPostgresDFS(Postgres, SQLAlchemyDFS):
 class TestPostgresBFS(Postgres, SQLAlchemyBFS):
     pass
 
+
+#----------------------------------------------------
+# Components
+#----------------------------------------------------
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite:///:memory:')
+    DeclarativeBase.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_cls(engine):
+    return sessionmaker(bind=engine)
+
+
+@pytest.mark.parametrize('upsert', [True, False])
+def test_states_upsert(session_cls, upsert):
+    states = States(session_cls, StateModel, 100)
+    if upsert:
+        if states._upsert is None:
+            pytest.skip("SQLite upsert requires SQLAlchemy 1.4+")
+    else:
+        # ORM merge fallback
+        states._upsert = None
+    requests = [Request('http://example.com/%d' % i, meta={b'fingerprint': b'%02d' % i, b'state': States.QUEUED})
+                for i in range(3)]
+    states.update_cache(requests)
+    states.flush()
+    requests[0].meta[b'state'] = States.CRAWLED
+    states.update_cache(requests[0])
+    states.flush(force_clear=True)
+    assert sorted((s.fingerprint, s.state) for s in states.session.query(StateModel)) == \
+        [('00', States.CRAWLED), ('01', States.QUEUED), ('02', States.QUEUED)]
+
+
+def test_metadata_write_behind(session_cls):
+    metadata = Metadata(session_cls, MetadataModel, 100, flush_size=3)
+    seed = Request('http://example.com/', meta={b'fingerprint': b'01'})
+    link = Request('http://example.com/link', meta={b'fingerprint': b'02'})
+    metadata.add_seeds([seed])
+    metadata.links_extracted(seed, [link])
+    metadata.update_score([(b'02', 0.5, link, True)])
+    metadata.page_crawled(Response(seed.url, status_code=200, request=seed))
+    # nothing is written until there are 3 changed rows
+    assert metadata.session.query(MetadataModel).count() == 0
+    assert metadata.cache[b'01'].status_code == 200
+    metadata.frontier_stop()
+    rows = dict((row.fingerprint, row) for row in session_cls().query(MetadataModel))
+    assert rows['01'].status_code == '200'
+    assert rows['02'].score == 0.5
+
+
+def test_metadata_write_behind_known_page(session_cls):
+    metadata = Metadata(session_cls, MetadataModel, 100, flush_size=10, flush_interval=None)
+    seed = Request('http://example.com/', meta={b'fingerprint': b'01'})
+    metadata.add_seeds([seed])
+    metadata.flush()
+    # the page is known and cached, only changed columns are written
+    metadata.page_crawled(Response(seed.url, status_code=200, request=seed))
+    metadata.request_error(seed, 'DNS_ERROR')
+    metadata.flush()
+    rows = list(session_cls().query(MetadataModel))
+    assert len(rows) == 1
+    assert (rows[0].fingerprint, rows[0].url, rows[0].status_code, rows[0].error) == \
+        ('01', 'http://example.com/', '200', 'DNS_ERROR')
+
+    # pending rows are written when the interval has passed, without new changes
+    metadata._flush_interval = 60
+    metadata.page_crawled(Response(seed.url, status_code=404, request=seed))
+    metadata.flush_if_needed()
+    assert metadata._pending
+    metadata._last_flush -= 60
+    metadata.flush_if_needed()
+    assert not metadata._pending
+    assert session_cls().query(MetadataModel).one().status_code == '404'
+
+
+def test_broad_crawling_queue_per_host(session_cls):
+    queue = BroadCrawlingQueue(session_cls, QueueModel, Crc32NamePartitioner([0]))
+    batch = []
+    for host, count in [(b'a.com', 5), (b'b.com', 1), (b'c.com', 2)]:
+        for i in range(count):
+            request = Request('http://%s/%d' % (host.decode(), i),
+                              meta={b'fingerprint': host + b'%d' % i, b'domain': {b'name': host}})
+            batch.append((request.meta[b'fingerprint'], 0.5, request, True))
+    queue.schedule(batch)
+    results = queue.get_next_requests(10, 0, min_requests=1, min_hosts=1, max_requests_per_host=2)
+    assert sorted(r.url for r in results) == ['http://a.com/0', 'http://a.com/1', 'http://b.com/0',
+                                              'http://c.com/0', 'http://c.com/1']
+    assert queue.count() == 3
+    # min_requests can't be more than max_n_requests
+    assert len(queue.get_next_requests(1, 0, min_requests=5, min_hosts=1, max_requests_per_host=2)) == 1
+
+
+def test_broad_crawling_queue_ranking_window(session_cls):
+    queue = BroadCrawlingQueue(session_cls, QueueModel, Crc32NamePartitioner([0]))
+    queue.RANKING_WINDOW = 1
+    batch = []
+    for host, count, score in [(b'a.com', 3, 0.1), (b'b.com', 1, 0.9)]:
+        for i in range(count):
+            request = Request('http://%s/%d' % (host.decode(), i),
+                              meta={b'fingerprint': host + b'%d' % i, b'domain': {b'name': host}})
+            batch.append((request.meta[b'fingerprint'], score, request, True))
+    queue.schedule(batch)
+    # only the head of the queue is ranked, b.com is out of it
+    assert [r.meta[b'domain'][b'name'] for r in queue.get_next_requests(2, 0, max_requests_per_host=1)] == \
+        [b'a.com']
+    queue.RANKING_WINDOW = 10
+    assert sorted(r.meta[b'domain'][b'name'] for r in queue.get_next_requests(2, 0, max_requests_per_host=1)) == \
+        [b'a.com', b'b.com']
+
+
+def test_broad_crawling_queue_mariadb():
+    session = MagicMock()
+    dialect = session.get_bind.return_value.dialect
+    dialect.name = 'mysql'
+    queue = BroadCrawlingQueue(MagicMock(return_value=session), QueueModel, Crc32NamePartitioner([0]))
+    # MariaDB is reported by mysql dialect, with its own versions
+    for is_mariadb, version, window_functions, skip_locked in [(False, (8, 0, 20), True, True),
+                                                               (False, (5, 7, 30), False, False),
+                                                               (True, (10, 1, 48), False, False),
+                                                               (True, (10, 5, 9), True, False),
+                                                               (True, (10, 6, 4), True, True)]:
+        dialect._is_mariadb = is_mariadb
+        queue._server_version = version
+        query = MagicMock()
+        assert queue._supports_window_functions() == window_functions
+        assert (queue._lock(query) is query.with_for_update.return_value) == skip_locked
+
+
+def test_payload_models(engine, session_cls):
+    request = Request('http://example.com/', headers={b'Accept': b'text/html'}, cookies={b'a': b'b'},
+                      meta={b'fingerprint': b'10a1b2c3d4e5f60718293a4b5c6d7e8f90a1b2c3', b'depth': 1})
+    queue = Queue(session_cls, PayloadQueueModel, FingerprintPartitioner([0]))
+    queue.schedule([(request.meta[b'fingerprint'], 0.5, request, True)])
+    dequeued, = queue.get_next_requests(10, 0)
+    assert dequeued.url == request.url
+    assert dequeued.headers == request.headers
+    assert dequeued.cookies == request.cookies
+    assert dequeued.meta[b'depth'] == 1
+
+    metadata = Metadata(session_cls, MetadataModel, 100)
+    metadata.add_seeds([request])
+    assert migrate(engine, MetadataModel, PayloadMetadataModel) == 1
+    row = session_cls().query(PayloadMetadataModel).one()
+    assert row.url == request.url
+    assert decode_payload(row.payload).cookies == request.cookies
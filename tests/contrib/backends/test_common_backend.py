@@ -2,6 +2,9 @@ from __future__ import absolute_import
 from tests import mock
 from frontera import Settings
 from frontera.contrib.backends import CommonBackend
+from frontera.contrib.backends.memory import MemoryStates
+from frontera.core.components import States
+from frontera.core.models import Request, Response
 
 
 class DummyManager:
@@ -22,6 +25,25 @@ class Backend(CommonBackend):
     def states(self):
         return mock.Mock()
 
+class StatesBackend(CommonBackend):
+    def __init__(self, settings):
+        self.manager = DummyManager(settings)
+        self.queue_size = 0
+        self._metadata = mock.Mock()
+        self._queue = mock.Mock()
+        self._states = MemoryStates(1000)
+
+    @property
+    def metadata(self):
+        return self._metadata
+    @property
+    def queue(self):
+        return self._queue
+    @property
+    def states(self):
+        return self._states
+
+
 def test_overused():
     settings = Settings(attributes={
         'OVERUSED_BATCH_DELAY': 2
@@ -38,3 +60,32 @@ def test_overused():
     assert backend.get_overused_for_batch([0, 1]) == {0: {'b'}, 1: {'a'}}
     assert backend.get_overused_for_batch([0, 1]) == {0: set(), 1: {'a'}}
     assert backend.get_overused_for_batch([0, 1]) == {0: set(), 1: set()}
+
+
+def test_links_extracted_many():
+    backend = StatesBackend(Settings())
+    r1 = Request('http://www.example.com/', meta={b'fingerprint': b'1', b'depth': 0})
+    r2 = Request('http://www.example.com/2', meta={b'fingerprint': b'2', b'depth': 1})
+    links1 = [Request('http://www.example.com/a', meta={b'fingerprint': b'a'}),
+              Request('http://www.example.com/b', meta={b'fingerprint': b'b'})]
+    links2 = [Request('http://www.example.com/b', meta={b'fingerprint': b'b'}),
+              Request('http://www.example.com/c', meta={b'fingerprint': b'c'})]
+    backend.links_extracted_many([(r1, links1), (r2, links2)])
+
+    assert backend.queue.schedule.call_count == 1
+    batch = backend.queue.schedule.call_args[0][0]
+    assert [fprint for fprint, _, _, _ in batch] == [b'a', b'b', b'c']
+    assert [request.meta[b'depth'] for _, _, request, _ in batch] == [1, 1, 2]
+    assert backend.metadata.links_extracted_many.call_count == 1
+    assert backend.states._cache == {b'a': States.QUEUED, b'b': States.QUEUED, b'c': States.QUEUED}
+
+
+def test_page_crawled_many():
+    backend = StatesBackend(Settings())
+    responses = [Response('http://www.example.com/', request=Request('http://www.example.com/',
+                                                                      meta={b'fingerprint': b'1'})),
+                 Response('http://www.example.com/2', request=Request('http://www.example.com/2',
+                                                                       meta={b'fingerprint': b'2'}))]
+    backend.page_crawled_many(responses)
+    backend.metadata.page_crawled_many.assert_called_once_with(responses)
+    assert backend.states._cache == {b'1': States.CRAWLED, b'2': States.CRAWLED}
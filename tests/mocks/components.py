@@ -3,6 +3,7 @@ from frontera.core.components import Backend, Middleware, CanonicalSolver, \
     DistributedBackend, Queue
 from six.moves import range
 from frontera.core.models import Request
+from frontera.contrib.backends.remote.codecs.msgpack import Encoder
 
 
 class FakeMiddleware(Middleware):
@@ -80,6 +81,9 @@ class FakeBackend(FakeMiddleware, Backend):
     def finished(self):
         return self._finished
 
+    def on_new_batch(self, partitions):
+        pass
+
     def put_requests(self, requests):
         self.queue.put_requests(requests)
 
@@ -96,6 +100,7 @@ class FakeDistributedBackend(FakeBackend, DistributedBackend):
         FakeBackend.__init__(self)
         self._queue = FakeQueue()
         self.partitions = set()
+        self.quotas = None
 
     @classmethod
     def db_worker(cls, manager):
@@ -112,9 +117,22 @@ class FakeDistributedBackend(FakeBackend, DistributedBackend):
     def get_next_requests(self, max_next_request, partitions, **kwargs):
         for partition in partitions:
             self.partitions.add(partition)
+        self.quotas = kwargs.get('quotas')
         return self._queue.get_next_requests(max_next_request)
 
 
+class FakeEncodedDistributedBackend(FakeDistributedBackend):
+    encoded_requests_codec = 'frontera.contrib.backends.remote.codecs.msgpack'
+
+    def __init__(self):
+        FakeDistributedBackend.__init__(self)
+        self._encoder = Encoder(Request)
+
+    def get_next_encoded_requests(self, max_next_request, partitions, **kwargs):
+        return [(request.meta[b'fingerprint'], self._encoder.encode_request(request))
+                for request in self.get_next_requests(max_next_request, partitions, **kwargs)]
+
+
 class FakeMiddlewareBlocking(FakeMiddleware):
 
     def add_seeds(self, seeds):
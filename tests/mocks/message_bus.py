@@ -33,13 +33,14 @@ class Producer(BaseStreamProducer):
     def __init__(self):
         self.messages = []
         self.offset = 0
+        self.flushed = 0
         self.partitioner = FingerprintPartitioner([0])
 
     def send(self, key, *messages):
         self.messages += messages
 
     def flush(self):
-        pass
+        self.flushed += 1
 
     def get_offset(self, partition_id):
         return self.offset
@@ -88,12 +89,15 @@ class SpiderFeedStream(BaseSpiderFeedStream):
         return Consumer()
 
     def available_partitions(self):
-        partitions = []
+        return list(self.partition_deficits())
+
+    def partition_deficits(self):
+        deficits = {}
         for partition_id, last_offset in self.partitions_offset.items():
-            lag = self._producer.get_offset(partition_id) - last_offset
-            if lag < self.max_next_requests or last_offset == 0:
-                partitions.append(partition_id)
-        return partitions
+            lag = self._producer.get_offset(partition_id) - last_offset if last_offset else 0
+            if lag < self.max_next_requests:
+                deficits[partition_id] = min(self.max_next_requests - lag, self.max_next_requests)
+        return deficits
 
     def set_spider_offset(self, partition_id, offset):
         self.partitions_offset[partition_id] = offset
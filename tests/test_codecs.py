@@ -6,6 +6,7 @@ import unittest
 from frontera.contrib.backends.remote.codecs.json import (Encoder as JsonEncoder, Decoder as JsonDecoder,
                                                           _convert_and_save_type, _convert_from_saved_type)
 from frontera.contrib.backends.remote.codecs.msgpack import Encoder as MsgPackEncoder, Decoder as MsgPackDecoder
+from frontera.core.codec import BaseEncoder
 from frontera.core.models import Request, Response
 import pytest
 
@@ -124,6 +125,25 @@ def test_codec(encoder, decoder, send_body, invalid_value):
         dec.decode(next(it))
 
 
+@pytest.mark.parametrize(
+    ('encoder', 'decoder'), [
+        (MsgPackEncoder, MsgPackDecoder),
+        (JsonEncoder, JsonDecoder)
+    ]
+)
+def test_update_request_meta(encoder, decoder):
+    enc = encoder(Request)
+    dec = decoder(Request, Response)
+    req = Request(url="http://www.yandex.ru", meta={b'test': b'shmest', b'jid': 1})
+    o = dec.decode_request(enc.update_request_meta(enc.encode_request(req), {b'jid': 2, b'score': 0.5}))
+    assert o.url == req.url
+    assert o.meta == {b'test': b'shmest', b'jid': 2, b'score': 0.5}
+
+    # default implementation, for codecs not overriding it
+    o = dec.decode_request(BaseEncoder.update_request_meta(enc, enc.encode_request(req), {b'jid': 3}))
+    assert o.meta == {b'test': b'shmest', b'jid': 3}
+
+
 class TestEncodeDecodeJson(unittest.TestCase):
     """
     Test for testing methods `_encode_recursively` and `_decode_recursively` used in json codec
@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 from frontera.settings import Settings
-from frontera.contrib.messagebus.zeromq import MessageBus as ZeroMQMessageBus
-from frontera.contrib.messagebus.kafkabus import MessageBus as KafkaMessageBus, Consumer as KafkaConsumer
+from frontera.contrib.messagebus.zeromq import MessageBus as ZeroMQMessageBus, Consumer as ZeroMQConsumer, \
+    SpiderLogProducer as ZeroMQSpiderLogProducer
+from frontera.contrib.backends.partitioners import FingerprintPartitioner
+from frontera.contrib.messagebus.zeromq.broker import ProxyServer
+from frontera.contrib.messagebus import kafkabus
+from frontera.contrib.messagebus.kafkabus import MessageBus as KafkaMessageBus, Consumer as KafkaConsumer, \
+    LagTracker
 from frontera.utils.fingerprint import sha1
-from kafka import KafkaClient
+from kafka import KafkaClient, TopicPartition
 from random import randint
-from time import sleep
+from time import sleep, time
+from struct import pack
+import zmq
+import pytest
 from six.moves import range
 import logging
 from sys import stdout
 import unittest
+from threading import Thread, Event, Lock
 from w3lib.util import to_bytes
 
 
@@ -116,6 +125,101 @@ class KafkaConsumerPolling(object):
 
 
 
+class FakeKafkaConsumer(object):
+    def __init__(self, batches):
+        self.batches = batches
+        self.polls = []
+
+    def poll(self, timeout_ms=0, max_records=None):
+        self.polls.append((timeout_ms, max_records))
+        if not self.batches:
+            return {}
+        return self.batches.pop(0)
+
+
+class FakeKafkaClient(object):
+    def __init__(self):
+        self.polls = 0
+
+    def poll(self):
+        self.polls += 1
+
+
+class FakeRecord(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def test_kafka_consumer_get_messages():
+    tp0, tp1 = TopicPartition('topic', 0), TopicPartition('topic', 1)
+    consumer = KafkaConsumer.__new__(KafkaConsumer)
+    consumer.fetch_stats = {}
+    consumer._lock = Lock()
+    consumer._consumer = FakeKafkaConsumer([
+        {tp0: [FakeRecord(b'1'), FakeRecord(b'2')], tp1: [FakeRecord(b'3')]},
+        {tp1: [FakeRecord(b'4')]},
+        {tp0: [FakeRecord(b'5')]},
+    ])
+    assert sorted(consumer.get_messages(timeout=1.0, count=4)) == [b'1', b'2', b'3', b'4']
+    assert [max_records for _, max_records in consumer._consumer.polls] == [4, 1]
+    assert consumer.fetch_stats == {0: {'fetched': 2, 'last_fetched': 2}, 1: {'fetched': 2, 'last_fetched': 2}}
+
+    assert consumer.get_messages(timeout=0.2, count=4) == [b'5']
+    assert consumer.fetch_stats == {0: {'fetched': 3, 'last_fetched': 1}, 1: {'fetched': 2, 'last_fetched': 0}}
+    assert all(timeout_ms <= 200 for timeout_ms, _ in consumer._consumer.polls[2:])
+
+
+def test_kafka_consumer_poll_client():
+    consumer = KafkaConsumer.__new__(KafkaConsumer)
+    consumer._lock = Lock()
+    consumer._consumer = FakeKafkaConsumer([])
+    consumer._consumer._client = FakeKafkaClient()
+    consumer._poll_client()
+    assert consumer._consumer._client.polls == 1
+    # consumer is being polled from another thread
+    with consumer._lock:
+        consumer._poll_client()
+    assert consumer._consumer._client.polls == 1
+
+
+class FakeOffsetsFetcher(object):
+    def __init__(self, lags):
+        self.lags = lags
+        self.fetched = Event()
+
+    def get(self):
+        self.fetched.set()
+        return self.lags
+
+
+def test_kafka_lag_tracker():
+    fetcher = FakeOffsetsFetcher({0: 10, 1: 0})
+    tracker = LagTracker(fetcher, 60.0)
+    # nothing is polled till the tracker is started, and the first refresh is done right away
+    assert not fetcher.fetched.is_set()
+    assert tracker.age is None
+    tracker.start()
+    assert tracker.lags == {0: 10, 1: 0}
+    assert 0 <= tracker.age < 60.0
+    tracker.stop()
+    assert not tracker._thread.is_alive()
+
+
+def test_kafka_spider_feed_lag_tracker(monkeypatch):
+    fetcher = FakeOffsetsFetcher({0: 10, 1: 0})
+    monkeypatch.setattr(kafkabus, 'OffsetsFetcherAsync', lambda **kwargs: fetcher)
+    settings = Settings()
+    settings.set('MAX_NEXT_REQUESTS', 64)
+    spider_feed = kafkabus.SpiderFeedStream(KafkaMessageBus(settings))
+    # spiders are creating the stream too, they mustn't poll offsets
+    assert spider_feed.lag_stats == {}
+    assert not fetcher.fetched.is_set()
+    assert spider_feed.partition_deficits() == {0: 54, 1: 64}
+    tracker = spider_feed._lag_tracker
+    spider_feed.close()
+    assert not tracker._thread.is_alive()
+
+
 class KafkaMessageBusTest(unittest.TestCase):
     def setUp(self):
         logging.basicConfig()
@@ -236,3 +340,130 @@ def test_zmq_message_bus():
     assert tester.sw_activity() == 64
     assert tester.db_activity(128) == (64, 32)
     assert tester.spider_feed_activity() == 128
+
+
+class ZeroMQContext(object):
+    zeromq = zmq.Context.instance()
+    stats = {}
+
+
+def test_zmq_consumer():
+    context = ZeroMQContext()
+    publisher = context.zeromq.socket(zmq.PUB)
+    publisher.bind('inproc://test-zmq-consumer')
+    consumer = ZeroMQConsumer(context, 'inproc://test-zmq-consumer', 0, b'sl')
+    sleep(0.1)
+    try:
+        started = time()
+        assert list(consumer.get_messages(timeout=0.2, count=10)) == []
+        assert time() - started >= 0.2
+
+        for seqno in [0, 1, 5]:
+            publisher.send_multipart([b'sl' + pack('>B', 0), b'message%d' % seqno, pack('>II', seqno, seqno),
+                                      pack('>B', 3)])
+        assert list(consumer.get_messages(timeout=1.0, count=2)) == [b'message0', b'message1']
+        assert list(consumer.get_messages(timeout=1.0, count=10)) == [b'message5']
+        assert consumer.counters == {3: 6}
+    finally:
+        consumer.subscriber.close()
+        publisher.close()
+
+
+def test_zmq_envelopes():
+    context = ZeroMQContext()
+    frontend = context.zeromq.socket(zmq.XSUB)
+    frontend.bind('inproc://test-zmq-envelopes-in')
+    backend = context.zeromq.socket(zmq.XPUB)
+    backend.bind('inproc://test-zmq-envelopes-out')
+    control = context.zeromq.socket(zmq.PAIR)
+    control.bind('inproc://test-zmq-envelopes-control')
+    controller = context.zeromq.socket(zmq.PAIR)
+    controller.connect('inproc://test-zmq-envelopes-control')
+    proxy = Thread(target=zmq.proxy_steerable, args=(frontend, backend, None, control))
+    proxy.start()
+
+    consumer = ZeroMQConsumer(context, 'inproc://test-zmq-envelopes-out', 0, b'sl')
+    producer = ZeroMQSpiderLogProducer(context, 'inproc://test-zmq-envelopes-in', FingerprintPartitioner([0]), 1,
+                                       3, 60.0)
+    sleep(0.1)
+    try:
+        key = sha1('key')
+        messages = [b'message%d' % i for i in range(7)]
+        producer.send(key, *messages)
+        assert list(consumer.get_messages(timeout=0.5, count=4)) == messages[:4]
+        assert list(consumer.get_messages(timeout=0.5, count=10)) == messages[4:6]
+        producer.flush()
+        producer.send(key, b'message7')
+        producer.flush()
+        assert list(consumer.get_messages(timeout=0.5, count=10)) == messages[6:] + [b'message7']
+        assert consumer.counters == {1: 8}
+        assert producer.get_offset(0) == 8
+    finally:
+        controller.send(b'TERMINATE')
+        proxy.join()
+        for socket in [consumer.subscriber, producer.sender, frontend, backend, control, controller]:
+            socket.close()
+
+
+def test_zmq_envelopes_idle():
+    context = ZeroMQContext()
+    frontend = context.zeromq.socket(zmq.XSUB)
+    frontend.bind('inproc://test-zmq-envelopes-idle-in')
+    backend = context.zeromq.socket(zmq.XPUB)
+    backend.bind('inproc://test-zmq-envelopes-idle-out')
+    control = context.zeromq.socket(zmq.PAIR)
+    control.bind('inproc://test-zmq-envelopes-idle-control')
+    controller = context.zeromq.socket(zmq.PAIR)
+    controller.connect('inproc://test-zmq-envelopes-idle-control')
+    proxy = Thread(target=zmq.proxy_steerable, args=(frontend, backend, None, control))
+    proxy.start()
+
+    consumer = ZeroMQConsumer(context, 'inproc://test-zmq-envelopes-idle-out', 0, b'sl')
+    producer = ZeroMQSpiderLogProducer(context, 'inproc://test-zmq-envelopes-idle-in', FingerprintPartitioner([0]), 1,
+                                       3, 0.05)
+    sleep(0.1)
+    try:
+        key = sha1('key')
+        producer.send(key, b'message0')
+        producer.flush_expired()
+        assert list(consumer.get_messages(timeout=0.2, count=10)) == []
+        # nothing else is sent, but the envelope is old enough
+        sleep(0.1)
+        producer.flush_expired()
+        assert list(consumer.get_messages(timeout=0.5, count=10)) == [b'message0']
+        # partial envelope is sent on close
+        producer.send(key, b'message1')
+        producer.close()
+        assert list(consumer.get_messages(timeout=0.5, count=10)) == [b'message1']
+    finally:
+        controller.send(b'TERMINATE')
+        proxy.join()
+        for socket in [consumer.subscriber, frontend, backend, control, controller]:
+            socket.close()
+
+
+def test_zmq_proxy_broker():
+    server = ProxyServer('127.0.0.1', 5590)
+    server.start_proxies()
+    try:
+        settings = Settings()
+        settings.set('ZMQ_BASE_PORT', 5590)
+        tester = MessageBusTester(ZeroMQMessageBus, settings)
+        tester.spider_log_activity(64)
+        assert tester.sw_activity() == 64
+        assert tester.db_activity(64) == (64, 32)
+        assert tester.spider_feed_activity() == 64
+        server.update_stats()
+        # proxies count frames, every message has at least one
+        assert server.stats['spiders_out_frames'] >= 64
+        assert server.stats['db_in_frames'] >= 96
+        assert server.stats['db_out_frames'] >= 64
+        assert server.stats['db_out_bytes'] > 0
+    finally:
+        server.stop()
+
+
+def test_zmq_proxy_broker_old_libzmq(monkeypatch):
+    monkeypatch.setattr(zmq, 'zmq_version_info', lambda: (4, 2, 5))
+    with pytest.raises(RuntimeError):
+        ProxyServer('127.0.0.1', 5600)
@@ -74,6 +74,7 @@ class TestMessageBusBackend(unittest.TestCase):
         _, partition_id, offset = mbb._decoder.decode(mbb.spider_log_producer.messages.pop(0))
         self.assertEqual((partition_id, offset), (0, 0))
         self.assertEqual(set([r.url for r in requests]), set([r1.url, r2.url, r3.url]))
+        self.assertEqual(mbb.spider_log_producer.flushed, 1)
         requests = set(mbb.get_next_requests(10, overused_keys=[], key_type='domain'))
         _, partition_id, offset = mbb._decoder.decode(mbb.spider_log_producer.messages.pop(0))
         self.assertEqual((partition_id, offset), (0, 0))
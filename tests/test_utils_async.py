@@ -4,7 +4,8 @@ import pytest
 from twisted.test.proto_helpers import MemoryReactor
 from twisted.internet.protocol import Factory
 from twisted.internet.task import Clock
-from frontera.utils.async import CallLaterOnce, listen_tcp
+from twisted.python.failure import Failure
+from frontera.utils.async import CallLaterOnce, CallInThreadOnce, listen_tcp
 
 
 class TestCallLaterOnce(object):
@@ -51,6 +52,85 @@ class TestCallLaterOnce(object):
         assert self.called == 0
 
 
+class ThreadClock(Clock):
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class DeferredThreadPool(object):
+    """Runs the calls only when asked to."""
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kwargs):
+        self.calls.append((onResult, func, args, kwargs))
+
+    def run_all(self):
+        calls, self.calls = self.calls, []
+        for onResult, func, args, kwargs in calls:
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+
+
+class TestCallInThreadOnce(object):
+
+    called = 0
+
+    def call_function(self):
+        self.called += 1
+
+    def raise_error(self):
+        raise ValueError('error')
+
+    def test_call_in_thread(self):
+        self.called = 0
+        reactor = ThreadClock()
+        pool = DeferredThreadPool()
+        call = CallInThreadOnce(self.call_function, pool, reactor=reactor)
+        call.schedule(delay=1)
+        reactor.advance(1)
+        assert self.called == 0
+        assert len(pool.calls) == 1
+        pool.run_all()
+        assert self.called == 1
+
+    def test_not_scheduled_while_running(self):
+        self.called = 0
+        reactor = ThreadClock()
+        pool = DeferredThreadPool()
+        call = CallInThreadOnce(self.call_function, pool, reactor=reactor)
+        call.schedule()
+        reactor.advance(0)
+        call.schedule()
+        reactor.advance(0)
+        assert len(pool.calls) == 1
+        pool.run_all()
+        call.schedule()
+        reactor.advance(0)
+        pool.run_all()
+        assert self.called == 2
+
+    def test_error(self):
+        reactor = ThreadClock()
+        pool = DeferredThreadPool()
+        errors = []
+        call = CallInThreadOnce(self.raise_error, pool, reactor=reactor)
+        call.setErrback(lambda f: errors.append(f))
+        call.schedule()
+        reactor.advance(0)
+        pool.run_all()
+        assert len(errors) == 1 and errors[0].check(ValueError)
+        call.schedule()
+        reactor.advance(0)
+        assert len(pool.calls) == 1
+
+
 class TestListenTCP(object):
 
     host = '127.0.0.1'
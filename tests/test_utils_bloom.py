@@ -0,0 +1,32 @@
+from __future__ import absolute_import
+from frontera.utils.bloom import BloomFilter, ScalableBloomFilter
+from frontera.utils.fingerprint import sha1, md5
+
+
+class TestBloomFilter(object):
+
+    def test_add(self):
+        bloom = BloomFilter(100)
+        assert bloom.add(sha1('a'))
+        assert not bloom.add(sha1('a'))
+        assert sha1('a') in bloom
+        assert sha1('b') not in bloom
+        assert bloom.count == 1
+
+    def test_short_fingerprint(self):
+        bloom = BloomFilter(100)
+        bloom.add(md5('a')[:8])
+        assert md5('a')[:8] in bloom
+
+
+class TestScalableBloomFilter(object):
+
+    def test_grow(self):
+        bloom = ScalableBloomFilter(100, 0.01)
+        fingerprints = [sha1(str(i)) for i in range(1000)]
+        for fprint in fingerprints:
+            bloom.add(fprint)
+        assert len(bloom._filters) > 1
+        assert all(fprint in bloom for fprint in fingerprints)
+        false_positives = sum(1 for i in range(1000) if sha1('x%d' % i) in bloom)
+        assert false_positives < 50
@@ -2,14 +2,10 @@ from __future__ import absolute_import
 from frontera.utils.heap import Heap
 
 
-def cmp(a, b):
-    return (a > b) - (a < b)
-
-
 class TestHeap(object):
 
     def test_heap_order(self):
-        heap = Heap(cmp)
+        heap = Heap()
         heap.push(5)
         heap.push(2)
         heap.push(3)
@@ -28,9 +24,19 @@ class TestHeap(object):
         b.score = 1
         c = obj()
         c.score = 2
-        heap = Heap(lambda x, y: cmp(x.score, y.score))
+        heap = Heap(lambda x: x.score)
         heap.push(a)
         heap.push(b)
         heap.push(c)
         assert heap.pop(3) == [b, c, a]
         assert heap.pop(1) == []
+
+    def test_heap_push_many(self):
+        heap = Heap(lambda x: x[0])
+        heap.push((2, 'a'))
+        heap.push_many([(1, 'b'), (2, 'c'), (0, 'd')])
+        heap.push_many([(2, 'e')])
+        assert len(heap) == 5
+        assert heap.pop(2) == [(0, 'd'), (1, 'b')]
+        assert heap.pop(0) == [(2, 'a'), (2, 'c'), (2, 'e')]
+        assert len(heap) == 0
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+import pytest
+from frontera.utils.fingerprint import sha1
+from frontera.utils.statetable import StateTable, StateDict
+
+
+class TestStateTable(object):
+
+    def test_set_get(self):
+        table = StateTable()
+        table[sha1('a')] = 1
+        table[sha1('b')] = 2
+        table[sha1('a')] = 3
+        assert len(table) == 2
+        assert table[sha1('a')] == 3
+        assert table.get(sha1('b')) == 2
+        assert table.get(sha1('c'), 0) == 0
+        assert sha1('c') not in table
+        with pytest.raises(KeyError):
+            table[sha1('c')]
+
+    def test_none_state(self):
+        table = StateTable()
+        table[sha1('a')] = None
+        assert sha1('a') in table
+        assert table[sha1('a')] is None
+        with pytest.raises(ValueError):
+            table[sha1('b')] = 255
+
+    def test_grow(self):
+        table = StateTable(capacity=4)
+        fingerprints = [sha1(str(i)) for i in range(1000)]
+        table.update((fprint, i % 4) for i, fprint in enumerate(fingerprints))
+        assert len(table) == 1000
+        assert all(table[fprint] == i % 4 for i, fprint in enumerate(fingerprints))
+
+    def test_items_full_key(self):
+        table = StateTable(key_size=None)
+        table.update({sha1('a'): 1, sha1('b'): 2})
+        assert dict(table.items()) == {sha1('a'): 1, sha1('b'): 2}
+        table.clear()
+        assert len(table) == 0
+        assert sha1('a') not in table
+
+    def test_evict(self):
+        table = StateTable(capacity=16)
+        fingerprints = [sha1(str(i)) for i in range(10)]
+        table.update(((fprint, 1) for fprint in fingerprints), dirty=False)
+        assert table.evict(9) == 1
+        hot = table_fingerprints(table, fingerprints)[:3]
+        for fprint in hot:
+            table.get(fprint)
+        assert table.evict(5) == 4
+        assert len(table) == 5
+        assert all(fprint in table for fprint in hot)
+
+    def test_remove(self):
+        table = StateTable(capacity=8, max_load=1.0)
+        fingerprints = [sha1(str(i)) for i in range(8)]
+        table.update((fprint, i % 4) for i, fprint in enumerate(fingerprints))
+        for fprint in fingerprints[::2]:
+            del table[fprint]
+        assert len(table) == 4
+        assert all(table[fprint] == i % 4 for i, fprint in enumerate(fingerprints) if i % 2)
+        assert all(fprint not in table for fprint in fingerprints[::2])
+
+    def test_dirty(self):
+        table = StateTable(key_size=None)
+        table.update({sha1('a'): 1, sha1('b'): 1}, dirty=False)
+        table[sha1('a')] = 1
+        table[sha1('b')] = 2
+        table[sha1('c')] = 0
+        assert sorted(table.dirty_items()) == sorted([(sha1('b'), 2), (sha1('c'), 0)])
+        assert len(table.dirty_items(1)) == 1
+        table.mark_clean([sha1('b')])
+        assert table.dirty_items() == [(sha1('c'), 0)]
+        assert table.dirty_count() == 1
+        assert table.evict(0) == 2
+        assert list(table.items()) == [(sha1('c'), 0)]
+
+
+def table_fingerprints(table, fingerprints):
+    return [fprint for fprint in fingerprints if fprint in table]
+
+
+class TestStateDict(object):
+
+    def test_evict(self):
+        states = StateDict()
+        states.update(((str(i), 1) for i in range(10)), dirty=False)
+        assert states.evict(9) == 1
+        states.get('1')
+        states['2'] = 2
+        assert states.evict(2) == 7
+        assert states == {'1': 1, '2': 2}
+
+    def test_dirty(self):
+        states = StateDict()
+        states.update({'a': 1, 'b': 1}, dirty=False)
+        states['a'] = 1
+        states['b'] = 2
+        assert states.dirty_items() == [('b', 2)]
+        assert states.evict(0) == 1
+        states.mark_clean(['b'])
+        assert states.dirty_count() == 0
+        assert states.evict(0) == 1
+        assert states == {}
+
+    def test_evict_hand(self):
+        states = StateDict()
+        states.update(((str(i), None) for i in range(4)), dirty=False)
+        assert states.evict(3) == 1
+        states.get('2')
+        assert states.evict(2) == 1
+        assert states == {'2': None, '3': None}
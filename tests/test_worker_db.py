@@ -1,8 +1,11 @@
 import pytest
+from threading import Event
 from frontera.core.models import Request, Response
-from frontera.worker.db import DBWorker
+from frontera.worker.db import DBWorker, Slot
+from frontera.utils.async import CallInThreadOnce
 from frontera.settings import Settings
 from frontera.core.components import States
+from tests.test_utils_async import ThreadClock, DeferredThreadPool
 
 
 r1 = Request('http://www.example.com/', meta={b'fingerprint': b'1', b'state': States.DEFAULT, b'jid': 0})
@@ -12,11 +15,16 @@ r3 = Request('https://www.dmoz.org', meta={b'fingerprint': b'3', b'state': State
 
 class TestDBWorker(object):
 
-    def dbw_setup(self, distributed=False):
+    def dbw_setup(self, distributed=False, encoded=False, pool_size=0, codec=None):
         settings = Settings()
+        if codec:
+            settings.MESSAGE_BUS_CODEC = codec
+        settings.WORKER_THREAD_POOL_SIZE = pool_size
         settings.MAX_NEXT_REQUESTS = 64
         settings.MESSAGE_BUS = 'tests.mocks.message_bus.FakeMessageBus'
-        if distributed:
+        if encoded:
+            settings.BACKEND = 'tests.mocks.components.FakeEncodedDistributedBackend'
+        elif distributed:
             settings.BACKEND = 'tests.mocks.components.FakeDistributedBackend'
         else:
             settings.BACKEND = 'tests.mocks.components.FakeBackend'
@@ -52,6 +60,100 @@ class TestDBWorker(object):
         assert dbw._backend.errors[0][0].url == r1.url
         assert dbw._backend.errors[0][1] == 'error'
 
+    def test_mixed_batch(self):
+        dbw = self.dbw_setup()
+        msgs = [dbw._encoder.encode_add_seeds([r1]),
+                dbw._encoder.encode_page_crawled(Response(r1.url, request=r1)),
+                dbw._encoder.encode_links_extracted(r1, [r2]),
+                dbw._encoder.encode_page_crawled(Response(r2.url, request=r2)),
+                dbw._encoder.encode_links_extracted(r2, [r3]),
+                dbw._encoder.encode_request_error(r3, 'error')]
+        dbw.spider_log_consumer.put_messages(msgs)
+        assert dbw.consume_incoming() == 6
+        assert [r.url for r in dbw._backend.seeds] == [r1.url]
+        assert set([r.url for r in dbw._backend.responses]) == set([r1.url, r2.url])
+        assert set([r.url for r in dbw._backend.links]) == set([r2.url, r3.url])
+        assert [(r.url, e) for r, e in dbw._backend.errors] == [(r3.url, 'error')]
+
+    def test_batch_fallback(self):
+        dbw = self.dbw_setup()
+
+        def page_crawled_many(responses):
+            raise ValueError
+
+        def page_crawled(response):
+            if response.url == r2.url:
+                raise ValueError
+            dbw._backend.responses.append(response)
+        dbw._backend.page_crawled_many = page_crawled_many
+        dbw._backend.page_crawled = page_crawled
+        msgs = [dbw._encoder.encode_page_crawled(Response(r.url, request=r)) for r in [r1, r2, r3]]
+        dbw.spider_log_consumer.put_messages(msgs)
+        dbw.consume_incoming()
+        assert set([r.url for r in dbw._backend.responses]) == set([r1.url, r3.url])
+
+    def test_idle_metadata_flush(self):
+        dbw = self.dbw_setup()
+        assert dbw._flush_metadata is None
+        flushed = []
+        dbw._flush_metadata = lambda: flushed.append(True)
+        # no messages consumed, but buffered metadata still gets a chance to be written
+        dbw.consume_incoming()
+        assert flushed == [True]
+
+    def test_thread_pool(self, monkeypatch):
+        class FakeReactor(object):
+            def __init__(self):
+                self.calls = []
+
+            def callFromThread(self, f, *args, **kwargs):
+                self.calls.append(f)
+
+        reactor = FakeReactor()
+        monkeypatch.setattr('frontera.worker.db.reactor', reactor)
+        dbw = self.dbw_setup(pool_size=2)
+        assert isinstance(dbw.slot.consumption, CallInThreadOnce)
+        assert isinstance(dbw.slot.new_batch, CallInThreadOnce)
+        dbw.spider_log_consumer.put_messages([dbw._encoder.encode_add_seeds([r1, r2])])
+        done = Event()
+        result = []
+
+        def on_result(success, value):
+            result.append((success, value))
+            done.set()
+
+        dbw.threadpool.start()
+        try:
+            dbw.threadpool.callInThreadWithCallback(on_result, dbw.consume_incoming)
+            assert done.wait(10)
+        finally:
+            dbw.threadpool.stop()
+        assert result == [(True, 1)]
+        assert set([r.url for r in dbw._backend.seeds]) == set([r1.url, r2.url])
+        # rescheduling is handed off to the reactor thread
+        assert reactor.calls == [dbw.slot.schedule]
+
+    def test_thread_pool_reschedule(self, monkeypatch):
+        monkeypatch.setattr('frontera.worker.db.isInIOThread', lambda: True)
+        clock = ThreadClock()
+        pool = DeferredThreadPool()
+        consumed = []
+
+        def consume_incoming():
+            consumed.append(1)
+            # tasks are rescheduling themselves at the end of the run, while they are still running
+            slot.schedule()
+            return 0
+        slot = Slot(None, consume_incoming, None, True, True, 5.0, False, threadpool=pool, clock=clock)
+        slot.schedule()
+        clock.advance(0)
+        pool.run_all()
+        assert consumed == [1]
+        clock.advance(0)
+        assert len(pool.calls) == 1
+        pool.run_all()
+        assert consumed == [1, 1]
+
     def test_scoring(self):
         dbw = self.dbw_setup(True)
         msg = dbw._encoder.encode_add_seeds([r1, r2, r3])
@@ -65,6 +167,15 @@ class TestDBWorker(object):
         assert set([r.url for r in dbw._backend.queue.requests]) == set([r1.url, r3.url])
         assert dbw.new_batch() == 2
 
+    def test_scoring_coalesced(self):
+        dbw = self.dbw_setup(True)
+        dbw.merge_score = max
+        dbw.scoring_log_consumer.put_messages([dbw._encoder.encode_update_score(r1, 0.5, False),
+                                               dbw._encoder.encode_update_score(r1, 0.8, True),
+                                               dbw._encoder.encode_update_score(r1, 0.3, False)])
+        dbw.consume_scoring()
+        assert [(r.url, r.meta[b'score']) for r in dbw._backend.queue.requests] == [(r1.url, 0.8)]
+
     def test_new_batch(self):
         dbw = self.dbw_setup(True)
         dbw._backend.queue.put_requests([r1, r2, r3])
@@ -72,6 +183,25 @@ class TestDBWorker(object):
         assert set(dbw.spider_feed_producer.messages) == \
             set([dbw._encoder.encode_request(r) for r in [r1, r2, r3]])
 
+    def test_new_batch_encoded(self):
+        dbw = self.dbw_setup(encoded=True)
+        dbw.job_id = 2
+        dbw._backend.queue.put_requests([r1, r2, r3])
+        assert dbw.new_batch() == 3
+        requests = [dbw._decoder.decode_request(m) for m in dbw.spider_feed_producer.messages]
+        assert set([r.url for r in requests]) == set([r1.url, r2.url, r3.url])
+        assert all(r.meta[b'jid'] == 2 for r in requests)
+
+    def test_new_batch_encoded_other_codec(self):
+        dbw = self.dbw_setup(encoded=True, codec='frontera.contrib.backends.remote.codecs.json')
+        assert not dbw._pass_encoded
+        dbw.job_id = 2
+        dbw._backend.queue.put_requests([r1, r2, r3])
+        assert dbw.new_batch() == 3
+        requests = [dbw._decoder.decode_request(m) for m in dbw.spider_feed_producer.messages]
+        assert set([r.url for r in requests]) == set([r1.url, r2.url, r3.url])
+        assert all(r.meta[b'jid'] == 2 for r in requests)
+
     def test_offset(self):
         dbw = self.dbw_setup(True)
         msg = dbw._encoder.encode_offset(2, 50)
@@ -91,6 +221,19 @@ class TestDBWorker(object):
         assert dbw.new_batch() == 3
         assert 3 in dbw._backend.partitions
 
+    def test_new_batch_quotas(self):
+        dbw = self.dbw_setup(True)
+        msg1 = dbw._encoder.encode_offset(0, 40)
+        msg2 = dbw._encoder.encode_offset(1, 100)
+        dbw.spider_log_consumer.put_messages([msg1, msg2])
+        dbw.spider_feed_producer.offset = 110
+        dbw.consume_incoming()
+        assert dbw.spider_feed.partition_deficits() == {1: 54}
+
+        dbw._backend.queue.put_requests([r1, r2, r3])
+        assert dbw.new_batch() == 3
+        assert dbw._backend.quotas == {1: 54}
+
     @pytest.mark.skip
     def test_busy_on_new_batch(self):
         dbw = self.dbw_setup(True)
@@ -1,4 +1,5 @@
-from frontera.worker.strategy import StrategyWorker
+from frontera.worker.strategy import StrategyWorker, UpdateScoreStream
+from frontera.worker.strategies import BaseCrawlingStrategy
 from frontera.worker.strategies.bfs import CrawlingStrategy
 from frontera.settings import Settings
 from frontera.core.models import Request, Response
@@ -11,14 +12,25 @@ r3 = Request('https://www.dmoz.org', meta={b'fingerprint': b'3', b'jid': 0})
 r4 = Request('http://www.test.com/some/page', meta={b'fingerprint': b'4', b'jid': 0})
 
 
+class PerMessageStrategy(CrawlingStrategy):
+
+    score_links = BaseCrawlingStrategy.score_links
+
+    def links_extracted(self, request, links):
+        self.extracted = getattr(self, 'extracted', []) + [[link.url for link in links]]
+        super(PerMessageStrategy, self).links_extracted(request, links)
+
+
 class TestStrategyWorker(object):
 
-    def sw_setup(self):
+    def sw_setup(self, strategy_class=CrawlingStrategy, links_dedup=False, batch_scoring=False):
         settings = Settings()
         settings.BACKEND = 'frontera.contrib.backends.sqlalchemy.Distributed'
         settings.MESSAGE_BUS = 'tests.mocks.message_bus.FakeMessageBus'
         settings.SPIDER_LOG_CONSUMER_BATCH_SIZE = 100
-        return StrategyWorker(settings, CrawlingStrategy)
+        settings.STRATEGY_LINKS_DEDUP = links_dedup
+        settings.STRATEGY_BATCH_SCORING = batch_scoring
+        return StrategyWorker(settings, strategy_class)
 
     def test_add_seeds(self):
         sw = self.sw_setup()
@@ -63,6 +75,13 @@ class TestStrategyWorker(object):
         assert set(sw.scoring_log_producer.messages) == \
             set(sw._encoder.encode_update_score(r, sw.strategy.get_score(r.url), True) for r in [r3, r4])
 
+    def test_domain_fingerprint(self):
+        sw = self.sw_setup(batch_scoring=True)
+        assert sw._get_domain_fingerprint(Request('http://a.com/', meta={b'domain': {b'fingerprint': b'5'}})) == b'5'
+        # domain info may be set to something else by custom middlewares
+        assert sw._get_domain_fingerprint(Request('http://a.com/', meta={b'domain': 5})) is None
+        assert sw._get_domain_fingerprint(Request('http://a.com/')) is None
+
     def test_request_error(self):
         sw = self.sw_setup()
         msg = sw._encoder.encode_request_error(r4, 'error')
@@ -71,3 +90,84 @@ class TestStrategyWorker(object):
         r4.meta[b'state'] = States.ERROR
         assert sw.scoring_log_producer.messages.pop() == \
             sw._encoder.encode_update_score(r4, 0.0, False)
+
+    def test_prefetch(self):
+        sw = self.sw_setup()
+        sw.states_prefetch = True
+        for r in [r1, r2, r3]:
+            r.meta[b'state'] = States.NOT_CRAWLED
+        sw.consumer.put_messages([sw._encoder.encode_add_seeds([r1, r2])])
+        sw.work()
+        # batch is processed on the next run, when its states are prefetched
+        assert sw.scoring_log_producer.messages == []
+
+        sw.consumer.put_messages([sw._encoder.encode_add_seeds([r1, r3])])
+        sw.work()
+        r1.meta[b'state'] = States.QUEUED
+        r2.meta[b'state'] = States.QUEUED
+        assert set(sw.scoring_log_producer.messages) == \
+            set([sw._encoder.encode_update_score(r, 1.0, True) for r in [r1, r2]])
+
+        # states cached by the previous batch aren't overwritten by prefetched ones
+        sw.scoring_log_producer.messages = []
+        sw.work()
+        r3.meta[b'state'] = States.QUEUED
+        assert sw.scoring_log_producer.messages == [sw._encoder.encode_update_score(r3, 1.0, True)]
+
+        # all batches are read by the same thread, which is stopped with the worker
+        reader = sw._states_reader
+        sw.work()
+        assert sw._states_reader is reader
+        sw.stop()
+        assert not reader._thread.is_alive()
+
+    def test_score_links(self):
+        assert not self.sw_setup().batch_scoring
+        sw = self.sw_setup(batch_scoring=True)
+        assert sw.batch_scoring
+        r1.meta[b'jid'] = 0
+        r2.meta[b'jid'] = 0
+        sw.consumer.put_messages([sw._encoder.encode_links_extracted(r1, [r3, r4]),
+                                  sw._encoder.encode_links_extracted(r2, [r4])])
+        sw.work()
+        # r4 is extracted twice, but scheduled once
+        assert len(sw.scoring_log_producer.messages) == 2
+        assert sw.stats['duplicate_links_since_start'] == 1
+        r3.meta[b'state'] = States.QUEUED
+        r4.meta[b'state'] = States.QUEUED
+        assert set(sw.scoring_log_producer.messages) == \
+            set(sw._encoder.encode_update_score(r, sw.strategy.get_score(r.url), True) for r in [r3, r4])
+
+    def test_update_score_coalesced(self):
+        sw = self.sw_setup()
+        stream = UpdateScoreStream(sw._encoder, sw.scoring_log_producer, 1024, 'sum')
+        stream.send(r1, 0.25, dont_queue=True)
+        stream.send(r2, 0.5)
+        stream.send(r1, 0.5)
+        stream.flush()
+        assert set(sw.scoring_log_producer.messages) == \
+            set([sw._encoder.encode_update_score(r1, 0.75, True), sw._encoder.encode_update_score(r2, 0.5, True)])
+
+    def test_links_dedup_stale_job(self):
+        sw = self.sw_setup(PerMessageStrategy, True)
+        stale = Request(r1.url, meta={b'fingerprint': r1.meta[b'fingerprint'], b'jid': 1})
+        r2.meta[b'jid'] = 0
+        # fake consumer returns messages in reverse order
+        sw.consumer.put_messages([sw._encoder.encode_links_extracted(r2, [r3, r4]),
+                                  sw._encoder.encode_links_extracted(stale, [r3, r4])])
+        sw.work()
+        assert sw.strategy.extracted == [[r3.url, r4.url]]
+        assert sw.stats['duplicate_links_since_start'] == 0
+
+    def test_links_dedup(self):
+        r1.meta[b'jid'] = 0
+        r2.meta[b'jid'] = 0
+        msgs = [(r1, [r3, r4]), (r2, [r4])]
+        for links_dedup, extracted in [(False, [[r3.url, r4.url], [r4.url]]), (True, [[r3.url, r4.url], []])]:
+            sw = self.sw_setup(PerMessageStrategy, links_dedup)
+            assert not sw.batch_scoring
+            # fake consumer returns messages in reverse order
+            sw.consumer.put_messages([sw._encoder.encode_links_extracted(request, links)
+                                      for request, links in reversed(msgs)])
+            sw.work()
+            assert sw.strategy.extracted == extracted